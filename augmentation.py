@@ -0,0 +1,128 @@
+'''
+Online augmentation of the sensor layout, batched tensor ops on the training device after collate
+'''
+
+import torch
+
+
+class SensorAugment:
+    '''Random sensor dropout, reading jitter, flips/transposes and translations of a collated batch.
+       The target image and the target_float coordinates are transformed together with the input,
+       so a fixed sensor layout in the dataset becomes many layouts during training at no extra I/O cost
+    '''
+    def __init__(self, dropout: float = 0.1, jitter: float = 0.025, flip: bool = True, max_shift: int = 10, floor: float = 0.,
+                 sensors=None):
+        '''
+        Args:
+            dropout   -- float -- probability of a sensor being set back to the noise floor
+            jitter    -- float -- std of the Gaussian noise added to the sensor readings, in normalized unit
+                                  (after UniformNormalize, 1 dB is 1/40)
+            flip      -- bool  -- random flips of x and y, and random transpose when the grid is square
+            max_shift -- int   -- max translation in cells, the shift keeps all TX inside the grid
+            floor     -- float -- the normalized noise floor, 0 after UniformNormalize
+            sensors   -- SensorArray -- the sensor layout of the dataset. By default a sensor is a cell above the noise floor,
+                                        which misses the sensors that read the noise floor
+        '''
+        self.dropout = dropout
+        self.jitter = jitter
+        self.flip = flip
+        self.max_shift = max_shift
+        self.floor = floor
+        self.sensor_mask = None if sensors is None else torch.as_tensor(sensors.mask())
+
+    def __call__(self, X: torch.Tensor, y: torch.Tensor, y_float: torch.Tensor, y_num: torch.Tensor):
+        '''
+        Args:
+            X       -- torch.Tensor -- (N, 1, H, W), the normalized sensor readings
+            y       -- torch.Tensor -- (N, 1, H, W), the target image
+            y_float -- torch.Tensor -- (N, max_ntx, 2), the TX locations, padded with zeros by my_collate
+            y_num   -- torch.Tensor -- (N,), number of TX of each sample
+        Return:
+            torch.Tensor, torch.Tensor, torch.Tensor -- X, y, y_float after augmentation (new tensors)
+        '''
+        X = self.sensor_noise(X)
+        if self.flip or self.max_shift > 0:
+            X, y, y_float = self.geometric(X, y, y_float, y_num)
+        return X, y, y_float
+
+    def sensor_noise(self, X: torch.Tensor):
+        '''dropout and jitter of the sensor cells (the cells above the noise floor)
+        '''
+        if self.sensor_mask is None:
+            sensor = X > self.floor
+        else:
+            if self.sensor_mask.device != X.device:
+                self.sensor_mask = self.sensor_mask.to(X.device)
+            sensor = self.sensor_mask.expand_as(X)
+        if self.jitter > 0:
+            X = torch.where(sensor, torch.clamp(X + torch.randn_like(X) * self.jitter, min=self.floor), X)
+        if self.dropout > 0:
+            drop = sensor & (torch.rand_like(X) < self.dropout)
+            X = X.masked_fill(drop, self.floor)
+        return X
+
+    def geometric(self, X: torch.Tensor, y: torch.Tensor, y_float: torch.Tensor, y_num: torch.Tensor):
+        '''per sample transpose, flips and translation, done as one gather with the source index of every cell.
+           The target image is rebuilt from the moved TX locations, a TX moved to the border has a clipped neighborhood
+        '''
+        N, _, H, W = X.shape
+        device = X.device
+        valid = torch.arange(y_float.shape[1], device=device)[None, :] < y_num.to(device).view(-1, 1)   # (N, max_ntx)
+        zeros = torch.zeros(N, dtype=torch.bool, device=device)
+        transpose = (torch.rand(N, device=device) < 0.5) if self.flip and H == W else zeros
+        flip_x = (torch.rand(N, device=device) < 0.5) if self.flip else zeros
+        flip_y = (torch.rand(N, device=device) < 0.5) if self.flip else zeros
+
+        # 1 transform the TX locations, then choose a shift that keeps every TX inside the grid
+        loc = y_float.clone()
+        loc = torch.where(transpose.view(-1, 1, 1), loc.flip(2), loc)
+        loc[:, :, 0] = torch.where(flip_x.view(-1, 1), H - loc[:, :, 0], loc[:, :, 0])
+        loc[:, :, 1] = torch.where(flip_y.view(-1, 1), W - loc[:, :, 1], loc[:, :, 1])
+        shift = []
+        for axis, length in [(0, H), (1, W)]:
+            cell = torch.floor(loc[:, :, axis])
+            low = torch.where(valid, -cell, torch.full_like(cell, -float('inf'))).max(1)[0].clamp(min=-self.max_shift)
+            high = torch.where(valid, length - 1 - cell, torch.full_like(cell, float('inf'))).min(1)[0].clamp(max=self.max_shift)
+            high = torch.max(high, low)
+            shift.append(torch.floor(low + torch.rand(N, device=device) * (high - low + 1)).clamp(max=high).long())
+        loc[:, :, 0] += shift[0].view(-1, 1)
+        loc[:, :, 1] += shift[1].view(-1, 1)
+        y_float = torch.where(valid.unsqueeze(2), loc, y_float)
+
+        # 2 the source cell of every destination cell: undo the shift, the flips, then the transpose
+        rows = torch.arange(H, device=device).view(1, H, 1) - shift[0].view(-1, 1, 1)
+        cols = torch.arange(W, device=device).view(1, 1, W) - shift[1].view(-1, 1, 1)
+        inside = (rows >= 0) & (rows < H) & (cols >= 0) & (cols < W)
+        rows = torch.where(flip_x.view(-1, 1, 1), H - 1 - rows, rows).expand(N, H, W)
+        cols = torch.where(flip_y.view(-1, 1, 1), W - 1 - cols, cols).expand(N, H, W)
+        src_r = torch.where(transpose.view(-1, 1, 1), cols, rows).clamp(0, H - 1)
+        src_c = torch.where(transpose.view(-1, 1, 1), rows, cols).clamp(0, W - 1)
+        batch = torch.arange(N, device=device).view(-1, 1, 1)
+        X = torch.where(inside, X[batch, 0, src_r, src_c], torch.full_like(X[:, 0], self.floor)).unsqueeze(1)
+        y = SensorAugment.target(y_float, valid, H, W).to(y.dtype)
+        return X, y, y_float
+
+    @staticmethod
+    def target(y_float: torch.Tensor, valid: torch.Tensor, H: int, W: int):
+        '''the target image of get_translation_target in dataset.py, for a batch: the 3 x 3 cells around each TX get
+           the inverse distance weights, normalized over the cells inside the grid
+        Args:
+            y_float -- torch.Tensor -- (N, max_ntx, 2), the TX locations
+            valid   -- torch.Tensor -- (N, max_ntx), False for the padding of my_collate
+        Return:
+            torch.Tensor -- (N, 1, H, W), float64
+        '''
+        N, device = len(y_float), y_float.device
+        loc = y_float.double()
+        offset = torch.arange(-1, 2, device=device)
+        nx = torch.floor(loc[:, :, 0]).long().view(N, -1, 1, 1) + offset.view(1, 1, 3, 1)      # (N, max_ntx, 3, 1)
+        ny = torch.floor(loc[:, :, 1]).long().view(N, -1, 1, 1) + offset.view(1, 1, 1, 3)      # (N, max_ntx, 1, 3)
+        inside = (nx >= 0) & (nx < H) & (ny >= 0) & (ny < W) & valid.view(N, -1, 1, 1)          # (N, max_ntx, 3, 3)
+        dist = torch.sqrt((nx + 0.5 - loc[:, :, 0].view(N, -1, 1, 1)) ** 2 + (ny + 0.5 - loc[:, :, 1].view(N, -1, 1, 1)) ** 2)
+        weight = torch.where(inside, 1. / dist, torch.zeros_like(dist))
+        count = inside.sum(dim=(2, 3), keepdim=True)
+        value = weight / weight.sum(dim=(2, 3), keepdim=True).clamp(min=1e-12) * count * 3
+        cell = (nx.clamp(0, H - 1) * W + ny.clamp(0, W - 1)).view(N, -1)
+        y = torch.zeros(N, H * W, dtype=torch.float64, device=device)
+        y.scatter_add_(1, cell, torch.where(inside, value, torch.zeros_like(value)).view(N, -1))
+        return y.view(N, 1, H, W)
@@ -0,0 +1,217 @@
+'''
+Benchmarks for the latency of the models and the pipelines
+'''
+
+import argparse
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+from input_output import Default
+
+
+class Benchmark:
+    '''some benchmarks, the results are printed as a table
+    '''
+    @staticmethod
+    def timeit(func, repeat: int = 10, warmup: int = 2):
+        '''the latency of calling func
+        Args:
+            func   -- callable -- no arguments
+            repeat -- int      -- number of timed runs
+            warmup -- int      -- number of untimed runs
+        Return:
+            (float, float) -- mean and std of the latency in milliseconds
+        '''
+        for _ in range(warmup):
+            func()
+        latency = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            latency.append((time.perf_counter() - start) * 1000)
+        return np.mean(latency), np.std(latency)
+
+    @staticmethod
+    def count_head(grid_lengths: list, batch_size: int = 32, repeat: int = 10, device=None):
+        '''latency of the NetNumTx head (fully connected, 100 x 100 only) against the NetNumTxPool head (any grid size)
+        Args:
+            grid_lengths -- list<int> -- the grid lengths to benchmark
+            batch_size   -- int       -- the batch size
+            repeat       -- int       -- number of timed runs
+        '''
+        from deepleaning_models import NetNumTx, NetNumTxPool
+
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        heads = {'NetNumTx': NetNumTx(max_ntx=10).to(device).eval(), 'NetNumTxPool': NetNumTxPool().to(device).eval()}
+        print(f'{"model":<14}{"grid":>6}{"ms/batch":>12}{"std":>8}{"us/cell":>10}')
+        for grid_length in grid_lengths:
+            X = torch.randn(batch_size, 1, grid_length, grid_length, device=device)
+            for name, head in heads.items():
+                if name == 'NetNumTx' and grid_length != Default.grid_length:
+                    print(f'{name:<14}{grid_length:>6}{"n/a":>12}')
+                    continue
+                def forward():
+                    with torch.no_grad():
+                        head(X)
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize()
+                mean, std = Benchmark.timeit(forward, repeat)
+                per_cell = mean * 1000 / (batch_size * grid_length * grid_length)
+                print(f'{name:<14}{grid_length:>6}{mean:>12.2f}{std:>8.2f}{per_cell:>10.4f}')
+
+    @staticmethod
+    def cpu_runner(name: str, checkpoint: str, exported: list, batch_size: int = 32, repeat: int = 10,
+                   num_threads: int = None, runtime: bool = False, **kwargs):
+        '''latency of the eager model against the exported models run by CpuRunner
+        Args:
+            name       -- str       -- the class name of the model
+            checkpoint -- str       -- the state dict
+            exported   -- list<str> -- TorchScript files saved by Export.export, run in the layout they are exported in
+            runtime    -- bool      -- pin to the available cores and one intra op thread per core, see Runtime
+            kwargs     -- the arguments of the model, eg. max_ntx=10 for NetNumTx
+        '''
+        from export import Export, CpuRunner
+
+        if runtime:
+            from runtime import Runtime
+            config = Runtime.apply(Runtime.plan(0))
+            num_threads = config.intra_op if num_threads is None else num_threads
+            print('\n'.join(Runtime.metadata(config)))
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        eager = Export.load(name, checkpoint, **kwargs)
+        X = Export.calibration_data(num=batch_size)
+        def forward():
+            with torch.no_grad():
+                eager(X)
+        mean, std = Benchmark.timeit(forward, repeat)
+        print(f'{"model":<40}{"ms/batch":>12}{"std":>8}{"speedup":>9}')
+        print(f'{"eager " + name:<40}{mean:>12.2f}{std:>8.2f}{1:>9.2f}')
+        baseline = mean
+        for filename in exported:
+            runner = CpuRunner(filename, num_threads)
+            mean, std = Benchmark.timeit(lambda: runner(X), repeat)
+            print(f'{filename:<40}{mean:>12.2f}{std:>8.2f}{baseline / mean:>9.2f}')
+
+    @staticmethod
+    def startup(repeat: int = 5, budget: float = None):
+        '''start up time of the command line entry points and the light weight modules,
+           and check that the heavy modules (torch, scipy, matplotlib, seaborn) are not loaded by them
+        Args:
+            repeat -- int   -- number of runs of each command
+            budget -- float -- if not None, raise an error when a command is slower than budget milliseconds
+        '''
+        heavy = ['torch', 'scipy', 'matplotlib', 'seaborn', 'imageio']
+        check = f'import sys; print(",".join(m for m in {heavy} if m in sys.modules))'
+        commands = {
+            'python -c pass':               ['-c', 'pass'],
+            'python generate.py -h':        ['generate.py', '-h'],
+            'import utility':               ['-c', 'import utility; ' + check],
+            'import generate':              ['-c', 'import generate; ' + check],
+            'Utility.compute_error':        ['-c', 'from utility import Utility; Utility.compute_error([(1, 1)], [(2, 2)], 20); ' + check],
+        }
+        print(f'{"command":<28}{"ms":>10}{"std":>8}  heavy modules loaded')
+        slow = []
+        for name, command in commands.items():
+            latency = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                output = subprocess.run([sys.executable] + command, capture_output=True, text=True, check=True).stdout
+                latency.append((time.perf_counter() - start) * 1000)
+            loaded = output.strip().split('\n')[-1] if command[0] == '-c' and command[1] != 'pass' else ''
+            print(f'{name:<28}{np.mean(latency):>10.1f}{np.std(latency):>8.1f}  {loaded}')
+            if loaded or (budget is not None and np.mean(latency) > budget):
+                slow.append(name)
+        if budget is not None and slow:
+            raise RuntimeError(f'start up is over the budget of {budget} ms or loads heavy modules: {slow}')
+
+    @staticmethod
+    def storage(root_dir: str, checkpoint: str, num: int = 256, repeat: int = 3):
+        '''size, read time and localization error of the float32, float16 and int16 storage of the matrices.
+           The samples of a float32 dataset are saved again in each dtype, the localization uses the true # of TX
+           so that only the storage changes the error
+        Args:
+            root_dir   -- str -- a float32 dataset generated by generate.py
+            checkpoint -- str -- the state dict of NetTranslation4
+            num        -- int -- number of samples
+        '''
+        import os
+        import tempfile
+        from dataset import UniformNormalize
+        from deepleaning_models import NetTranslation4
+        from generate import GenerateData
+        from sample_index import SampleIndex
+        from utility import Utility
+
+        index = SampleIndex.load(root_dir)
+        num = min(num, len(index))
+        dB = [np.load(index.path(root_dir, i)).astype(np.float32) for i in range(num)]
+        truth = [index.target(i) for i in range(num)]
+        model = NetTranslation4()
+        model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+        model.eval()
+        normalize = UniformNormalize(Default.noise_floor)
+        print(f'{"dtype":<10}{"KB/sample":>12}{"read ms":>10}{"max dB err":>12}{"loc error":>11}{"miss":>8}{"false":>8}')
+        with tempfile.TemporaryDirectory() as tmp:
+            for dtype in ['float32', 'float16', 'int16']:
+                files = [os.path.join(tmp, f'{dtype}-{i}.npy') for i in range(num)]
+                for f, matrix in zip(files, dB):
+                    np.save(f, GenerateData.quantize(matrix, dtype))
+                size = np.mean([os.path.getsize(f) for f in files]) / 1024
+                read, _ = Benchmark.timeit(lambda: [normalize(np.load(f)) for f in files], repeat, warmup=1)
+                X = np.stack([normalize(np.load(f)) for f in files])
+                dB_error = np.abs(np.stack([UniformNormalize.dequantize(np.load(f)) for f in files]) - np.stack(dB)).max()
+                with torch.no_grad():
+                    pred = model(torch.as_tensor(X).unsqueeze(1))[:, 0].numpy()
+                peaks, _ = Utility.detect_peak_batch(pred, [len(t) for t in truth], 0.1)
+                errors, misses, falses = [], [], []
+                for p, t in zip(peaks, truth):
+                    error, miss, false = Utility.compute_error(p, t, Default.grid_length * Default.error_threshold)
+                    errors.extend(error)
+                    misses.append(miss)
+                    falses.append(false)
+                print(f'{dtype:<10}{size:>12.1f}{read:>10.1f}{dB_error:>12.4f}{np.mean(errors):>11.4f}{np.mean(misses):>8.3f}{np.mean(falses):>8.3f}')
+
+
+if __name__ == '__main__':
+
+    # python benchmark.py -ch -gl 100 200 400 1000
+    # python benchmark.py -su -bu 500
+    # python benchmark.py -cr -n NetTranslation4 -c model/model1-11.10.pt -ex model/model1.pt model/model1-int8-cl.pt
+    # python benchmark.py -cr -n NetNumTx -mn 10 -c model/model2-11.10.pt -ex model/model2-11.10.int8.pt
+    # python benchmark.py -sg -rd data/matrix-test51 -c model/model1-11.10.pt
+
+    parser = argparse.ArgumentParser(description='Benchmarks')
+    parser.add_argument('-ch', '--count_head', action='store_true', help='latency of the # of TX heads')
+    parser.add_argument('-cr', '--cpu_runner', action='store_true', help='latency of the exported models on the CPU')
+    parser.add_argument('-su', '--startup', action='store_true', help='start up time of the command line and light modules')
+    parser.add_argument('-sg', '--storage', action='store_true', help='size, read time and error of the reduced precision storage')
+    parser.add_argument('-rd', '--root_dir', nargs=1, type=str, default=['data/matrix-test51'], help='a float32 dataset')
+    parser.add_argument('-bu', '--budget', nargs=1, type=float, default=[None], help='start up budget in milliseconds')
+    parser.add_argument('-n', '--name', nargs=1, type=str, default=['NetTranslation4'], help='the class name of the model')
+    parser.add_argument('-c', '--checkpoint', nargs=1, type=str, default=[None], help='the state dict')
+    parser.add_argument('-mn', '--max_ntx', nargs=1, type=int, default=[None], help='max_ntx of NetNumTx')
+    parser.add_argument('-ex', '--exported', nargs='+', type=str, default=[], help='TorchScript files')
+    parser.add_argument('-th', '--num_threads', nargs=1, type=int, default=[None], help='intra op threads')
+    parser.add_argument('-rt', '--runtime', action='store_true', help='pin the cores and set the threads by Runtime.plan')
+    parser.add_argument('-gl', '--grid_length', nargs='+', type=int, default=[Default.grid_length], help='the grid lengths')
+    parser.add_argument('-bs', '--batch_size', nargs=1, type=int, default=[32], help='the batch size')
+    parser.add_argument('-re', '--repeat', nargs=1, type=int, default=[10], help='number of timed runs')
+    args = parser.parse_args()
+
+    if args.count_head:
+        Benchmark.count_head(args.grid_length, args.batch_size[0], args.repeat[0])
+
+    if args.cpu_runner:
+        kwargs = {} if args.max_ntx[0] is None else {'max_ntx': args.max_ntx[0]}
+        Benchmark.cpu_runner(args.name[0], args.checkpoint[0], args.exported, args.batch_size[0], args.repeat[0], args.num_threads[0],
+                             args.runtime, **kwargs)
+
+    if args.startup:
+        Benchmark.startup(args.repeat[0], args.budget[0])
+
+    if args.storage:
+        Benchmark.storage(args.root_dir[0], args.checkpoint[0])
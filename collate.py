@@ -16,7 +16,7 @@ sys.path.insert(0, '/home/caitao/Project/dl-localization')
 from input_output import Default
 from utility import Utility
 
-from torch._six import container_abcs, string_classes, int_classes
+import collections.abc as container_abcs
 import re
 np_str_obj_array_pattern = re.compile(r'[SaUO]')
 default_collate_err_msg_format = (
@@ -149,9 +149,9 @@ def my_collate(batch):
             return torch.as_tensor(batch)
     elif isinstance(elem, float):
         return torch.tensor(batch, dtype=torch.float64)
-    elif isinstance(elem, int_classes):
+    elif isinstance(elem, int):
         return torch.tensor(batch)
-    elif isinstance(elem, string_classes):
+    elif isinstance(elem, str):
         return batch
     elif isinstance(elem, container_abcs.Mapping):
         return {key: my_collate([d[key] for d in batch]) for key in elem}
@@ -173,7 +173,7 @@ root_dir = './data/matrix-train51'
 sensor_input_dataset = SensorInputDatasetTranslation(root_dir = root_dir, transform = tf)
 sensor_input_dataloader = DataLoader(sensor_input_dataset, batch_size=32, shuffle=True, num_workers=3, collate_fn=my_collate)
 
-device = torch.device('cuda')
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
 def my_uncollate(y_num, y_float):
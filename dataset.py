@@ -0,0 +1,257 @@
+'''
+The datasets, transforms and collate functions of the multi TX image translation pipeline
+'''
+
+import os
+import re
+import collections.abc as container_abcs
+import numpy as np
+import torch
+import torchvision.transforms as T
+from torch.utils.data import Dataset, Subset
+from input_output import Default
+from utility import Utility
+from sample_index import SampleIndex
+from shard import ShardReader
+from sample_cache import SampleCache
+
+np_str_obj_array_pattern = re.compile(r'[SaUO]')
+default_collate_err_msg_format = (
+    "default_collate: batch must contain tensors, numpy arrays, numbers, "
+    "dicts or lists; found {}")
+
+
+class MinMaxNormalize:
+    '''Min max normalization, the new bound is (lower, upper)
+    '''
+    def __init__(self, lower=0, upper=1):
+        assert isinstance(lower, (int, float))
+        assert isinstance(upper, (int, float))
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, matrix):
+        minn = matrix.min()
+        maxx = matrix.max()
+        matrix = (matrix - minn) / (maxx - minn)
+        if self.lower != 0 or self.upper != 1:
+            matrix = self.lower + matrix * (self.upper - self.lower)
+        return matrix.astype(np.float32)
+
+
+class UniformNormalize:
+    '''Set a uniform threshold accross all samples
+       The matrices stored as int16 fixed point dB (see GenerateData.quantize) are dequantized and normalized
+       in one multiply add, the float16 ones are cast to float32 first
+    '''
+    def __init__(self, noise_floor, db_scale=Default.db_scale):
+        self.noise_floor = noise_floor
+        self.db_scale = db_scale
+
+    def __call__(self, matrix):
+        if matrix.dtype == np.int16:
+            scale = np.float32(self.db_scale / (-self.noise_floor/2))
+            return matrix * scale + np.float32(self.noise_floor / (self.noise_floor/2))
+        if matrix.dtype != np.float32 and matrix.dtype != np.float64:
+            matrix = matrix.astype(np.float32)
+        matrix -= self.noise_floor
+        matrix /= (-self.noise_floor/2)
+        return matrix.astype(np.float32)
+
+    @staticmethod
+    def dequantize(matrix, db_scale=Default.db_scale):
+        '''the stored matrix back to float32 dB
+        '''
+        if matrix.dtype == np.int16:
+            return matrix * np.float32(db_scale)
+        return matrix.astype(np.float32)
+
+
+tf = T.Compose([
+     UniformNormalize(Default.noise_floor),                 # TUNE: Uniform normalization is better than the above minmax normalization
+     T.ToTensor()])
+
+
+class SensorInputDatasetTranslation(Dataset):
+    '''Sensor reading input dataset -- for multi TX
+       Output is image, model as a image segmentation problem
+       The length, the file of each sample and the TX locations come from the SampleIndex of root_dir.
+       With enable_cache, the transformed matrices are kept in a SampleCache shared by the DataLoader workers
+    '''
+    def __init__(self, root_dir: str, transform=None):
+        '''
+        Args:
+            root_dir:  directory with all the images
+            labels:    labels of images
+            transform: optional transform to be applied on a sample
+        '''
+        self.root_dir = root_dir
+        self.transform = transform
+        self.index = SampleIndex.load(root_dir)
+        self.cache = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        target_img, target_float = self.get_translation_target(self.index.target(idx))
+        matrix = None if self.cache is None else self.cache.get(idx)
+        if matrix is None:
+            matrix = self.load_matrix(idx)
+            if self.transform:
+                matrix = self.transform(matrix)
+            if self.cache is not None:
+                matrix = torch.as_tensor(matrix)       # the same type for the cached and the loaded samples
+                self.cache.put(idx, matrix)
+        target_num = len(target_float)
+        sample = {'matrix':matrix, 'target':target_img, 'target_float':target_float, 'target_num':target_num, 'index':idx}
+        return sample
+
+    def load_matrix(self, idx):
+        '''the stored matrix of the idx-th sample
+        '''
+        return np.load(self.index.path(self.root_dir, idx))
+
+    def enable_cache(self, max_bytes: int):
+        '''cache the transformed matrices in shared memory, up to max_bytes. Call it before creating the DataLoader.
+           The transform must be deterministic (the augmentation runs on the batches, after the cache)
+        Return:
+            SampleCache -- for the hit and miss counters
+        '''
+        matrix = self.load_matrix(0)
+        matrix = torch.as_tensor(self.transform(matrix) if self.transform else matrix)
+        self.cache = SampleCache(len(self), max_bytes, matrix.shape, matrix.dtype)
+        return self.cache
+
+    def subset(self, num_tx=None, min_dist: float = None, max_dist: float = None):
+        '''the samples filtered by num_tx and the min pairwise TX distance, see SampleIndex.select
+        '''
+        return Subset(self, self.index.select(num_tx, min_dist, max_dist))
+
+    def stratified(self, num: int, dist_bins=None, seed: int = 0):
+        '''num samples from each (num_tx, distance bin) stratum, see SampleIndex.stratified
+        '''
+        return Subset(self, self.index.stratified(num, dist_bins, seed))
+
+    def get_translation_target(self, location: np.ndarray):
+        '''
+        Args:
+            location -- np.ndarray, n = 2, the TX locations, eg. from SampleIndex.target
+        Return:
+            np.ndarray, n = 2, the pixels surrounding TX will be assigned some values
+        '''
+        num_tx = len(location)
+        grid = np.zeros((Default.grid_length, Default.grid_length))
+        for i in range(num_tx):
+            x, y = location[i][0], location[i][1]
+            target_float = (x, y)
+            x, y = int(x), int(y)
+            neighbor = []
+            sum_weight = 0
+            for i in [-1, 0, 1]:
+                for j in [-1, 0, 1]:
+                    nxt = (x + i, y + j)
+                    if 0 <= nxt[0] < Default.grid_length and 0 <= nxt[1] < Default.grid_length:
+                        weight = 1./Utility.distance((nxt[0] + 0.5, nxt[1] + 0.5), target_float)
+                        sum_weight += weight
+                        neighbor.append((nxt, weight))
+            for n, w in neighbor:
+                grid[n[0]][n[1]] += w / sum_weight * len(neighbor) * 3  # 2 is for adding weights
+        grid = np.expand_dims(grid, 0)
+        return grid.astype(np.float32), location.astype(np.float32)
+
+
+class SensorInputDatasetShards(SensorInputDatasetTranslation):
+    '''The same samples as SensorInputDatasetTranslation, read from the compressed chunked shards of shard.py
+    '''
+    def __init__(self, root_dir: str, transform=None, cache_bytes: int = 256 << 20):
+        '''
+        Args:
+            root_dir:    the shard directory written by ShardWriter.convert
+            cache_bytes: the bound of the decompressed chunk cache of each DataLoader worker
+        '''
+        super().__init__(root_dir, transform)
+        self.reader = ShardReader(root_dir, cache_bytes)
+
+    def load_matrix(self, idx):
+        return self.reader[idx]
+
+
+def open_dataset(root_dir: str, transform=tf, cache_bytes: int = 0):
+    """SensorInputDatasetShards if root_dir is converted by shard.py, otherwise SensorInputDatasetTranslation.
+       cache_bytes > 0 enables the shared sample cache"""
+    if os.path.exists(os.path.join(root_dir, 'chunks.npz')):
+        dataset = SensorInputDatasetShards(root_dir, transform)
+    else:
+        dataset = SensorInputDatasetTranslation(root_dir, transform)
+    if cache_bytes > 0:
+        dataset.enable_cache(cache_bytes)
+    return dataset
+
+
+def my_padding(batch, max_len):
+    """add zeros to elements that are not maximum length"""
+    for i in range(len(batch)):
+        diff = max_len - len(batch[i])
+        if diff > 0:                      # padding
+            zeros = torch.zeros(diff, 2)
+            padded = torch.cat((batch[i], zeros), 0)
+            batch[i] = padded
+
+
+def my_collate(batch):
+    """Puts each data field into a tensor with outer dimension batch size"""
+    elem = batch[0]
+    elem_type = type(elem)
+    if isinstance(elem, torch.Tensor):
+        max_len = len(max(batch, key=len))
+        min_len = len(min(batch, key=len))
+        if max_len != min_len:
+            my_padding(batch, max_len)
+            elem = batch[0]               # the padded size
+        out = None
+        if torch.utils.data.get_worker_info() is not None:
+            # If we're in a background process, concatenate directly into a
+            # shared memory tensor to avoid an extra copy
+            numel = sum([x.numel() for x in batch])
+            storage = elem._typed_storage()._new_shared(numel, device=elem.device)
+            out = elem.new(storage).resize_(len(batch), *list(elem.size()))
+        return torch.stack(batch, 0, out=out)
+    elif elem_type.__module__ == 'numpy' and elem_type.__name__ != 'str_' \
+            and elem_type.__name__ != 'string_':
+        if elem_type.__name__ == 'ndarray' or elem_type.__name__ == 'memmap':
+            # array of string classes and object
+            if np_str_obj_array_pattern.search(elem.dtype.str) is not None:
+                raise TypeError(default_collate_err_msg_format.format(elem.dtype))
+
+            return my_collate([torch.as_tensor(b) for b in batch])
+        elif elem.shape == ():  # scalars
+            return torch.as_tensor(batch)
+    elif isinstance(elem, float):
+        return torch.tensor(batch, dtype=torch.float64)
+    elif isinstance(elem, int):
+        return torch.tensor(batch)
+    elif isinstance(elem, str):
+        return batch
+    elif isinstance(elem, container_abcs.Mapping):
+        return {key: my_collate([d[key] for d in batch]) for key in elem}
+    elif isinstance(elem, tuple) and hasattr(elem, '_fields'):  # namedtuple
+        return elem_type(*(my_collate(samples) for samples in zip(*batch)))
+    elif isinstance(elem, container_abcs.Sequence):
+        # check to make sure that the elements in batch have consistent size
+        it = iter(batch)
+        elem_size = len(next(it))
+        if not all(len(elem) == elem_size for elem in it):
+            raise RuntimeError('each element in list of batch should be of equal size')
+        transposed = zip(*batch)
+        return [my_collate(samples) for samples in transposed]
+
+    raise TypeError(default_collate_err_msg_format.format(elem_type))
+
+
+def my_uncollate(y_num, y_float):
+    """this is for uncollating the target_float"""
+    y_float_tmp = []
+    for ntx, y_f in zip(y_num, y_float):
+        y_float_tmp.append(y_f[:ntx])
+    return np.array(y_float_tmp, dtype=object)
@@ -66,6 +66,89 @@ class NetTranslation2(nn.Module):
         return num_features
 
 
+class NetTranslation4(nn.Module):
+    '''Image translation.
+       Comparing to NetTranslation, the filters are larger (7 x 7). This is the model used by the two CNNs in parallel design
+       (together with NetNumTx). It is fully convolutional, so it also runs on grids that are not 100 x 100
+       Assuming the input image is 1 x 100 x 100
+    '''
+    def __init__(self):
+        super(NetTranslation4, self).__init__()
+        self.conv11 = nn.Conv2d(1, 8,  7, padding=3)   # TUNE: a larger filter decrease miss, decrease localization error
+        self.conv12 = nn.Conv2d(8, 32, 7, padding=3)
+        self.conv13 = nn.Conv2d(32, 1, 7, padding=3)
+
+    def forward(self, x):
+        # first CNN input is 1 x 100 x 100
+        x = F.relu(self.conv11(x))
+        x = F.relu(self.conv12(x))
+        y = self.conv13(x)
+        return y
+
+
+class NetNumTx(nn.Module):
+    '''this CNN predicts # of TX, it runs in parallel with NetTranslation4 (two CNNs in parallel)
+       the output is max_ntx classes, class 0 means 1 TX, class 1 means 2 TX etc...
+       Assuming the input image is 1 x 100 x 100, the fully connected layer ties it to this size
+    '''
+    def __init__(self, max_ntx):
+        super(NetNumTx, self).__init__()
+        self.conv1 = nn.Conv2d(1, 2, 5)
+        self.conv2 = nn.Conv2d(2, 4, 5)
+        self.conv3 = nn.Conv2d(4, 8, 5)
+        self.groupnorm1 = nn.GroupNorm(1, 2)
+        self.groupnorm2 = nn.GroupNorm(2, 4)
+        self.groupnorm3 = nn.GroupNorm(4, 8)
+        self.fc1 = nn.Linear(648, 32)
+        self.fc2 = nn.Linear(32, max_ntx)
+
+    def forward(self, x):
+        x = F.max_pool2d(F.relu(self.groupnorm1(self.conv1(x))), 2)
+        x = F.max_pool2d(F.relu(self.groupnorm2(self.conv2(x))), 2)
+        x = F.max_pool2d(F.relu(self.groupnorm3(self.conv3(x))), 2)
+        x = x.view(-1, self.num_flat_features(x))
+        x = F.relu(self.fc1(x))
+        y = self.fc2(x)
+        return y
+
+    def num_flat_features(self, x):
+        size = x.size()[1:]
+        num_features = 1
+        for s in size:
+            num_features *= s
+        return num_features
+
+
+class NetNumTxPool(nn.Module):
+    '''this CNN predicts # of TX at any grid size
+       Comparing to NetNumTx, the fully connected layers are replaced by a 1 x 1 convolution that outputs a TX density map,
+       and the # of TX is the global sum pooling of the density map. So the cost is linear in the area,
+       and the count grows with the area instead of being tied to a 100 x 100 input.
+       The output is (N, 1) and is trained as a regression of target_num
+    '''
+    def __init__(self):
+        super(NetNumTxPool, self).__init__()
+        self.conv1 = nn.Conv2d(1, 4, 5, padding=2)
+        self.conv2 = nn.Conv2d(4, 8, 5, padding=2)
+        self.conv3 = nn.Conv2d(8, 16, 5, padding=2)
+        self.groupnorm1 = nn.GroupNorm(2, 4)
+        self.groupnorm2 = nn.GroupNorm(4, 8)
+        self.groupnorm3 = nn.GroupNorm(8, 16)
+        self.conv4 = nn.Conv2d(16, 1, 1)
+
+    def forward(self, x):
+        y = self.density(x)
+        return y.sum(dim=(2, 3))
+
+    def density(self, x):
+        '''the TX density map, its size is the input size divided by 8 (ceiling)
+        '''
+        x = F.max_pool2d(F.relu(self.groupnorm1(self.conv1(x))), 2, ceil_mode=True)
+        x = F.max_pool2d(F.relu(self.groupnorm2(self.conv2(x))), 2, ceil_mode=True)
+        x = F.max_pool2d(F.relu(self.groupnorm3(self.conv3(x))), 2, ceil_mode=True)
+        return F.relu(self.conv4(x))
+
+
 class NetRegression1(nn.Module):
     '''NetRegression1 is designed for regression
        the output of the fully connected layer is (2,) array
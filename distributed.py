@@ -0,0 +1,189 @@
+'''
+Distributed data parallel training on CPU clusters, gloo backend
+'''
+
+import argparse
+import os
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Sampler
+
+
+class ShardedBatchSampler(Sampler):
+    '''Every rank draws the same global batches (the wrapped batch sampler is seeded by (seed, epoch)), and keeps its
+       slice of each batch. So a stratified or curriculum batch sampler is sharded without any communication
+    '''
+    def __init__(self, batch_sampler: Sampler, rank: int, world_size: int):
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.world_size = world_size
+
+    def set_epoch(self, epoch: int):
+        self.batch_sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        for batch in self.batch_sampler:
+            yield batch[self.rank::self.world_size]
+
+
+class Distributed:
+    '''Launch the training on nproc_per_node processes of each node. One process per rank, each with
+       num_threads = cores // nproc_per_node intra-op threads, the gradients are all reduced in buckets of bucket_cap_mb
+    '''
+    @staticmethod
+    def setup(rank: int, world_size: int, master_addr: str = None, master_port: int = None, num_threads: int = None):
+        '''an explicit master_addr / master_port overrides the environment, otherwise MASTER_ADDR and MASTER_PORT
+           of the environment (eg. set by torchrun) are kept, by default 127.0.0.1:29500
+        '''
+        for key, value, default in [('MASTER_ADDR', master_addr, '127.0.0.1'), ('MASTER_PORT', master_port, 29500)]:
+            if value is not None:
+                os.environ[key] = str(value)
+            else:
+                os.environ.setdefault(key, str(default))
+        dist.init_process_group('gloo', rank=rank, world_size=world_size)
+        torch.set_num_threads(num_threads if num_threads else max(os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', world_size)), 1))
+        torch.manual_seed(0)       # the same initial weights on all ranks, DDP also broadcasts them from rank 0
+
+    @staticmethod
+    def cleanup():
+        dist.destroy_process_group()
+
+    @staticmethod
+    def wrap(model: nn.Module, bucket_cap_mb: float = 25):
+        return DistributedDataParallel(model, bucket_cap_mb=bucket_cap_mb)
+
+    @staticmethod
+    def launch(fn, nproc_per_node: int, nnodes: int = 1, node_rank: int = 0, master_addr: str = None, master_port: int = None, *args):
+        '''fn(rank, world_size, *args) on every local process. Under torchrun (RANK and WORLD_SIZE in the environment)
+           this process is already one rank, otherwise nproc_per_node processes are spawned
+        '''
+        if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+            rank, world_size = int(os.environ['RANK']), int(os.environ['WORLD_SIZE'])
+            Distributed.setup(rank, world_size, master_addr, master_port)
+            try:
+                fn(rank, world_size, *args)
+            finally:
+                Distributed.cleanup()
+            return
+        os.environ['LOCAL_WORLD_SIZE'] = str(nproc_per_node)
+        mp.spawn(Distributed.worker, args=(fn, nproc_per_node, nnodes, node_rank, master_addr, master_port, args), nprocs=nproc_per_node)
+
+    @staticmethod
+    def worker(local_rank: int, fn, nproc_per_node: int, nnodes: int, node_rank: int, master_addr: str, master_port: int, args: tuple):
+        rank, world_size = node_rank * nproc_per_node + local_rank, nnodes * nproc_per_node
+        Distributed.setup(rank, world_size, master_addr, master_port)
+        try:
+            fn(rank, world_size, *args)
+        finally:
+            Distributed.cleanup()
+
+
+def train(rank: int, world_size: int, args):
+    '''the train_test of train.py, with both models in DistributedDataParallel
+    '''
+    from train import train_test
+    from deepleaning_models import NetTranslation4, NetNumTx
+    from augmentation import SensorAugment
+    from sampler import Uniform, Curriculum
+
+    model1 = Distributed.wrap(NetTranslation4(), args.bucket_cap_mb[0])
+    model2 = Distributed.wrap(NetNumTx(args.max_ntx[0]), args.bucket_cap_mb[0])
+    augment = SensorAugment() if args.augment else None
+    schedule = {'shuffle': None, 'uniform': Uniform(), 'curriculum': Curriculum(args.warmup[0])}[args.sampler[0]]
+    train_test(args.train[0], args.test[0], args.num_epochs[0], model1, model2, augment, args.batch_size[0], args.num_workers[0],
+               torch.device('cpu'), schedule=schedule, rank=rank, world_size=world_size)
+    if rank == 0 and args.output[0] is not None:
+        torch.save(model1.module.state_dict(), f'{args.output[0]}-1.pt')
+        torch.save(model2.module.state_dict(), f'{args.output[0]}-2.pt')
+
+
+def scaling(rank: int, world_size: int, args, queue):
+    '''NetTranslation4 training steps per second with world_size ranks, batch_size samples per rank (weak scaling)
+    '''
+    from torch.utils.data import DataLoader
+    from torch.utils.data.distributed import DistributedSampler
+    from deepleaning_models import NetTranslation4
+    from dataset import open_dataset, tf, my_collate
+
+    dataset = open_dataset(os.path.join('.', 'data', args.train[0]), tf)
+    sampler = DistributedSampler(dataset, world_size, rank, shuffle=True)
+    loader = DataLoader(dataset, batch_size=args.batch_size[0], sampler=sampler, num_workers=args.num_workers[0], collate_fn=my_collate, drop_last=True)
+    model = Distributed.wrap(NetTranslation4(), args.bucket_cap_mb[0])
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    mse_loss = nn.MSELoss()
+    warmup = 3
+    step, start, epoch = 0, None, 0
+    while step < args.steps[0] + warmup:
+        sampler.set_epoch(epoch)
+        for sample in loader:
+            if step == warmup:
+                dist.barrier()
+                start = time.perf_counter()
+            loss = mse_loss(model(sample['matrix']), sample['target'])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            step += 1
+            if step == args.steps[0] + warmup:
+                break
+        epoch += 1
+    dist.barrier()
+    if rank == 0:
+        queue.put(time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+
+    # one node, 4 ranks:
+    #   python distributed.py -tr matrix-train52 -te matrix-test52 -np 4 -ep 10
+    # two nodes, 8 ranks each:
+    #   python distributed.py -tr matrix-train52 -te matrix-test52 -np 8 -nn 2 -nr 0 -ma node0 -ep 10   (on node0)
+    #   python distributed.py -tr matrix-train52 -te matrix-test52 -np 8 -nn 2 -nr 1 -ma node0 -ep 10   (on node1)
+    # or torchrun --nnodes 2 --nproc_per_node 8 ... distributed.py -tr matrix-train52 -te matrix-test52
+    # scaling benchmark:
+    #   python distributed.py -tr matrix-train52 -sc -ws 1 2 4 8 -st 50
+
+    parser = argparse.ArgumentParser(description='Distributed data parallel training on CPU')
+    parser.add_argument('-tr', '--train', nargs=1, type=str, default=['matrix-train51'], help='the training dataset in data/')
+    parser.add_argument('-te', '--test', nargs=1, type=str, default=['matrix-test51'], help='the testing dataset in data/')
+    parser.add_argument('-ep', '--num_epochs', nargs=1, type=int, default=[10], help='number of epochs')
+    parser.add_argument('-mn', '--max_ntx', nargs=1, type=int, default=[10], help='max_ntx of NetNumTx')
+    parser.add_argument('-bs', '--batch_size', nargs=1, type=int, default=[32], help='the batch size of each rank')
+    parser.add_argument('-nw', '--num_workers', nargs=1, type=int, default=[1], help='number of DataLoader workers of each rank')
+    parser.add_argument('-np', '--nproc_per_node', nargs=1, type=int, default=[2], help='number of ranks on this node')
+    parser.add_argument('-nn', '--nnodes', nargs=1, type=int, default=[1], help='number of nodes')
+    parser.add_argument('-nr', '--node_rank', nargs=1, type=int, default=[0], help='the rank of this node')
+    parser.add_argument('-ma', '--master_addr', nargs=1, type=str, default=[None], help='the address of the node of rank 0, by default $MASTER_ADDR or 127.0.0.1')
+    parser.add_argument('-mp', '--master_port', nargs=1, type=int, default=[None], help='a free port on the node of rank 0, by default $MASTER_PORT or 29500')
+    parser.add_argument('-bc', '--bucket_cap_mb', nargs=1, type=float, default=[25], help='the size of the gradient buckets of DDP')
+    parser.add_argument('-au', '--augment', action='store_true', help='online sensor dropout, jitter, flips and translations')
+    parser.add_argument('-sa', '--sampler', nargs=1, type=str, default=['shuffle'], choices=['shuffle', 'uniform', 'curriculum'])
+    parser.add_argument('-wu', '--warmup', nargs=1, type=int, default=[5], help='epochs of the curriculum until all strata are uniform')
+    parser.add_argument('-o', '--output', nargs=1, type=str, default=[None], help='save the state dicts as {output}-1.pt and {output}-2.pt')
+    parser.add_argument('-sc', '--scaling', action='store_true', help='the scaling benchmark of NetTranslation4 training')
+    parser.add_argument('-ws', '--world_sizes', nargs='+', type=int, default=[1, 2, 4], help='the world sizes of the scaling benchmark')
+    parser.add_argument('-st', '--steps', nargs=1, type=int, default=[50], help='timed steps of the scaling benchmark')
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.scaling:
+        print(f'{os.cpu_count()} cores, {args.batch_size[0]} samples per rank per step')
+        base = None
+        for world_size in args.world_sizes:
+            queue = mp.get_context('spawn').SimpleQueue()
+            Distributed.launch(scaling, world_size, 1, 0, args.master_addr[0], args.master_port[0], args, queue)
+            elapsed = queue.get()
+            throughput = args.steps[0] * args.batch_size[0] * world_size / elapsed
+            base = throughput if base is None else base
+            print(f'world size = {world_size:<3} {throughput:8.1f} samples/s, speedup = {throughput / base:.2f}, '
+                  f'efficiency = {throughput / base / world_size * args.world_sizes[0]:.2f}')
+    else:
+        Distributed.launch(train, args.nproc_per_node[0], args.nnodes[0], args.node_rank[0], args.master_addr[0], args.master_port[0], args)
+    print('time = {}'.format(time.time() - start))
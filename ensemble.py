@@ -0,0 +1,169 @@
+'''
+Two CNNs in parallel: the image translation model and the # of TX model run together on the same input,
+the predicted # of TX goes directly into the batched peak detection
+'''
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.nn as nn
+from utility import Utility
+
+
+class FusedLocalizer:
+    '''Fused inference of model1 (eg. NetTranslation4) and model2 (eg. NetNumTx, NetNumTxPool).
+       The input batch is moved to the device once and shared by both models.
+       On GPU the two models are launched on two CUDA streams, on CPU they are submitted to a thread pool
+       (the torch operators release the GIL, so the two forward passes overlap)
+    '''
+    def __init__(self, model1: nn.Module, model2: nn.Module, device=None, threshold: float = 0.05, profile=None, preprocess=None):
+        '''
+        Args:
+            model1    -- nn.Module -- image translation model, output (N, 1, H, W)
+            model2    -- nn.Module -- # of TX model, output (N, max_ntx) classes or (N, 1) regression
+            device    -- torch.device -- by default cuda if available, otherwise cpu
+            threshold -- float     -- threshold for non-tx areas in the peak detection
+            profile   -- PeakProfile -- the tuned peak detection of tuning.py, overrides threshold
+            preprocess -- Preprocess -- the normalization of the raw input on the device, None if X is already normalized
+        '''
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
+        self.model1 = model1.to(device).eval()
+        self.model2 = model2.to(device).eval()
+        self.threshold = threshold
+        self.profile = profile
+        self.preprocess = preprocess
+        self.count_head = FusedLocalizer.is_count_head(model2)
+        self.pool = None
+        if device.type == 'cuda':
+            self.streams = (torch.cuda.Stream(device), torch.cuda.Stream(device))
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=2)
+
+    def close(self):
+        '''release the threads of the CPU pool
+        '''
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def forward(self, X: torch.Tensor):
+        '''run both models concurrently
+        Args:
+            X -- torch.Tensor -- (N, 1, H, W), already normalized, or the raw batch when there is a preprocess
+        Return:
+            torch.Tensor, torch.Tensor -- the output of model1 and the predicted # of TX (N,)
+        '''
+        X = X.to(self.device, non_blocking=True)
+        if self.preprocess is not None:
+            X = self.preprocess(X)
+        with torch.no_grad():
+            if self.device.type == 'cuda':
+                current = torch.cuda.current_stream(self.device)
+                for stream in self.streams:
+                    stream.wait_stream(current)
+                with torch.cuda.stream(self.streams[0]):
+                    pred_matrix = self.model1(X)
+                with torch.cuda.stream(self.streams[1]):
+                    pred_ntx = self.model2(X)
+                for stream in self.streams:
+                    current.wait_stream(stream)
+            else:
+                future = self.pool.submit(self.model2, X)
+                pred_matrix = self.model1(X)
+                pred_ntx = future.result()
+        return pred_matrix, FusedLocalizer.num_tx(pred_ntx, self.count_head)
+
+    @staticmethod
+    def is_count_head(model2: nn.Module):
+        '''True if the # of TX model outputs a count (NetNumTxPool), False if it outputs classes (NetNumTx).
+           Decided by the model type, a NetNumTx with max_ntx = 1 also has one output
+        '''
+        from deepleaning_models import NetNumTxPool
+
+        return isinstance(getattr(model2, 'module', model2), NetNumTxPool)     # module: in DistributedDataParallel
+
+    @staticmethod
+    def num_tx(pred_ntx: torch.Tensor, count_head: bool = False):
+        '''turn the output of the # of TX model into integers
+        Args:
+            pred_ntx   -- torch.Tensor -- (N, max_ntx) classes, class 0 means 1 TX; or (N, 1) count
+            count_head -- bool         -- pred_ntx is a count, see is_count_head
+        Return:
+            torch.Tensor -- (N,), at least 1
+        '''
+        if count_head:
+            return torch.clamp(torch.round(pred_ntx[:, 0]), min=1).long()
+        return pred_ntx.argmax(1) + 1
+
+    @staticmethod
+    def float_target(pred_matrix: np.ndarray, pred_peaks: list):
+        '''refine the peaks into continuous locations, the weighted center of the peak and its four neighbors
+        Args:
+            pred_matrix -- np.ndarray       -- (H, W)
+            pred_peaks  -- list<(int, int)> -- the peaks
+        Return:
+            list<(float, float)>
+        '''
+        height, width = pred_matrix.shape
+        new_pred_peaks = []
+        for pred_x, pred_y in pred_peaks:
+            sum_weight = 0
+            neighbor = []
+            for d in [(0, 0), (-1, 0), (0, 1), (1, 0), (0, -1)]:
+                nxt = (pred_x + d[0], pred_y + d[1])
+                if 0 <= nxt[0] < height and 0 <= nxt[1] < width:
+                    neighbor.append(((nxt[0] + 0.5, nxt[1] + 0.5), pred_matrix[nxt[0]][nxt[1]]))
+                    sum_weight += pred_matrix[nxt[0]][nxt[1]]
+            pred_x, pred_y = 0, 0
+            for loc, w in neighbor:
+                pred_x += loc[0] / sum_weight * w
+                pred_y += loc[1] / sum_weight * w
+            new_pred_peaks.append((pred_x, pred_y))
+        return new_pred_peaks
+
+    def localize(self, X: torch.Tensor, refine: bool = True):
+        '''the full localization of a batch in one call
+        Args:
+            X      -- torch.Tensor -- (N, 1, H, W), already normalized
+            refine -- bool         -- continuous locations by float_target
+        Return:
+            list<list<tuple>>, np.ndarray -- the locations of each sample, the predicted # of TX
+        '''
+        pred_matrix, pred_ntx = self.forward(X)
+        pred_matrix = pred_matrix[:, 0].data.cpu().numpy()
+        pred_ntx = pred_ntx.cpu().numpy()
+        peaks, _ = Utility.detect_peak_batch(pred_matrix, pred_ntx, self.threshold, self.profile)
+        if refine:
+            peaks = [FusedLocalizer.float_target(pred, p) for pred, p in zip(pred_matrix, peaks)]
+        return peaks, pred_ntx
+
+
+if __name__ == '__main__':
+
+    # python ensemble.py -m1 model/model1-11.10.pt -m2 model/model2-11.10.pt
+
+    from export import Export
+
+    parser = argparse.ArgumentParser(description='Two CNNs in parallel')
+    parser.add_argument('-m1', '--model1', nargs=1, type=str, default=['model/model1-11.10.pt'], help='state dict of NetTranslation4')
+    parser.add_argument('-m2', '--model2', nargs=1, type=str, default=['model/model2-11.10.pt'], help='state dict of NetNumTx')
+    parser.add_argument('-mn', '--max_ntx', nargs=1, type=int, default=[10], help='max_ntx of NetNumTx')
+    parser.add_argument('-bs', '--batch_size', nargs=1, type=int, default=[32], help='the batch size')
+    args = parser.parse_args()
+
+    model1 = Export.load('NetTranslation4', args.model1[0])
+    model2 = Export.load('NetNumTx', args.model2[0], max_ntx=args.max_ntx[0])
+    X = Export.calibration_data(num=args.batch_size[0])
+    with FusedLocalizer(model1, model2) as fused:
+        peaks, ntx = fused.localize(X)
+    for p, n in zip(peaks[:5], ntx[:5]):
+        print(n, [(round(float(x), 2), round(float(y), 2)) for x, y in p])
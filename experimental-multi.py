@@ -208,7 +208,7 @@ def train_test(train, test, num_epoch, net):
 
     print(net)
 
-    device     = torch.device('cuda')
+    device     = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model      = net.to(device)
     optimizer  = optim.Adam(model.parameters(), lr=0.001)
     criterion  = nn.MSELoss()  # criterion is the loss function
@@ -0,0 +1,245 @@
+'''
+Export the trained models for CPU inference: TorchScript/ONNX, int8 quantization, channels last
+'''
+
+import argparse
+import glob
+import os
+import tempfile
+import numpy as np
+import torch
+import torch.nn as nn
+import deepleaning_models
+from input_output import Default
+from node import SensorArray
+
+
+class Export:
+    '''export pipeline of the models in deepleaning_models.py
+    '''
+    @staticmethod
+    def load(name: str, checkpoint: str = None, **kwargs):
+        '''build a model by its class name and load a state dict on the CPU
+        Args:
+            name       -- str -- eg. NetTranslation4, NetNumTx
+            checkpoint -- str -- a state dict saved by torch.save(model.state_dict()), could be saved on a GPU
+            kwargs     -- the arguments of the model, eg. max_ntx=10 for NetNumTx
+        Return:
+            nn.Module -- in eval mode, on the CPU
+        '''
+        model = getattr(deepleaning_models, name)(**kwargs)
+        if checkpoint is not None:
+            model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+        return model.eval()
+
+    @staticmethod
+    def calibration_data(root_dir: str = None, num: int = 64, sensor_file: str = 'data/sensors/100-500'):
+        '''the inputs used by the static quantization to observe the activation ranges
+        Args:
+            root_dir    -- str -- a dataset generated by generate.py, if None then synthetic samples are made
+                                  from the propagation model, with 1 to 3 TX and the sensors in sensor_file
+            num         -- int -- number of samples
+            sensor_file -- str -- sensor location file for the synthetic samples
+        Return:
+            torch.Tensor -- (num, 1, grid_length, grid_length), uniform normalized like the training data
+        '''
+        if root_dir is None:
+            rng = np.random.RandomState(Default.random_seed)
+            sensors = SensorArray.load(sensor_file)
+            matrix = np.full((num, Default.grid_length, Default.grid_length), Default.noise_floor, dtype=np.float32)
+            for i in range(num):
+                txs = rng.uniform(0, Default.grid_length, (rng.randint(1, 4), 2))
+                dist = sensors.distance(txs) * Default.cell_length
+                pathloss = 10 * Default.alpha * np.log10(np.maximum(dist, 1)) + rng.normal(0, Default.std, dist.shape)
+                linear = np.power(10, (Default.power - np.abs(pathloss)) / 10).sum(axis=0)
+                matrix[i, sensors.x, sensors.y] = np.maximum(10 * np.log10(linear), Default.noise_floor)
+        else:
+            from dataset import UniformNormalize
+            files = sorted(glob.glob(os.path.join(root_dir, '*', '0.npy')))[:num]
+            matrix = np.stack([UniformNormalize.dequantize(np.load(f)) for f in files])
+        matrix -= Default.noise_floor
+        matrix /= (-Default.noise_floor/2)
+        return torch.as_tensor(matrix).unsqueeze(1)
+
+    @staticmethod
+    def quantize_dynamic(model: nn.Module):
+        '''int8 dynamic quantization, only the fully connected layers are quantized (eg. NetNumTx)
+        '''
+        from torch.ao.quantization import quantize_dynamic
+        if not any(isinstance(m, nn.Linear) for m in model.modules()):
+            raise ValueError(f'{type(model).__name__} has no fully connected layer, dynamic quantization would not change it, '
+                             'use static quantization')
+        return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    @staticmethod
+    def quantize_static(model: nn.Module, calibration: torch.Tensor, backend: str = 'x86'):
+        '''int8 static quantization (FX graph mode), both convolution and fully connected layers are quantized
+        Args:
+            model       -- nn.Module    -- in eval mode
+            calibration -- torch.Tensor -- (N, 1, H, W) inputs to observe the activation ranges
+            backend     -- str          -- x86 or qnnpack (ARM)
+        '''
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        torch.backends.quantized.engine = backend
+        prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (calibration[:1],))
+        with torch.no_grad():
+            for i in range(0, len(calibration), 32):
+                prepared(calibration[i:i+32])
+        return convert_fx(prepared)
+
+    @staticmethod
+    def channels_last(model: nn.Module):
+        '''the activations with 8 and 32 channels are faster in NHWC layout on the CPU
+        '''
+        return model.to(memory_format=torch.channels_last)
+
+    @staticmethod
+    def torchscript(model: nn.Module, example: torch.Tensor, method: str = 'trace'):
+        '''
+        Args:
+            model   -- nn.Module
+            example -- torch.Tensor -- an example input for tracing
+            method  -- str          -- trace or script
+        Return:
+            torch.jit.ScriptModule -- frozen
+        '''
+        with torch.no_grad():
+            if method == 'script':
+                scripted = torch.jit.script(model)
+            else:
+                scripted = torch.jit.trace(model, example)
+        return torch.jit.freeze(scripted.eval())
+
+    @staticmethod
+    def onnx(model: nn.Module, example: torch.Tensor, filename: str):
+        '''export to ONNX, the batch and the grid size are dynamic axes. needs the onnx package
+        '''
+        torch.onnx.export(model, example, filename, input_names=['matrix'], output_names=['output'],
+                          dynamic_axes={'matrix': {0: 'batch', 2: 'height', 3: 'width'}, 'output': {0: 'batch'}})
+
+    @staticmethod
+    def onnx_runner(filename: str):
+        '''the written ONNX file in an onnxruntime session, as a callable on torch tensors. needs the onnxruntime package
+        '''
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(filename, providers=['CPUExecutionProvider'])
+        return lambda X: torch.from_numpy(session.run(None, {'matrix': X.contiguous().numpy()})[0])
+
+    @staticmethod
+    def parity(reference: nn.Module, exported, example: torch.Tensor):
+        '''numerical parity between the eager model and the exported model
+        Return:
+            (float, float) -- max absolute difference, and the max absolute difference divided by the output range
+        '''
+        with torch.no_grad():
+            ref = reference(example)
+            out = exported(example.contiguous(memory_format=torch.channels_last))
+        diff = (ref - out).abs().max().item()
+        scale = (ref.max() - ref.min()).item()
+        return diff, diff / scale if scale > 0 else diff
+
+    @staticmethod
+    def export(name: str, checkpoint: str, output: str, quantize: str = None, channels_last: bool = False,
+               method: str = 'trace', root_dir: str = None, tolerance: float = None, **kwargs):
+        '''the whole pipeline: load -> (quantize) -> (channels last) -> TorchScript/ONNX -> parity check
+        Args:
+            name          -- str   -- the class name of the model
+            checkpoint    -- str   -- the state dict
+            output        -- str   -- the output file, .pt for TorchScript, .onnx for ONNX. Only replaced if the parity check passes
+            quantize      -- str   -- None, dynamic or static
+            channels_last -- bool  -- NHWC layout
+            method        -- str   -- trace or script
+            root_dir      -- str   -- dataset for the static quantization calibration and the parity check
+            tolerance     -- float -- max relative difference allowed, by default 1e-4 for float and 0.02 for int8.
+                                      The static int8 NetTranslation4 is about 0.10 off, it needs an explicit tolerance
+        Return:
+            (float, float) -- the parity of the written file
+        '''
+        reference = Export.load(name, checkpoint, **kwargs)
+        model = Export.load(name, checkpoint, **kwargs)
+        example = Export.calibration_data(root_dir)
+        if quantize == 'dynamic':
+            model = Export.quantize_dynamic(model)
+        elif quantize == 'static':
+            model = Export.quantize_static(model, example)
+        if channels_last:
+            model = Export.channels_last(model)
+        extension = os.path.splitext(output)[1]
+        fd, tmp = tempfile.mkstemp(suffix=extension, dir=os.path.dirname(os.path.abspath(output)))   # replaces output after the parity check
+        os.close(fd)
+        try:
+            if extension == '.onnx':
+                Export.onnx(model, example[:1], tmp)
+                exported = Export.onnx_runner(tmp)
+            else:
+                exported = Export.torchscript(model, example[:1], method)
+                torch.jit.save(exported, tmp, _extra_files={'layout': 'channels_last' if channels_last else 'contiguous'})
+            diff, relative = Export.parity(reference, exported, example)
+            if tolerance is None:
+                tolerance = 1e-4 if quantize is None else 0.02
+            print(f'{name} -> {output}: max abs diff = {diff:.6f}, relative = {relative:.6f}, tolerance = {tolerance}')
+            if relative > tolerance:
+                raise RuntimeError(f'parity check failed, max abs diff {diff:.6f}, relative difference {relative:.6f} > {tolerance}. '
+                                   f'{output} is not written, pass a larger tolerance to accept it')
+            os.replace(tmp, output)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return diff, relative
+
+
+class CpuRunner:
+    '''run an exported TorchScript model on the CPU
+    '''
+    def __init__(self, filename: str, num_threads: int = None, channels_last: bool = None):
+        '''
+        Args:
+            filename      -- str  -- the TorchScript file saved by Export.export
+            num_threads   -- int  -- intra op threads, None uses the torch default
+            channels_last -- bool -- run in NHWC layout, None reads the layout saved by Export.export
+        '''
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        extra = {'layout': ''}
+        self.model = torch.jit.load(filename, map_location='cpu', _extra_files=extra)
+        self.model.eval()
+        self.channels_last = extra['layout'] == b'channels_last' if channels_last is None else channels_last
+
+    def __call__(self, matrix):
+        '''
+        Args:
+            matrix -- np.ndarray or torch.Tensor -- (N, H, W) or (N, 1, H, W), already normalized
+        Return:
+            np.ndarray
+        '''
+        X = torch.as_tensor(matrix, dtype=torch.float32)
+        if X.dim() == 3:
+            X = X.unsqueeze(1)
+        if self.channels_last:
+            X = X.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            return self.model(X).numpy()
+
+
+if __name__ == '__main__':
+
+    # python export.py -n NetTranslation4 -c model/model1-11.10.pt -o model/model1-11.10.int8.pt -q static -cl -to 0.12
+    # python export.py -n NetNumTx -c model/model2-11.10.pt -o model/model2-11.10.int8.pt -q dynamic -mn 10
+
+    parser = argparse.ArgumentParser(description='Export a model for CPU inference')
+    parser.add_argument('-n', '--name', nargs=1, type=str, default=['NetTranslation4'], help='the class name of the model')
+    parser.add_argument('-c', '--checkpoint', nargs=1, type=str, default=[None], help='the state dict')
+    parser.add_argument('-o', '--output', nargs=1, type=str, required=True, help='.pt for TorchScript, .onnx for ONNX')
+    parser.add_argument('-q', '--quantize', nargs=1, type=str, default=[None], choices=['dynamic', 'static'], help='int8 quantization')
+    parser.add_argument('-cl', '--channels_last', action='store_true', help='NHWC memory layout')
+    parser.add_argument('-me', '--method', nargs=1, type=str, default=['trace'], choices=['trace', 'script'])
+    parser.add_argument('-rd', '--root_dir', nargs=1, type=str, default=[None], help='dataset for calibration and parity')
+    parser.add_argument('-to', '--tolerance', nargs=1, type=float, default=[None], help='max relative difference of the parity check')
+    parser.add_argument('-mn', '--max_ntx', nargs=1, type=int, default=[None], help='max_ntx of NetNumTx')
+    args = parser.parse_args()
+
+    kwargs = {} if args.max_ntx[0] is None else {'max_ntx': args.max_ntx[0]}
+    Export.export(args.name[0], args.checkpoint[0], args.output[0], args.quantize[0], args.channels_last,
+                  args.method[0], args.root_dir[0], args.tolerance[0], **kwargs)
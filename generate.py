@@ -6,13 +6,15 @@ from typing import List
 
 import random
 import numpy as np
-import imageio
 import argparse
+import hashlib
+import json
 import os
-from visualize import Visualize
+import shutil
 from propagation import Propagation
 from input_output import Default
-from node import Sensor
+from node import SensorArray
+from sample_index import SampleIndex
 from utility import Utility
 
 
@@ -20,62 +22,81 @@ class GenerateSensors:
     '''generate sensors
     '''
     @classmethod
-    def random(cls, grid_length: int, sensor_density: int, seed: int, filename: str):
-        '''randomly generate some sensors in a grid
+    def random(cls, grid_length: int, sensor_density: int, seed: int, filename: str, min_dist: float = 2, visualize: bool = False):
+        '''randomly generate some sensors in a grid, no two sensors are closer than min_dist
+        Args:
+            grid_length    -- int   -- the length of the grid
+            sensor_density -- int   -- number of sensors
+            seed           -- int   -- random seed
+            filename       -- str   -- the sensor file, a binary copy is saved as filename.npy
+            min_dist       -- float -- the minimum spacing, 2 means no two sensors are side by side (including diagonal)
+            visualize      -- bool  -- save a heatmap of the sensors in visualize/
         '''
-        random.seed(seed)
-        all_sensors = list(range(grid_length * grid_length))
-        subset_sensors = random.sample(all_sensors, sensor_density)
-        Visualize.sensors(subset_sensors, grid_length, 1)
-        subset_sensors = GenerateSensors.relocate_sensors(subset_sensors, grid_length)
-        Visualize.sensors(subset_sensors, grid_length, 2)
-        subset_sensors = GenerateSensors.relocate_sensors(subset_sensors, grid_length)
-        Visualize.sensors(subset_sensors, grid_length, 3)
-        subset_sensors.sort()
-        GenerateSensors.save(subset_sensors, grid_length, filename)
+        subset_sensors = SensorArray.from_index(GenerateSensors.poisson_disk(grid_length, sensor_density, seed, min_dist), grid_length)
+        if visualize:
+            from visualize import Visualize
+            Visualize.sensors(subset_sensors, grid_length, 1)
+        subset_sensors.save(filename)
 
     @classmethod
-    def relocate_sensors(cls, random_sensors: List, grid_len: int):
-        '''Relocate sensors that are side by side
+    def poisson_disk(cls, grid_length: int, sensor_density: int, seed: int, min_dist: float = 2):
+        '''Poisson disk sampling on the grid, vectorized by rounds of dart throwing:
+           in each round, random candidates are drawn from the available cells, a candidate is accepted if it has the
+           highest priority among the candidates within min_dist (a maximum filter), then the cells within min_dist of the
+           accepted sensors are masked out (a dilation). The highest priority candidate is always accepted, so every round progresses
+        Args:
+            grid_length    -- int   -- the length of the grid
+            sensor_density -- int   -- number of sensors
+            seed           -- int   -- random seed
+            min_dist       -- float -- any two sensors are at least min_dist apart (euclidean, in cells)
+        Return:
+            np.ndarray -- the sorted flat indices (x * grid_length + y) of the sensors
         '''
-        new_random_sensors = []
-        need_to_relocate = []
-        ocupy_grid = np.zeros((grid_len, grid_len), dtype=int)
-        random_sensors.sort()
-        for sen in random_sensors:
-            s_x = sen // grid_len
-            s_y = sen % grid_len
-            if ocupy_grid[s_x][s_y] == 1:
-                need_to_relocate.append(sen)
-            else:
-                new_random_sensors.append(sen)
-                for x, y in [(0, 0), (-1, 0), (0, -1), (0, 1), (1, 0), (1, 1), (1, -1), (-1, -1), (-1, 1)]:
-                    try:
-                        ocupy_grid[s_x + x][s_y + y] = 1
-                    except:
-                        pass
-        available = []
-        for x in range(grid_len):
-            for y in range(grid_len):
-                if ocupy_grid[x][y] == 0:
-                    available.append(x*grid_len + y)
-
-        relocated = random.sample(available, len(need_to_relocate))
-        new_random_sensors.extend(relocated)
-        return new_random_sensors
+        from scipy.ndimage import maximum_filter, binary_dilation
+
+        rng = np.random.RandomState(seed)
+        radius = int(np.ceil(min_dist)) - 1
+        offset = np.arange(-radius, radius + 1)
+        footprint = offset[:, None] ** 2 + offset[None, :] ** 2 < min_dist ** 2
+        available = np.ones((grid_length, grid_length), dtype=bool)
+        sensors = np.zeros((grid_length, grid_length), dtype=bool)
+        num = 0
+        while num < sensor_density:
+            free = np.flatnonzero(available)
+            if len(free) == 0:
+                raise ValueError(f'cannot place {sensor_density} sensors with min distance {min_dist} in a {grid_length} x {grid_length} grid, placed {num}')
+            k = min(len(free), sensor_density - num)
+            priority = np.zeros((grid_length, grid_length))
+            priority.flat[rng.choice(free, k, replace=False)] = rng.permutation(k) + 1
+            accepted = (priority > 0) & (maximum_filter(priority, footprint=footprint, mode='constant') == priority)
+            sensors |= accepted
+            num += accepted.sum()
+            available &= ~binary_dilation(accepted, structure=footprint)
+        return np.flatnonzero(sensors)
 
     @classmethod
     def save(cls, sensors: List[int], grid_length: int, filename: str):
-        with open(filename, 'w') as f:
-            for sensor in sensors:
-                x = sensor // grid_length
-                y = sensor % grid_length
-                f.write(f'{x} {y}\n')
+        '''save the sensors (flat indices) as text (one "x y" per line), and as binary in filename.npy
+        '''
+        SensorArray.from_index(sensors, grid_length).save(filename)
+
+    @classmethod
+    def load(cls, filename: str, grid_length: int = None):
+        '''read a sensor file, through the binary cache of SensorArray.load
+        Return:
+            SensorArray -- np.asarray of it is n = 2, one (x, y) per row
+        '''
+        return SensorArray.load(filename, grid_length)
 
 
 class GenerateData:
     '''generate training data using a propagation model
     '''
+    version = 3        # of the generated data, bump it when the same parameters generate different data
+    compatible = ['seed', 'alpha', 'std', 'grid length', 'cell length', 'sensor density', 'noise floor', 'power', 'sensor file',
+                  'number of TX', 'num TX upperbound', 'min distance', 'max distance', 'storage dtype', 'data version']
+                       # the log entries that an append should not change
+
     def __init__(self, seed: int, alpha: float, std: float, grid_length: int, cell_length: int, sensor_density: int, noise_floor: int):
         self.seed = seed
         self.alpha = alpha
@@ -86,28 +107,102 @@ class GenerateData:
         self.noise_floor = noise_floor
         self.propagation = Propagation(self.alpha, self.std)
 
-    def log(self, power, cell_percentage, sample_per_label, sensor_file, root_dir, num_tx, num_tx_upper, min_dist, max_dist):
+    def log(self, power, cell_percentage, sample_per_label, sensor_file, root_dir, num_tx, num_tx_upper, min_dist, max_dist, dtype='float32',
+            content_hash=None):
         '''the meta data of the data
         '''
         with open(root_dir + '.txt', 'w') as f:
-            f.write(f'seed              = {self.seed}\n')
-            f.write(f'alpha             = {self.alpha}\n')
-            f.write(f'std               = {self.std}\n')
-            f.write(f'grid length       = {self.grid_length}\n')
-            f.write(f'cell length       = {self.cell_length}\n')
-            f.write(f'sensor density    = {self.sensor_density}\n')
-            f.write(f'noise floor       = {self.noise_floor}\n')
-            f.write(f'power             = {power}\n')
-            f.write(f'cell percentage   = {cell_percentage}\n')
-            f.write(f'sample per label  = {sample_per_label}\n')
-            f.write(f'sensor file       = {sensor_file}\n')
-            f.write(f'root file         = {root_dir}\n')
-            f.write(f'number of TX      = {num_tx}\n')
-            f.write(f'num TX upperbound = {num_tx_upper}\n')
-            f.write(f'min distance      = {min_dist}\n')
-            f.write(f'max distance      = {max_dist}\n')
-
-    def generate(self, power: float, cell_percentage: float, sample_per_label: int, sensor_file: str, root_dir: str, num_tx: int, num_tx_upper: bool, min_dist: int, max_dist: int):
+            for key, value in self.log_entries(power, cell_percentage, sample_per_label, sensor_file, root_dir, num_tx, num_tx_upper,
+                                               min_dist, max_dist, dtype).items():
+                f.write(f'{key:<17} = {value}\n')
+            if content_hash is not None:
+                f.write(f'content hash      = {content_hash}\n')
+
+    def log_entries(self, power, cell_percentage, sample_per_label, sensor_file, root_dir, num_tx, num_tx_upper, min_dist, max_dist, dtype='float32'):
+        '''the entries of the log, as read_log reads them back
+        '''
+        return {'seed': self.seed, 'alpha': self.alpha, 'std': self.std, 'grid length': self.grid_length, 'cell length': self.cell_length,
+                'sensor density': self.sensor_density, 'noise floor': self.noise_floor, 'power': power, 'cell percentage': cell_percentage,
+                'sample per label': sample_per_label, 'sensor file': sensor_file, 'root file': root_dir, 'number of TX': num_tx,
+                'num TX upperbound': num_tx_upper, 'min distance': min_dist, 'max distance': max_dist, 'storage dtype': dtype,
+                'data version': GenerateData.version}
+
+    def check_append(self, root_dir: str, entries: dict):
+        '''refuse to append samples generated with other parameters (or by another version) to the dataset of root_dir
+        '''
+        def same(logged, value):                # 1 and 1.0 are the same std
+            try:
+                return float(logged) == float(value)
+            except (TypeError, ValueError):
+                return logged == str(value)
+
+        log = GenerateData.read_log(root_dir)
+        mismatch = [f'{key}: {log.get(key)} != {entries[key]}' for key in GenerateData.compatible if not same(log.get(key), entries[key])]
+        if mismatch:
+            raise ValueError(f'cannot append to {root_dir}, it is generated with other parameters: ' + ', '.join(mismatch))
+
+    @staticmethod
+    def quantize(grid: np.ndarray, dtype: str = 'float32'):
+        '''the storage of a matrix of RSSI (dB)
+        Args:
+            grid  -- np.ndarray -- the RSSI in dB, in [noise floor, power]
+            dtype -- str        -- float32, float16, or int16 (fixed point, Default.db_scale dB per unit)
+        Return:
+            np.ndarray
+        '''
+        if dtype == 'int16':
+            return np.clip(np.round(grid / Default.db_scale), -32768, 32767).astype(np.int16)
+        return grid.astype(dtype)
+
+    def content_hash(self, sensor_file: str, **params):
+        '''the hash of everything that determines the generated data: the parameters of this object and of the call,
+           and the sensor layout (its coordinates, so the text file and its .npy cache hash the same)
+        '''
+        params.update(seed=self.seed, alpha=self.alpha, std=self.std, grid_length=self.grid_length, cell_length=self.cell_length,
+                      sensor_density=self.sensor_density, noise_floor=self.noise_floor, version=GenerateData.version)
+        sha = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode())
+        sensors = GenerateSensors.load(sensor_file, self.grid_length)
+        sha.update(np.ascontiguousarray(sensors.coordinates, dtype=np.int64).tobytes())
+        return sha.hexdigest()[:16]
+
+    @staticmethod
+    def link(stored: str, root_dir: str):
+        '''make root_dir and its index relative symbolic links to a dataset of the store, replacing what was there
+        '''
+        root_dir = os.path.normpath(root_dir)
+        for src, dst in [(stored, root_dir), (SampleIndex.filename(stored), SampleIndex.filename(root_dir))]:
+            if os.path.islink(dst) or os.path.isfile(dst):
+                os.remove(dst)
+            elif os.path.isdir(dst):
+                shutil.rmtree(dst)
+            try:
+                os.symlink(os.path.relpath(src, os.path.dirname(dst) or '.'), dst)
+            except OSError:                     # no symbolic links on this file system
+                shutil.copytree(src, dst) if os.path.isdir(src) else shutil.copyfile(src, dst)
+
+    def content_addressed(self, store_dir: str, root_dir: str, sensor_file: str, params: dict, create):
+        '''reuse the dataset of the store with the same content hash, otherwise create it in the store.
+           A dataset of the store is complete once its index is saved (the last step of the generation)
+        Args:
+            store_dir -- str      -- the content addressed store, eg. data/store
+            root_dir  -- str      -- the requested name, linked to the dataset of the store
+            params    -- dict     -- the parameters of the call
+            create    -- callable -- generate into the directory given as argument
+        Return:
+            str -- the content hash
+        '''
+        key = self.content_hash(sensor_file, **params)
+        stored = os.path.join(store_dir, key)
+        if os.path.exists(SampleIndex.filename(stored)):
+            print(f'{root_dir}: the same data is in {stored}, reuse it')
+        else:
+            os.makedirs(store_dir, exist_ok=True)
+            create(stored)
+        GenerateData.link(stored, root_dir)
+        return key
+
+    def generate(self, power: float, cell_percentage: float, sample_per_label: int, sensor_file: str, root_dir: str, num_tx: int, num_tx_upper: bool, min_dist: int, max_dist: int,
+                 dtype: str = 'float32', store_dir: str = None, append: bool = False):
         '''
         The generated input data is not images, but instead matrix. Because saving as images will loss some accuracy
         Args:
@@ -116,97 +211,250 @@ class GenerateData:
             sample_per_label -- samples per cell
             sensor_file      -- sensor location file
             root_dir         -- the output directory
+            dtype            -- the storage of the matrices, int16 and float16 halve the size, see quantize
+            store_dir        -- the content addressed store: the data is generated once per parameter set into the store
+                                and root_dir links to it. None removes root_dir and generates into it
+            append           -- extend the dataset of root_dir up to cell_percentage and sample_per_label, see generate_dir
         '''
-        Utility.remove_make(root_dir)
-        self.log(power, cell_percentage, sample_per_label, sensor_file, root_dir, num_tx, num_tx_upper, min_dist, max_dist)
-        random.seed(self.seed)
-        np.random.seed(self.seed)
+        entries = self.log_entries(power, cell_percentage, sample_per_label, sensor_file, root_dir, num_tx, num_tx_upper, min_dist, max_dist, dtype)
+        source = os.path.realpath(root_dir)
+        append = append and os.path.exists(SampleIndex.filename(source))
+        if append:
+            self.check_append(root_dir, entries)
+        if store_dir is None:
+            if os.path.islink(os.path.normpath(root_dir)):   # a link to the store, whose entries are never modified
+                GenerateData.unlink(root_dir)
+                if append:
+                    GenerateData.fork(source, root_dir)
+            return self.generate_dir(power, cell_percentage, sample_per_label, sensor_file, root_dir, num_tx, num_tx_upper, min_dist, max_dist, dtype, append)
+        params = dict(kind='generate', power=power, cell_percentage=cell_percentage, sample_per_label=sample_per_label, num_tx=num_tx,
+                      num_tx_upper=num_tx_upper, min_dist=min_dist, max_dist=max_dist, dtype=dtype)
+        if append:
+            params['append_to'] = GenerateData.read_log(root_dir).get('content hash', source)    # the store entries are never modified
+
+        def create(stored):
+            if 'append_to' in params:
+                GenerateData.fork(source, stored)
+            self.generate_dir(power, cell_percentage, sample_per_label, sensor_file, stored, num_tx, num_tx_upper, min_dist, max_dist, dtype, append)
+
+        key = self.content_addressed(store_dir, root_dir, sensor_file, params, create)
+        self.log(power, cell_percentage, sample_per_label, sensor_file, os.path.normpath(root_dir), num_tx, num_tx_upper, min_dist, max_dist, dtype, key)
+
+    @staticmethod
+    def read_log(root_dir: str):
+        '''the key values of {root_dir}.txt, empty if there is no log
+        '''
+        filename = os.path.normpath(root_dir) + '.txt'
+        if not os.path.exists(filename):
+            return {}
+        with open(filename) as f:
+            return dict((k.strip(), v.strip()) for k, v in (line.split('=', 1) for line in f if '=' in line))
+
+    @staticmethod
+    def unlink(root_dir: str):
+        '''remove the links of root_dir and its index to the store, the store entry is kept
+        '''
+        root_dir = os.path.normpath(root_dir)
+        for path in [root_dir, SampleIndex.filename(root_dir)]:
+            if os.path.islink(path):
+                os.remove(path)
+
+    @staticmethod
+    def fork(source: str, stored: str):
+        '''a new dataset that starts as a copy of source: the sample files are hard links (they are never
+           rewritten, appending only adds files), the index and the log are copied
+        '''
+        if os.path.exists(stored):
+            shutil.rmtree(stored)
+        try:
+            shutil.copytree(source, stored, copy_function=os.link)
+        except OSError:                         # another file system
+            shutil.rmtree(stored, ignore_errors=True)
+            shutil.copytree(source, stored)
+        shutil.copyfile(SampleIndex.filename(source), SampleIndex.filename(stored))
+        if os.path.exists(os.path.normpath(source) + '.txt'):
+            shutil.copyfile(os.path.normpath(source) + '.txt', os.path.normpath(stored) + '.txt')
+
+    def labels(self, cell_percentage: float):
+        '''the labels (the cell of the first TX): a prefix of one random permutation of the cells,
+           so a larger cell_percentage keeps the labels of a smaller one and adds new ones
+        '''
+        order = np.random.default_rng([self.seed]).permutation(self.grid_length * self.grid_length)
+        count = int(self.grid_length * self.grid_length * cell_percentage)
+        return [(int(c // self.grid_length), int(c % self.grid_length)) for c in order[:count]]
+
+    def population_mask(self, intruder: tuple, min_dist: int, max_dist: int, mask: np.ndarray):
+        '''remove the cells that cannot be the next TX (closer than min_dist or farther than max_dist) from the mask (grid_length, grid_length)
+        '''
+        x, y = np.meshgrid(np.arange(self.grid_length), np.arange(self.grid_length), indexing='ij')
+        dist = np.sqrt((x - intruder[0]) ** 2 + (y - intruder[1]) ** 2)
+        if max_dist is None:
+            mask &= dist >= min_dist
+        else:
+            mask &= (min_dist <= dist) & (dist <= max_dist)
+        return mask
+
+    def sample(self, sensors: SensorArray, label: tuple, i: int, power: float, num_tx: int, num_tx_upper: bool, min_dist: int, max_dist: int):
+        '''the i-th sample of a label. Every label and every (label, sample) has its own random stream, seeded by
+           (seed, label, i), so a sample does not depend on the order of generation or on the other samples
+        Return:
+            np.ndarray, list<(float, float)> -- the matrix (grid_length, grid_length) in dB and the TX locations
+        '''
+        tx_float = tuple(np.array(label) + np.random.default_rng([self.seed, label[0], label[1], 0]).uniform(0, 1, 2))
+        rng = np.random.default_rng([self.seed, label[0], label[1], 1, i])
+        targets = [tx_float]
+        rssi = power - self.propagation.pathloss_vector(sensors.distance(tx_float) * Default.cell_length, rng)
+        readings = np.maximum(rssi, Default.noise_floor)
+        num_tx_copy = rng.integers(1, num_tx + 1) if num_tx_upper else num_tx
+        mask = np.ones((self.grid_length, self.grid_length), dtype=bool)
+        intru = tx_float
+        while num_tx_copy > 1:   # get one new TX at a time
+            cells = np.flatnonzero(self.population_mask(intru, min_dist, max_dist, mask))
+            if len(cells) == 0:
+                raise ValueError(f'no cell for one more TX with min distance {min_dist} and max distance {max_dist}')
+            cell = cells[rng.integers(len(cells))]
+            ntx = tuple(np.array(divmod(int(cell), self.grid_length)) + rng.uniform(0, 1, 2))   # TX is not at the center of grid cell
+            targets.append(ntx)
+            rssi = power - self.propagation.pathloss_vector(sensors.distance(ntx) * Default.cell_length, rng)
+            readings = GenerateData.add_db(readings, rssi)
+            num_tx_copy -= 1
+            intru = ntx
+        return sensors.scatter(readings, Default.noise_floor, np.float64), targets
+
+    def generate_dir(self, power: float, cell_percentage: float, sample_per_label: int, sensor_file: str, root_dir: str, num_tx: int, num_tx_upper: bool,
+                     min_dist: int, max_dist: int, dtype: str = 'float32', append: bool = False):
+        '''generate into root_dir, see generate
+        Args:
+            append -- bool -- keep the existing samples of root_dir, add the folders of the new labels (a larger cell_percentage)
+                              and the samples up to sample_per_label in every folder. The index is updated, not rebuilt.
+                              The folder of a label is its position in the permutation of labels, so the appended dataset
+                              is the same as generating it at once. The parameters should be the ones of the log of root_dir
+        '''
+        import imageio
+
+        index, counts = SampleIndex(), np.zeros(0, dtype=np.int64)     # the # of samples already in each folder
+        if append and os.path.exists(SampleIndex.filename(root_dir)):
+            self.check_append(root_dir, self.log_entries(power, cell_percentage, sample_per_label, sensor_file, root_dir, num_tx,
+                                                         num_tx_upper, min_dist, max_dist, dtype))
+            index = SampleIndex.load(root_dir)
+            counts = index.sample_per_label()
+        else:
+            Utility.remove_make(root_dir)
+        self.log(power, cell_percentage, sample_per_label, sensor_file, root_dir, num_tx, num_tx_upper, min_dist, max_dist, dtype)
         # 1 read the sensor file, do a checking
         if str(self.grid_length) not in sensor_file[:sensor_file.find('-')]:
             print(f'grid length {self.grid_length} and sensor file {sensor_file} not match')
 
-        sensors = []
-        with open(sensor_file, 'r') as f:
-            indx = 0
-            for line in f:
-                x, y = line.split()
-                sensors.append(Sensor(int(x), int(y), indx))
-                indx += 1
-
-        # 2 start from (0, 0), generate data, might skip some locations
-        label_count = int(self.grid_length * self.grid_length * cell_percentage)
-        population = [(i, j) for j in range(self.grid_length) for i in range(self.grid_length)]
-        labels = random.sample(population, label_count)
-
-        counter = 0
-        for label in sorted(labels):
-            tx = label           # each label create a directory
-            tx_float = (tx[0] + random.uniform(0, 1), tx[1] + random.uniform(0, 1))
-            if counter % 100 == 0:
-                print(f'{counter/len(labels)*100}%')
-            folder = f'{root_dir}/{counter:06d}'
-            os.mkdir(folder)     # update on Aug. 27, change the name of the folder from label to counter index
-            for i in range(sample_per_label):
-                targets = [tx_float]
-                grid = np.zeros((self.grid_length, self.grid_length))
-                grid.fill(Default.noise_floor)
-                for sensor in sensors:
-                    dist = Utility.distance_propagation(tx_float, (sensor.x, sensor.y)) * Default.cell_length
-                    pathloss = self.propagation.pathloss(dist)
-                    rssi = power - pathloss
-                    grid[sensor.x][sensor.y] = rssi if rssi > Default.noise_floor else Default.noise_floor
-                # the other TX
-                population_set = set(population)
-                if num_tx_upper is False:
-                    num_tx_copy = num_tx
-                else:
-                    num_tx_copy = random.randint(1, num_tx)
-                intru = tx
-                while num_tx_copy > 1:   # get one new TX at a time
-                    self.update_population(population_set, intru, Default.grid_length, min_dist, max_dist)
-                    ntx = random.sample(population_set, 1)[0]
-                    ntx = (ntx[0] + random.uniform(0, 1), ntx[1] + random.uniform(0, 1))  # TX is not at the center of grid cell
-                    targets.append(ntx)
-                    for sensor in sensors:
-                        dist = Utility.distance_propagation(ntx, (sensor.x, sensor.y)) * Default.cell_length
-                        pathloss = self.propagation.pathloss(dist)
-                        rssi = power - pathloss
-                        exist_rssi = grid[sensor.x][sensor.y]
-                        grid[sensor.x][sensor.y] = Utility.linear2db(Utility.db2linear(exist_rssi) + Utility.db2linear(rssi))
-                    num_tx_copy -= 1
-                    intru = ntx
-                np.save(f'{folder}/{i}.npy', grid.astype(np.float32))
-                np.save(f'{folder}/{i}.target', np.array(targets).astype(np.float32))
+        sensors = GenerateSensors.load(sensor_file, self.grid_length)
+
+        # 2 the labels in the order of the permutation, the folder of a label is its position
+        labels = self.labels(cell_percentage)
+        added = 0
+        for folder, label in enumerate(labels):
+            if folder % 100 == 0:
+                print(f'{folder/len(labels)*100}%')
+            existing = int(counts[folder]) if folder < len(counts) else 0
+            if not os.path.isdir(f'{root_dir}/{folder:06d}'):
+                os.mkdir(f'{root_dir}/{folder:06d}')     # update on Aug. 27, change the name of the folder from label to counter index
+            for i in range(existing, sample_per_label):
+                grid, targets = self.sample(sensors, label, i, power, num_tx, num_tx_upper, min_dist, max_dist)
+                np.save(f'{root_dir}/{folder:06d}/{i}.npy', GenerateData.quantize(grid, dtype))
+                np.save(f'{root_dir}/{folder:06d}/{i}.target', np.array(targets).astype(np.float32))
+                index.add(folder, i, targets)
                 if i == 0:
-                    imageio.imwrite(f'{folder}/{tx}.png', grid)
-            counter += 1
+                    imageio.imwrite(f'{root_dir}/{folder:06d}/{label}.png', grid)
+                added += 1
+        index.save(root_dir)
+        if append:
+            print(f'{root_dir}: {added} samples added, {len(index)} samples')
+
+    @staticmethod
+    def add_db(db1: np.ndarray, db2: np.ndarray):
+        '''the sum of two powers in dB, vectorized Utility.linear2db(Utility.db2linear(db1) + Utility.db2linear(db2))
+        '''
+        linear = np.where(db1 <= -80, 0, np.power(10, db1 / 10)) + np.where(db2 <= -80, 0, np.power(10, db2 / 10))
+        with np.errstate(divide='ignore'):
+            db = 10 * np.log10(linear)
+        return np.where(db < -80, -80, db)
 
 
-    def update_population(self, population_set, intruder, grid_len, min_dist, max_dist):
-        '''Update the population (the TX candidate locations)
+class GenerateMovingData(GenerateData):
+    '''generate sequences of moving TX, each TX moves with a constant velocity plus a random acceleration
+       and bounces at the border of the grid. For testing the multi frame tracking
+    '''
+    def frame(self, sensors: SensorArray, txs: np.ndarray, power: float):
+        '''the sensor readings of one frame, the same propagation model as GenerateData.generate (vectorized)
         Args:
-            population_set -- set             -- the TX candidate locations
-            intruder       -- tuple<int, int> -- the new selected TX
-            grid_len       -- int             -- grid length
-            min_dist       -- int             -- minimum distance between two TX. for far away sensors
-            max_dist       -- int             -- maximum distance between two TX. for close by sensors
+            sensors -- SensorArray -- the sensors
+            txs     -- np.ndarray  -- n = 2, the continuous TX locations
+            power   -- float       -- the power of the transmitter
+        Return:
+            np.ndarray -- (grid_length, grid_length)
         '''
-        if max_dist is None:
-            cur_x = intruder[0]
-            cur_y = intruder[1]
-            for x in range(-min_dist, min_dist+1):
-                for y in range(-min_dist, min_dist+1):
-                    nxt_x = cur_x + x
-                    nxt_y = cur_y + y
-                    if 0 <= nxt_x < grid_len and 0 <= nxt_y < grid_len and Utility.distance(intruder, (nxt_x, nxt_y)) < min_dist:
-                        if (nxt_x, nxt_y) in population_set:
-                            population_set.remove((nxt_x, nxt_y))
-        else:
-            cur_x = intruder[0]
-            cur_y = intruder[1]
-            for x, y in population_set.copy():
-                if not (min_dist <= Utility.distance(intruder, (x, y)) <= max_dist):
-                    population_set.remove((x, y))
+        rssi = power - self.propagation.pathloss_vector(sensors.distance(txs) * Default.cell_length)   # (num_tx, num_sensor)
+        linear = np.where(rssi <= Default.noise_floor, 0, np.power(10, rssi / 10)).sum(axis=0)
+        with np.errstate(divide='ignore'):
+            readings = np.maximum(10 * np.log10(linear), Default.noise_floor)
+        return sensors.scatter(readings, Default.noise_floor, np.float64)
+
+    def sequence(self, sensors: SensorArray, power: float, num_tx: int, num_frames: int, speed: float, acceleration: float = 0.1):
+        '''one sequence of frames
+        Args:
+            sensors      -- SensorArray -- the sensors
+            power        -- float       -- the power of the transmitter
+            num_tx       -- int         -- number of TX
+            num_frames   -- int         -- number of frames
+            speed        -- float       -- the initial speed, cells per frame
+            acceleration -- float       -- std of the random acceleration, cells per frame^2
+        Return:
+            np.ndarray, np.ndarray -- the matrices (num_frames, grid_length, grid_length), the TX locations (num_frames, num_tx, 2)
+        '''
+        location = np.random.uniform(0, self.grid_length, (num_tx, 2))
+        angle = np.random.uniform(0, 2 * np.pi, num_tx)
+        velocity = speed * np.stack([np.cos(angle), np.sin(angle)], axis=1)
+        matrices, targets = [], []
+        for _ in range(num_frames):
+            matrices.append(self.frame(sensors, location, power))
+            targets.append(location.copy())
+            velocity += np.random.normal(0, acceleration, velocity.shape)
+            location += velocity
+            low, high = location < 0, location >= self.grid_length                # bounce at the border
+            location[low] = -location[low]
+            location[high] = 2 * self.grid_length - location[high] - 1e-6
+            velocity[low | high] *= -1
+        return np.array(matrices), np.array(targets)
+
+    def generate_moving(self, power: float, num_sequence: int, num_frames: int, sensor_file: str, root_dir: str, num_tx: int, speed: float,
+                        dtype: str = 'float32', store_dir: str = None):
+        '''each sequence is a folder, each frame is a sample, so the layout is the same as GenerateData.generate
+        Args:
+            num_sequence -- int   -- number of sequences
+            num_frames   -- int   -- frames per sequence
+            speed        -- float -- the initial speed, cells per frame
+            dtype        -- str   -- the storage of the matrices, see GenerateData.quantize
+            store_dir    -- str   -- the content addressed store, see GenerateData.generate
+        '''
+        if store_dir is not None:
+            params = dict(kind='moving', power=power, num_sequence=num_sequence, num_frames=num_frames, num_tx=num_tx, speed=speed, dtype=dtype)
+            key = self.content_addressed(store_dir, root_dir, sensor_file, params, lambda stored: self.generate_moving(
+                power, num_sequence, num_frames, sensor_file, stored, num_tx, speed, dtype))
+            self.log(power, 0, num_frames, sensor_file, os.path.normpath(root_dir), num_tx, False, None, None, dtype, key)
+            return
+        Utility.remove_make(root_dir)
+        self.log(power, 0, num_frames, sensor_file, root_dir, num_tx, False, None, None, dtype)
+        random.seed(self.seed)
+        np.random.seed(self.seed)
+        sensors = GenerateSensors.load(sensor_file, self.grid_length)
+        index = SampleIndex()
+        for counter in range(num_sequence):
+            folder = f'{root_dir}/{counter:06d}'
+            os.mkdir(folder)
+            matrices, targets = self.sequence(sensors, power, num_tx, num_frames, speed)
+            for i, (grid, target) in enumerate(zip(matrices, targets)):
+                np.save(f'{folder}/{i}.npy', GenerateData.quantize(grid, dtype))
+                np.save(f'{folder}/{i}.target', target.astype(np.float32))
+                index.add(counter, i, target)
+        index.save(root_dir)
 
 
 
@@ -217,11 +465,14 @@ if __name__ == '__main__':
     # python generate.py -gd -rd data/matrix-test30 -sl 2 -cp 1 -rs 1 -nt 2
 
     # python generate.py -gd -rd data/matrix-train52 -sl 10 -rs 0 -nt 2 -ntup -mind 1 -maxd 10
+    # python generate.py -gd -rd data/matrix-train60 -sl 10 -rs 0 -nt 5 -ntup -dt int16
+    # python generate.py -gm -rd data/moving-test1 -ns 10 -nf 50 -nt 3 -ve 1
 
     parser = argparse.ArgumentParser(description='Localize multiple transmitters')
 
     parser.add_argument('-gs', '--generate_sensor', action='store_true')
     parser.add_argument('-gd', '--generate_data', action='store_true')
+    parser.add_argument('-gm', '--generate_moving', action='store_true', help='generate sequences of moving TX')
     parser.add_argument('-al', '--alpha', nargs=1, type=float, default=[Default.alpha], help='the slope of pathloss')
     parser.add_argument('-st', '--std', nargs=1, type=float, default=[Default.std], help='the standard deviation zero mean Guassian')
     parser.add_argument('-gl', '--grid_length', nargs=1, type=int, default=[Default.grid_length], help='the length of the grid')
@@ -236,7 +487,17 @@ if __name__ == '__main__':
     parser.add_argument('-nt', '--num_tx', nargs=1, type=int, default=[Default.num_tx], help='number of transmitters')
     parser.add_argument('-mind', '--min_dist', nargs=1, type=int, default=[Default.min_dist], help='minimum distance between intruders')
     parser.add_argument('-maxd', '--max_dist', nargs=1, type=int, default=[None], help='maximum distance between intruders')
+    parser.add_argument('-sp', '--sensor_spacing', nargs=1, type=float, default=[2], help='minimum distance between sensors')
+    parser.add_argument('-vi', '--visualize', action='store_true', help='save a heatmap of the generated sensors')
+    parser.add_argument('-ns', '--num_sequence', nargs=1, type=int, default=[10], help='number of sequences of moving TX')
+    parser.add_argument('-nf', '--num_frames', nargs=1, type=int, default=[50], help='number of frames per sequence')
+    parser.add_argument('-ve', '--velocity', nargs=1, type=float, default=[1], help='the initial speed of moving TX, cells per frame')
+    parser.add_argument('-dt', '--dtype', nargs=1, type=str, default=['float32'], choices=['float32', 'float16', 'int16'],
+                        help='the storage of the matrices, int16 is fixed point dB')
     parser.add_argument('-ntup', '--num_tx_upbound', action='store_true', help='if yes, then generate [1, ntx] number of TX')
+    parser.add_argument('-cs', '--content_store', nargs=1, type=str, default=['data/store'], help='the content addressed store of the datasets')
+    parser.add_argument('-nc', '--no_cache', action='store_true', help='remove root_dir and generate into it, without the store')
+    parser.add_argument('-ap', '--append', action='store_true', help='add the new labels and samples per label to the dataset of root_dir')
 
     args = parser.parse_args()
 
@@ -244,10 +505,11 @@ if __name__ == '__main__':
     grid_length = args.grid_length[0]
     sensor_density = args.sensor_density[0]
     num_tx = args.num_tx[0]
+    store_dir = None if args.no_cache else args.content_store[0]
 
     if args.generate_sensor:
         print('generating sensor')
-        GenerateSensors.random(grid_length, sensor_density, random_seed, f'data/sensors-{grid_length}-{sensor_density}')
+        GenerateSensors.random(grid_length, sensor_density, random_seed, f'data/sensors-{grid_length}-{sensor_density}', args.sensor_spacing[0], args.visualize)
 
     if args.generate_data:
         alpha       = args.alpha[0]
@@ -265,4 +527,11 @@ if __name__ == '__main__':
         print(f'generating {num_tx} TX data')
 
         gd = GenerateData(random_seed, alpha, std, grid_length, cell_length, sensor_density, noise_floor)
-        gd.generate(power, cell_percentage, sample_per_label, f'data/sensors/{grid_length}-{sensor_density}', root_dir, num_tx, num_tx_upbound, min_dist, max_dist)
+        gd.generate(power, cell_percentage, sample_per_label, f'data/sensors/{grid_length}-{sensor_density}', root_dir, num_tx, num_tx_upbound, min_dist, max_dist, args.dtype[0], store_dir,
+                    args.append)
+
+    if args.generate_moving:
+        print(f'generating {num_tx} moving TX data')
+        gm = GenerateMovingData(random_seed, args.alpha[0], args.std[0], grid_length, args.cell_length[0], sensor_density, args.noise_floor[0])
+        gm.generate_moving(args.power[0], args.num_sequence[0], args.num_frames[0], f'data/sensors/{grid_length}-{sensor_density}',
+                           args.root_dir[0], num_tx, args.velocity[0], args.dtype[0], store_dir)
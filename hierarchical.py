@@ -0,0 +1,195 @@
+'''
+Coarse to fine localization for large areas: a coarse pass on a downsampled grid finds the regions with TX,
+then the full resolution model and the peak detection run only on the regions of interest, batched
+'''
+
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from input_output import Default
+from utility import Utility
+from tiling import TiledInference
+from ensemble import FusedLocalizer
+
+
+class HierarchicalLocalizer:
+    '''1 coarse: the normalized grid is max pooled by factor, the coarse model runs on it, the coarse cells above
+         coarse_threshold (dilated by one cell) are the candidate regions. By default the coarse model is the fine model:
+         on the pooled grid it sees a denser sensor layout and lights the neighborhood of the TX, which is all this pass needs
+       2 fine: the grid is split into cores of roi_length - 2 * receptive radius cells, like the tiles of TiledInference.
+         Only the cores with a candidate are computed, each one with its halo as a roi_length x roi_length region of interest,
+         batched through the fine model, so the output of a core is the same as a full grid forward
+       3 the # of TX of a region is the # of local maxima above count_threshold, detect_peak_batch and float_target refine them,
+         and a peak is kept by the region whose core contains it
+       The fine compute scales with the # of TX, the coarse one with the area / factor^2
+    '''
+    def __init__(self, model: nn.Module, coarse_model: nn.Module = None, factor: int = 4, coarse_threshold: float = 0.1,
+                 roi_length: int = Default.grid_length, threshold: float = 0.1, count_threshold: float = 1, count_size: int = 9,
+                 batch_size: int = 32, profile=None, device=None):
+        '''
+        Args:
+            model            -- nn.Module -- the fully convolutional fine model, eg. NetTranslation4
+            coarse_model     -- nn.Module -- the model of the pooled grid, by default model
+            factor           -- int       -- the downsampling of the coarse pass
+            coarse_threshold -- float     -- the coarse cells above it are candidates
+            roi_length       -- int       -- the length of a region of interest, by default the training grid
+            threshold        -- float     -- threshold for non-tx areas in the fine output
+            count_threshold  -- float     -- a local maximum above it is a TX. NetTranslation4 peaks at 3 ~ 8 on a TX,
+                                             the side lobes stay below 1
+            count_size       -- int       -- the window of the local maxima that count the TX of a region
+            profile          -- PeakProfile -- the tuned peak detection of tuning.py, overrides threshold in detect_peak_batch
+        '''
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
+        self.model = model.to(device).eval()
+        self.coarse_model = self.model if coarse_model is None else coarse_model.to(device).eval()
+        self.factor = factor
+        self.coarse_threshold = coarse_threshold
+        self.halo = TiledInference.receptive_radius(model)
+        if roi_length <= 2 * self.halo:
+            raise ValueError(f'roi length {roi_length} should be larger than two times the receptive radius {self.halo}')
+        self.roi_length = roi_length
+        self.core = roi_length - 2 * self.halo
+        self.threshold = threshold
+        self.count_threshold = count_threshold
+        self.count_size = count_size
+        self.batch_size = batch_size
+        self.profile = profile
+
+    def coarse(self, X: torch.Tensor):
+        '''
+        Args:
+            X -- torch.Tensor -- (H, W) normalized, on the device
+        Return:
+            np.ndarray -- (ceil(H / factor), ceil(W / factor)), the candidate coarse cells
+        '''
+        from scipy.ndimage import binary_dilation
+
+        with torch.no_grad():
+            pooled = F.max_pool2d(X[None, None], self.factor, ceil_mode=True)
+            score = self.coarse_model(pooled)[0, 0].cpu().numpy()
+        return binary_dilation(score > self.coarse_threshold, np.ones((3, 3), dtype=bool))
+
+    def regions(self, candidates: np.ndarray, height: int, width: int):
+        '''the cores that overlap a candidate coarse cell
+        Return:
+            list<(int, int, int, int)> -- (core x, core y, region x, region y), the region is the top left of its ROI
+        '''
+        cells = np.argwhere(candidates) * self.factor
+        cores = set()
+        for dx in (0, self.factor - 1):                   # a coarse cell spans at most two cores on each axis
+            for dy in (0, self.factor - 1):
+                x = np.minimum(cells[:, 0] + dx, height - 1) // self.core
+                y = np.minimum(cells[:, 1] + dy, width - 1) // self.core
+                cores.update(zip(x.tolist(), y.tolist()))
+        regions = []
+        for cx, cy in sorted(cores):
+            rx = min(max(cx * self.core - self.halo, 0), max(height - self.roi_length, 0))
+            ry = min(max(cy * self.core - self.halo, 0), max(width - self.roi_length, 0))
+            regions.append((cx, cy, rx, ry))
+        return regions
+
+    def fine(self, X: torch.Tensor, regions: list):
+        '''the fine model on the regions of interest, batched
+        Return:
+            np.ndarray -- (len(regions), roi_length, roi_length)
+        '''
+        outputs = []
+        with torch.no_grad():
+            for i in range(0, len(regions), self.batch_size):
+                batch = regions[i:i + self.batch_size]
+                inputs = torch.stack([X[rx:rx + self.roi_length, ry:ry + self.roi_length] for _, _, rx, ry in batch])
+                outputs.append(self.model(inputs.unsqueeze(1))[:, 0].cpu().numpy())
+        return np.concatenate(outputs) if outputs else np.zeros((0, self.roi_length, self.roi_length), dtype=np.float32)
+
+    def count(self, outputs: np.ndarray):
+        '''the # of local maxima above count_threshold of each region
+        '''
+        from scipy.ndimage import maximum_filter
+
+        peaks = (maximum_filter(outputs, size=(1, self.count_size, self.count_size)) == outputs) & (outputs > self.count_threshold)
+        return peaks.reshape(len(outputs), -1).sum(axis=1)
+
+    def localize(self, matrix: np.ndarray):
+        '''
+        Args:
+            matrix -- np.ndarray -- (height, width), already normalized, at least roi_length on each side
+        Return:
+            list<(float, float)>, dict -- the TX locations, and the work done (coarse cells, regions)
+        '''
+        height, width = matrix.shape
+        X = torch.as_tensor(matrix, dtype=torch.float32, device=self.device)
+        candidates = self.coarse(X)
+        regions = self.regions(candidates, height, width)
+        outputs = self.fine(X, regions)
+        counts = self.count(outputs)
+        active = np.flatnonzero(counts > 0)
+        locations = []
+        if len(active):
+            peaks, _ = Utility.detect_peak_batch(outputs[active].copy(), counts[active], self.threshold, self.profile)
+            for i, region_peaks in zip(active, peaks):
+                cx, cy, rx, ry = regions[i]
+                for x, y in FusedLocalizer.float_target(outputs[i], region_peaks):
+                    x, y = x + rx, y + ry
+                    if cx * self.core <= x < (cx + 1) * self.core and cy * self.core <= y < (cy + 1) * self.core:
+                        locations.append((x, y))
+        work = {'coarse cells': candidates.size, 'candidates': int(candidates.sum()), 'regions': len(regions),
+                'fine cells': len(regions) * self.roi_length ** 2}
+        return locations, work
+
+
+if __name__ == '__main__':
+
+    # python hierarchical.py -m model/model1-11.10.pt -gl 500 1000 2000 -nt 1 4 16
+
+    from dataset import UniformNormalize
+    from generate import GenerateData, GenerateSensors
+    from node import SensorArray
+    from deepleaning_models import NetTranslation4
+
+    parser = argparse.ArgumentParser(description='Coarse to fine localization against the full resolution tiled forward')
+    parser.add_argument('-m', '--model', nargs=1, type=str, default=['model/model1-11.10.pt'], help='state dict of NetTranslation4')
+    parser.add_argument('-gl', '--grid_length', nargs='+', type=int, default=[500, 1000, 2000], help='the lengths of the areas')
+    parser.add_argument('-nt', '--num_tx', nargs='+', type=int, default=[1, 4, 16], help='the # of TX')
+    parser.add_argument('-fa', '--factor', nargs=1, type=int, default=[4], help='the downsampling of the coarse pass')
+    parser.add_argument('-mind', '--min_dist', nargs=1, type=int, default=[20], help='minimum distance between TX')
+    parser.add_argument('-n', '--num', nargs=1, type=int, default=[3], help='samples of each (area, # of TX)')
+    parser.add_argument('-fu', '--full', action='store_true', help='also time the full resolution tiled forward')
+    args = parser.parse_args()
+
+    model = NetTranslation4()
+    model.load_state_dict(torch.load(args.model[0], map_location='cpu'))
+    hierarchical = HierarchicalLocalizer(model, factor=args.factor[0])
+    tiled = TiledInference(model)
+    normalize = UniformNormalize(Default.noise_floor)
+    print(f'{"area":>10}{"TX":>5}{"regions":>9}{"error":>8}{"miss":>7}{"false":>7}{"hierarchical s":>16}{"tiled forward s":>17}')
+    for grid_length in args.grid_length:
+        density = grid_length * grid_length * Default.sen_density // Default.grid_length ** 2      # the density of the training data
+        sensors = SensorArray.from_index(GenerateSensors.poisson_disk(grid_length, density, 0), grid_length)
+        generator = GenerateData(0, Default.alpha, Default.std, grid_length, Default.cell_length, density, Default.noise_floor)
+        rng = np.random.default_rng(grid_length)
+        for num_tx in args.num_tx:
+            errors, misses, falses, elapsed, full, regions = [], [], [], [], [], []
+            for i in range(args.num[0]):
+                label = tuple(rng.integers(0, grid_length, 2))
+                grid, targets = generator.sample(sensors, label, i, Default.power, num_tx, False, args.min_dist[0], None)
+                matrix = normalize(grid.astype(np.float32))
+                start = time.perf_counter()
+                pred, work = hierarchical.localize(matrix)
+                elapsed.append(time.perf_counter() - start)
+                regions.append(work['regions'])
+                error, miss, false = Utility.compute_error(pred, targets, Default.grid_length * Default.error_threshold)
+                errors.extend(error)
+                misses.append(miss)
+                falses.append(false)
+                if args.full:
+                    start = time.perf_counter()
+                    tiled.predict(matrix)
+                    full.append(time.perf_counter() - start)
+            full = f'{np.mean(full):>17.3f}' if full else f'{"-":>17}'
+            print(f'{f"{grid_length}^2":>10}{num_tx:>5}{np.mean(regions):>9.1f}{np.mean(errors):>8.3f}{np.mean(misses):>7.2f}'
+                  f'{np.mean(falses):>7.2f}{np.mean(elapsed):>16.3f}{full}')
@@ -27,6 +27,7 @@ class Default:
     error_threshold  = 0.2
     min_dist         = 1
     max_dist         = None
+    db_scale         = 0.01    # the dB of one unit of the int16 fixed point storage
 
 @dataclass
 class Input:
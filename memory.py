@@ -0,0 +1,268 @@
+'''
+Memory of a training step: activation checkpointing of the conv blocks, the peak memory estimate that picks the micro batch
+of the gradient accumulation, and the measured peak memory of each step
+'''
+
+import argparse
+import copy
+import multiprocessing
+import time
+from dataclasses import dataclass
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+class ActivationCheckpoint(nn.Module):
+    '''The conv blocks (conv + relu, no relu after the last conv) of NetTranslation4 or NetTranslation. The output block
+       (32 -> 1 channels) is a sum over the channels of the wide block before it (8 -> 32), so the two are computed in
+       groups of channels, each group checkpointed: only the input of the wide block and the output are kept, and the
+       backward recomputes the wide activations one group at a time. One group is the plain checkpoint of the two blocks,
+       it does not lower the peak since the backward recomputes all the 32 channels at once.
+       The wrapped model is not changed, its state dict is saved as usual
+    '''
+    def __init__(self, model: nn.Module, groups: int = 4):
+        '''
+        Args:
+            model  -- nn.Module -- a fully convolutional model, the Conv2d children in the order of the forward
+            groups -- int       -- the channel groups of the wide block, more groups is a lower peak for the same recompute
+        '''
+        super().__init__()
+        self.model = model
+        self.convs = [m for m in model.children() if isinstance(m, nn.Conv2d)]
+        if len(self.convs) < 2:
+            raise ValueError('the model should have at least two conv blocks')
+        self.groups = min(groups, self.convs[-2].out_channels)
+
+    @staticmethod
+    def conv(conv: nn.Conv2d, x: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor = None):
+        return F.conv2d(x, weight, bias, conv.stride, conv.padding, conv.dilation)
+
+    def group(self, x: torch.Tensor, start: int, stop: int):
+        '''the contribution of the wide channels [start, stop) to the output, without its bias
+        '''
+        wide, last = self.convs[-2:]
+        x = F.relu(self.conv(wide, x, wide.weight[start:stop], wide.bias[start:stop]))
+        return self.conv(last, x, last.weight[:, start:stop])
+
+    def forward(self, x: torch.Tensor):
+        for conv in self.convs[:-2]:
+            x = F.relu(conv(x))
+        if not torch.is_grad_enabled():
+            return self.convs[-1](F.relu(self.convs[-2](x)))
+        bounds = torch.linspace(0, self.convs[-2].out_channels, self.groups + 1).round().int().tolist()
+        y = self.convs[-1].bias.view(1, -1, 1, 1)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            y = y + checkpoint(self.group, x, start, stop, use_reentrant=False)
+        return y
+
+
+@dataclass
+class MemoryProfile:
+    '''the bytes of a training step, linear in the micro batch
+    '''
+    fixed: int              # gradients, optimizer states and the workspace of the step
+    per_sample: int         # the activations and the gradients of one sample, at the peak of the step
+    batch_per_sample: int   # the input, the target and the prediction of one sample, held for the whole batch
+
+    def peak(self, micro_batch: int, batch_size: int = None):
+        batch_size = micro_batch if batch_size is None else batch_size
+        return self.fixed + micro_batch * self.per_sample + batch_size * self.batch_per_sample
+
+
+class Memory:
+    '''Estimate, budget and measure the memory of a training step.
+       The estimate is measured, not derived from the layers: the peak of the backward depends on the workspaces
+       of the conv kernels and on what the checkpoints recompute, NetTranslation4 peaks at about 3 times its saved tensors
+    '''
+    @staticmethod
+    def step(models: list, X: torch.Tensor, micro_batch: int):
+        '''one training step of each model in turn: the gradients of the micro batches are accumulated, then Adam
+        '''
+        for model in models:
+            optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+            for i in range(0, len(X), micro_batch):
+                x = X[i:i + micro_batch]
+                (model(x).float().square().mean() * len(x) / len(X)).backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+    @staticmethod
+    def probe(models: list, shape: tuple, micro_batch: int, batch_size: int, num_threads: int, queue):
+        '''the target of the process of Memory.measure
+        '''
+        torch.set_num_threads(num_threads)
+        X = torch.rand((batch_size, *shape))
+        Memory.reset_peak()
+        before = Memory.peak()
+        start = time.perf_counter()
+        Memory.step(models, X, micro_batch)
+        queue.put((Memory.peak() - before, time.perf_counter() - start))
+
+    @staticmethod
+    def measure(models: list, shape: tuple, micro_batch: int, batch_size: int = None, device=None):
+        '''one training step on random inputs, its peak bytes above the memory before it (the batch excluded).
+           On the CPU it runs in a new process: the pages that the allocator of this process already holds would hide the peak
+        Args:
+            models      -- list<nn.Module> -- eg. [ActivationCheckpoint(NetTranslation4()), NetNumTx(10)]
+            shape       -- tuple           -- the shape of a sample, eg. (1, 100, 100)
+            micro_batch -- int             -- the samples of one forward and backward
+            batch_size  -- int             -- the samples of one optimizer step, by default micro_batch
+        Return:
+            int, float -- the peak bytes, and the seconds of the step
+        '''
+        batch_size = micro_batch if batch_size is None else batch_size
+        models = [copy.deepcopy(model) for model in models]        # the step changes the weights
+        if device is not None and torch.device(device).type == 'cuda':
+            X = torch.rand((batch_size, *shape), device=device)
+            torch.cuda.synchronize(device)
+            before = torch.cuda.memory_allocated(device)
+            Memory.reset_peak(device)
+            start = time.perf_counter()
+            Memory.step(models, X, micro_batch)
+            torch.cuda.synchronize(device)
+            return Memory.peak(device) - before, time.perf_counter() - start
+        context = multiprocessing.get_context('spawn')
+        queue = context.Queue()
+        models = [model.cpu() for model in models]
+        process = context.Process(target=Memory.probe, args=(models, shape, micro_batch, batch_size, torch.get_num_threads(), queue))
+        process.start()
+        peak, elapsed = queue.get()
+        process.join()
+        return peak, elapsed
+
+    @staticmethod
+    def profile(models: list, shape: tuple, micro_batches: tuple = (2, 8), device=None):
+        '''the peak of two micro batches, extrapolated linearly. The workspaces of the conv kernels change with the size
+           of the batch, so it is an estimate: feasible_batch_size verifies it
+        Args:
+            models        -- list<nn.Module> -- the models trained in one step, in the order of the step
+            shape         -- tuple           -- the shape of a sample, eg. (1, 100, 100)
+            micro_batches -- tuple           -- the two probed micro batches
+        Return:
+            MemoryProfile
+        '''
+        small, large = micro_batches
+        low, high = (Memory.measure(models, shape, m, device=device)[0] for m in micro_batches)
+        per_sample = max((high - low) // (large - small), 1)
+        fixed = max(low - small * per_sample, 0)
+        batch_per_sample = 3 * torch.Size(shape).numel() * 4        # float32 input, target and detached prediction
+        return MemoryProfile(fixed, per_sample, batch_per_sample)
+
+    @staticmethod
+    def available(device=None, fraction: float = 0.8):
+        '''a fraction of the free memory of the GPU, or of MemAvailable of /proc/meminfo
+        '''
+        if device is not None and torch.device(device).type == 'cuda':
+            free, _ = torch.cuda.mem_get_info(device)
+            return int(free * fraction)
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(int(line.split()[1]) * 1024 * fraction)
+        raise OSError('MemAvailable is not in /proc/meminfo')
+
+    @staticmethod
+    def estimate_batch_size(profile: MemoryProfile, budget: int, batch_size: int):
+        '''the largest micro batch of a batch of batch_size whose estimated peak is within the budget
+        Args:
+            profile    -- MemoryProfile
+            budget     -- int -- bytes
+            batch_size -- int -- the batch of one optimizer step
+        Return:
+            int
+        '''
+        spare = budget - profile.fixed - batch_size * profile.batch_per_sample
+        micro_batch = min(spare // profile.per_sample, batch_size) if spare > 0 else 0
+        if micro_batch < 1:
+            raise ValueError(f'a micro batch of 1 needs {profile.peak(1, batch_size) / 2**20:.0f} MB, '
+                             f'the budget is {budget / 2**20:.0f} MB')
+        return int(micro_batch)
+
+    @staticmethod
+    def feasible_batch_size(models: list, shape: tuple, budget: int, batch_size: int, profile: MemoryProfile = None,
+                            device=None, tries: int = 3):
+        '''the micro batch of the estimate, then measured: while its peak is over the budget, it is scaled down by the ratio
+        Args:
+            models     -- list<nn.Module> -- the models trained in one step
+            shape      -- tuple           -- the shape of a sample, eg. (1, 100, 100)
+            budget     -- int             -- bytes
+            batch_size -- int             -- the batch of one optimizer step
+            profile    -- MemoryProfile   -- by default Memory.profile of the models
+        Return:
+            int, int -- the micro batch and its measured peak, the batch included
+        '''
+        profile = Memory.profile(models, shape, device=device) if profile is None else profile
+        micro_batch = Memory.estimate_batch_size(profile, budget, batch_size)
+        for _ in range(tries):
+            peak, _ = Memory.measure(models, shape, micro_batch, batch_size, device)
+            peak += batch_size * profile.batch_per_sample
+            if peak <= budget or micro_batch == 1:
+                break
+            micro_batch = max(int(micro_batch * budget / peak), 1)
+        return micro_batch, peak
+
+    @staticmethod
+    def reset_peak(device=None):
+        '''start a new peak: the CUDA allocator statistics, or the high water mark of the resident set (Linux clear_refs)
+        '''
+        if device is not None and torch.device(device).type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+            return
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:                                   # then VmHWM is the peak since the start of the process
+            pass
+
+    @staticmethod
+    def peak(device=None):
+        '''the peak bytes since reset_peak: allocated by torch on CUDA, VmHWM of the process on the CPU (None if unknown)
+        '''
+        if device is not None and torch.device(device).type == 'cuda':
+            return torch.cuda.max_memory_allocated(device)
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+
+if __name__ == '__main__':
+
+    # python memory.py -gl 100 200 400 -bs 32
+    # python memory.py -gl 400 -bs 32 -gr 0 1 4 8 -mm 1024
+
+    from deepleaning_models import NetTranslation4
+
+    parser = argparse.ArgumentParser(description='Estimated against measured peak memory of a training step of NetTranslation4')
+    parser.add_argument('-gl', '--grid_length', nargs='+', type=int, default=[100, 200, 400], help='the lengths of the grids')
+    parser.add_argument('-bs', '--batch_size', nargs=1, type=int, default=[32], help='the batch size')
+    parser.add_argument('-gr', '--groups', nargs='+', type=int, default=[0, 4], help='the checkpoint groups, 0 is no checkpoint')
+    parser.add_argument('-mm', '--memory_mb', nargs=1, type=float, default=[None], help='a budget in MB, by default 80%% of the available memory')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = NetTranslation4()
+    budget = Memory.available() if args.memory_mb[0] is None else int(args.memory_mb[0] * 2**20)
+    batch_size = args.batch_size[0]
+    print(f'budget = {budget / 2**20:.0f} MB, batch size = {batch_size}')
+    print(f'{"grid":>6}{"groups":>8}{"estimate":>10}{"estimated MB":>14}{"micro":>7}{"measured MB":>13}{"s/step":>8}')
+    for grid_length in args.grid_length:
+        shape = (1, grid_length, grid_length)
+        for groups in args.groups:
+            models = [model if groups == 0 else ActivationCheckpoint(model, groups)]
+            profile = Memory.profile(models, shape)
+            try:
+                estimate = Memory.estimate_batch_size(profile, budget, batch_size)
+                micro_batch, measured = Memory.feasible_batch_size(models, shape, budget, batch_size, profile)
+            except ValueError as e:
+                print(f'{grid_length:>6}{groups:>8}  {e}')
+                continue
+            _, elapsed = Memory.measure(models, shape, micro_batch, batch_size)
+            print(f'{grid_length:>6}{groups:>8}{estimate:>10}{profile.peak(estimate, batch_size) / 2**20:>14.1f}{micro_batch:>7}'
+                  f'{measured / 2**20:>13.1f}{elapsed:>8.2f}')
@@ -2,6 +2,11 @@
 Encapsulates both RX and TX
 '''
 
+import os
+import re
+import numpy as np
+
+
 class Node:
     '''the parent class of RX and TX
     '''
@@ -32,3 +37,142 @@ class Transmitter(Node):
         super().__init__(x, y, indx)
         self.power = power
 
+
+
+class SensorArray:
+    '''structure of arrays of the receivers: contiguous x, y coordinate arrays, the flat grid indices,
+       and optional per sensor metadata arrays (eg. a gain). Replaces a list of Sensor in the vectorized code
+    '''
+    def __init__(self, x, y, grid_length: int, **metadata):
+        '''
+        Args:
+            x           -- np.ndarray -- (n,) x axis coordinates
+            y           -- np.ndarray -- (n,) y axis coordinates
+            grid_length -- int        -- the length of the grid
+            metadata    -- np.ndarray -- (n,) per sensor values, eg. gain=np.zeros(n)
+        '''
+        self.x = np.ascontiguousarray(x, dtype=np.int32)
+        self.y = np.ascontiguousarray(y, dtype=np.int32)
+        self.grid_length = grid_length
+        self.index = self.x.astype(np.int64) * grid_length + self.y        # flat grid indices
+        self.metadata = {key: np.asarray(value) for key, value in metadata.items()}
+        for key, value in self.metadata.items():
+            if len(value) != len(self.x):
+                raise ValueError(f'metadata {key} has {len(value)} values for {len(self.x)} sensors')
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, i: int):
+        '''the i-th sensor as a Sensor, for the code that is not vectorized
+        '''
+        return Sensor(int(self.x[i]), int(self.y[i]), i)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __array__(self, dtype=None, copy=None):
+        '''np.asarray(sensors) is the (n, 2) coordinates
+        '''
+        return self.coordinates if dtype is None else self.coordinates.astype(dtype)
+
+    @property
+    def coordinates(self):
+        '''(n, 2), one (x, y) per row
+        '''
+        return np.stack([self.x, self.y], axis=1)
+
+    @classmethod
+    def from_coordinates(cls, coordinates, grid_length: int, **metadata):
+        coordinates = np.asarray(coordinates, dtype=np.int64).reshape(-1, 2)
+        return cls(coordinates[:, 0], coordinates[:, 1], grid_length, **metadata)
+
+    @classmethod
+    def from_index(cls, index, grid_length: int, **metadata):
+        index = np.asarray(index, dtype=np.int64)
+        return cls(index // grid_length, index % grid_length, grid_length, **metadata)
+
+    @staticmethod
+    def cache_path(filename: str):
+        '''the binary cache of a sensor file, outside of the source tree: in $XDG_CACHE_HOME (by default ~/.cache),
+           named by the absolute path of the sensor file
+        '''
+        import hashlib
+
+        cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'deeplearning-localization', 'sensors')
+        name = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f'{os.path.basename(filename)}-{name}.npy')
+
+    @classmethod
+    def load(cls, filename: str, grid_length: int = None):
+        '''read a sensor file (one "x y" per line). A binary copy is used when it is not older than the text file:
+           filename.npy written by save, or the cache of cache_path. Otherwise the text is parsed once and the cache is written
+        Args:
+            filename    -- str -- eg. data/sensors/100-500
+            grid_length -- int -- by default the first number in the file name, eg. 100
+        '''
+        def fresh(path):
+            return os.path.exists(path) and (not os.path.exists(filename) or os.path.getmtime(path) >= os.path.getmtime(filename))
+
+        cache = SensorArray.cache_path(filename)
+        if fresh(filename + '.npy'):
+            coordinates = np.load(filename + '.npy')
+        elif fresh(cache):
+            coordinates = np.load(cache)
+        else:
+            coordinates = np.loadtxt(filename, dtype=int, ndmin=2)
+            try:
+                os.makedirs(os.path.dirname(cache), exist_ok=True)
+                np.save(cache, coordinates)
+            except OSError:                     # no writable cache directory, parse the text next time
+                pass
+        if grid_length is None:
+            match = re.search(r'\d+', os.path.basename(filename))
+            grid_length = int(match.group()) if match else int(coordinates.max()) + 1
+        return cls.from_coordinates(coordinates, grid_length)
+
+    def save(self, filename: str):
+        '''the text file and its binary cache filename.npy
+        '''
+        np.savetxt(filename, self.coordinates, fmt='%d')
+        np.save(filename + '.npy', self.coordinates)
+
+    def distance(self, points):
+        '''euclidean distance (cells) between every point and every sensor, 0.5 for a point on a sensor
+           like Utility.distance_propagation
+        Args:
+            points -- np.ndarray -- (m, 2) or (2,)
+        Return:
+            np.ndarray -- (m, n) or (n,)
+        '''
+        points = np.asarray(points, dtype=np.float64)
+        dist = np.sqrt((points[..., 0, None] - self.x) ** 2 + (points[..., 1, None] - self.y) ** 2)
+        return np.where(dist == 0, 0.5, dist)
+
+    def scatter(self, values, fill: float = 0, dtype=None):
+        '''the grid (input representation) with the values at the sensors and fill elsewhere
+        Args:
+            values -- np.ndarray -- (n,) or (batch, n)
+        Return:
+            np.ndarray -- (grid_length, grid_length) or (batch, grid_length, grid_length)
+        '''
+        values = np.asarray(values)
+        dtype = values.dtype if dtype is None else dtype
+        grid = np.full(values.shape[:-1] + (self.grid_length * self.grid_length,), fill, dtype=dtype)
+        grid[..., self.index] = values
+        return grid.reshape(values.shape[:-1] + (self.grid_length, self.grid_length))
+
+    def gather(self, grid):
+        '''the values at the sensors of a grid (..., grid_length, grid_length), the inverse of scatter
+        '''
+        return grid.reshape(grid.shape[:-2] + (-1,))[..., self.index]
+
+    def mask(self):
+        '''bool grid, True at the sensors
+        '''
+        return self.scatter(np.ones(len(self), dtype=bool), False)
+
+    def subset(self, keep):
+        '''the sensors selected by a bool mask or indices, metadata included
+        '''
+        return SensorArray(self.x[keep], self.y[keep], self.grid_length, **{k: v[keep] for k, v in self.metadata.items()})
@@ -0,0 +1,252 @@
+'''
+Cache of the raw model outputs over a dataset, to re-run the post processing (peak detection, errors) without the forward
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from input_output import Default
+
+
+class PredictionCache:
+    '''One entry per (checkpoint content hash, dataset, preprocessing config): the outputs of the model on every sample of
+       the dataset in a memory mapped {key}.npy, and {key}.json with the description of the entry.
+       The entries are evicted, least recently used first, when the cache is larger than max_bytes
+    '''
+    def __init__(self, cache_dir: str = None, max_bytes: int = 4 << 30):
+        '''
+        Args:
+            cache_dir -- str -- by default default_dir, outside of the source tree
+            max_bytes -- int -- the size of the cache
+        '''
+        self.cache_dir = PredictionCache.default_dir() if cache_dir is None else cache_dir
+        self.max_bytes = max_bytes
+        self.hashes = {}                     # (path, mtime, size) -> content hash, a checkpoint is hashed once
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def default_dir():
+        '''$XDG_CACHE_HOME (by default ~/.cache)/deeplearning-localization/predictions, next to the sensor cache of SensorArray
+        '''
+        return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'deeplearning-localization', 'predictions')
+
+    def file_hash(self, filename: str):
+        '''sha256 of the content of a file
+        '''
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+        if key not in self.hashes:
+            sha = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            self.hashes[key] = sha.hexdigest()
+        return self.hashes[key]
+
+    @staticmethod
+    def default_config():
+        '''the preprocessing of tf in dataset.py
+        '''
+        return {'transform': 'UniformNormalize', 'noise_floor': Default.noise_floor, 'db_scale': Default.db_scale}
+
+    def dataset_identity(self, root_dir: str):
+        '''what identifies the data of a dataset: the content hash of its log (GenerateData.content_addressed), otherwise
+           the real path and the generation parameters of its log, otherwise the content of its matrices
+        '''
+        from generate import GenerateData
+        from sample_index import SampleIndex
+
+        index = SampleIndex.load(root_dir)                 # builds the index of an old dataset
+        log = GenerateData.read_log(root_dir)
+        if 'content hash' in log:
+            return {'content_hash': log['content hash']}
+        identity = {'dataset': os.path.realpath(root_dir), 'index_hash': self.file_hash(SampleIndex.filename(root_dir))}
+        if log:
+            identity['log'] = {k: v for k, v in log.items() if k != 'root file'}
+        else:
+            sha = hashlib.sha256()
+            for i in range(len(index)):
+                sha.update(self.file_hash(index.path(root_dir, i)).encode())
+            identity['matrices_hash'] = sha.hexdigest()
+        return identity
+
+    def key(self, checkpoint: str, root_dir: str, config: dict = None):
+        '''
+        Args:
+            checkpoint -- str  -- the state dict, identified by its content
+            root_dir   -- str  -- the dataset, identified by dataset_identity
+            config     -- dict -- the preprocessing config, and anything else that changes the outputs (eg. the model class)
+        Return:
+            str, dict -- the key and the description of the entry
+        '''
+        description = {'checkpoint': os.path.abspath(checkpoint), 'checkpoint_hash': self.file_hash(checkpoint),
+                       'dataset': os.path.abspath(root_dir), 'dataset_identity': self.dataset_identity(root_dir),
+                       'config': PredictionCache.default_config() if config is None else config}
+        identity = {k: v for k, v in description.items() if k not in ('checkpoint', 'dataset')}
+        key = hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:24]
+        return key, description
+
+    def paths(self, key: str):
+        return os.path.join(self.cache_dir, key + '.npy'), os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key: str):
+        '''the read only memory map of a complete entry, or None
+        '''
+        array_path, meta_path = self.paths(key)
+        if not (os.path.exists(array_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if not meta.get('complete'):
+            return None
+        meta['last_used'] = time.time()
+        self.write_meta(meta_path, meta)
+        return np.load(array_path, mmap_mode='r')
+
+    @staticmethod
+    def write_meta(meta_path: str, meta: dict):
+        tmp = meta_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(tmp, meta_path)
+
+    def predictions(self, model, checkpoint: str, root_dir: str, config: dict = None, transform=None,
+                    batch_size: int = 64, num_workers: int = 0, device=None):
+        '''the outputs of the model on the dataset, from the cache, otherwise computed once and cached
+        Args:
+            model      -- nn.Module -- with the state dict of checkpoint loaded
+            transform  -- callable  -- the preprocessing described by config, by default tf of dataset.py
+        Return:
+            np.memmap -- (N, *output shape of one sample), float32, read only
+        '''
+        config = dict(PredictionCache.default_config() if config is None else config, model=type(model).__name__)
+        key, description = self.key(checkpoint, root_dir, config)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        import torch
+        from torch.utils.data import DataLoader
+        from dataset import open_dataset, tf, my_collate
+
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        dataset = open_dataset(root_dir, tf if transform is None else transform)
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=my_collate)
+        model = model.to(device).eval()
+        array_path, meta_path = self.paths(key)
+        output = None
+        with torch.no_grad():
+            for sample in loader:
+                pred = model(sample['matrix'].to(device)).float().cpu().numpy()
+                if output is None:
+                    self.evict(len(dataset) * pred[0].nbytes)
+                    description.update({'complete': False, 'created': time.time(), 'last_used': time.time(), 'bytes': len(dataset) * pred[0].nbytes})
+                    self.write_meta(meta_path, description)     # an interrupted run leaves an incomplete entry that evict can remove
+                    output = np.lib.format.open_memmap(array_path, mode='w+', dtype=np.float32, shape=(len(dataset),) + pred.shape[1:])
+                index = sample['index'].numpy()
+                output[index[0]:index[-1] + 1] = pred
+        output.flush()
+        del output
+        description.update({'complete': True, 'created': time.time(), 'last_used': time.time(), 'bytes': os.path.getsize(array_path)})
+        self.write_meta(meta_path, description)
+        return np.load(array_path, mmap_mode='r')
+
+    def entries(self):
+        '''the descriptions of the entries, with their key
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                with open(os.path.join(self.cache_dir, name)) as f:
+                    entries.append(dict(json.load(f), key=name[:-5]))
+        return entries
+
+    def evict(self, incoming: int = 0):
+        '''remove the arrays without a description, then the least recently used entries until the cache and the incoming
+           bytes fit in max_bytes
+        '''
+        entries = sorted(self.entries(), key=lambda e: e.get('last_used', 0))
+        keys = {entry['key'] for entry in entries}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy') and name[:-4] not in keys:
+                os.remove(os.path.join(self.cache_dir, name))
+        total = sum(e.get('bytes', 0) for e in entries)
+        for entry in entries:
+            if total + incoming <= self.max_bytes:
+                break
+            for path in self.paths(entry['key']):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= entry.get('bytes', 0)
+
+    def clear(self):
+        for entry in self.entries():
+            for path in self.paths(entry['key']):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def evaluate(predictions: np.ndarray, root_dir: str, num_tx=None, threshold: float = 0.05, indices=None, profile=None,
+             index=None, batch_size: int = 256):
+    '''peak detection and errors from the cached outputs of NetTranslation4 alone
+    Args:
+        predictions -- np.ndarray -- (N, 1, H, W), eg. PredictionCache.predictions
+        num_tx      -- array-like -- the # of TX of each sample, by default the truth of the SampleIndex
+        indices     -- array-like -- only these samples
+        profile     -- PeakProfile -- the tuned peak detection of tuning.py, overrides threshold
+        index       -- SampleIndex -- the index of root_dir, when it is already loaded
+    Return:
+        list<float>, list<int>, list<int> -- errors (of all TX), misses, false alarms
+    '''
+    from sample_index import SampleIndex
+    from utility import Utility
+    from ensemble import FusedLocalizer
+
+    index = SampleIndex.load(root_dir) if index is None else index
+    indices = np.arange(len(predictions)) if indices is None else np.asarray(indices)
+    num_tx = index.num_tx if num_tx is None else np.asarray(num_tx)
+    errors, misses, falses = [], [], []
+    for b in range(0, len(indices), batch_size):
+        batch = indices[b:b + batch_size]
+        images = np.array(predictions[batch][:, 0])
+        peaks, _ = Utility.detect_peak_batch(images.copy(), num_tx[batch], threshold, profile)
+        for i, image, peak in zip(batch, images, peaks):
+            error, miss, false = Utility.compute_error(FusedLocalizer.float_target(image, peak), index.target(i),
+                                                       Default.grid_length * Default.error_threshold)
+            errors.extend(error)
+            misses.append(miss)
+            falses.append(false)
+    return errors, misses, falses
+
+
+if __name__ == '__main__':
+
+    # python prediction_cache.py -rd data/matrix-test51 -c model/model1-11.10.pt -th 0.05 0.1 0.2
+
+    import torch
+    from deepleaning_models import NetTranslation4
+
+    parser = argparse.ArgumentParser(description='Cache the outputs of NetTranslation4, then sweep the threshold of detect_peak')
+    parser.add_argument('-rd', '--root_dir', nargs=1, type=str, default=['data/matrix-test51'], help='the dataset')
+    parser.add_argument('-c', '--checkpoint', nargs=1, type=str, default=['model/model1-11.10.pt'], help='the state dict of NetTranslation4')
+    parser.add_argument('-cd', '--cache_dir', nargs=1, type=str, default=[None], help='the cache directory, by default $XDG_CACHE_HOME/deeplearning-localization/predictions')
+    parser.add_argument('-mb', '--max_bytes', nargs=1, type=float, default=[4], help='the size of the cache in GB')
+    parser.add_argument('-th', '--threshold', nargs='+', type=float, default=[0.05, 0.1], help='the thresholds of detect_peak')
+    args = parser.parse_args()
+
+    cache = PredictionCache(args.cache_dir[0], int(args.max_bytes[0] * 2**30))
+    model = NetTranslation4()
+    model.load_state_dict(torch.load(args.checkpoint[0], map_location='cpu'))
+    for attempt in ['first', 'cached']:
+        start = time.perf_counter()
+        predictions = cache.predictions(model, args.checkpoint[0], args.root_dir[0])
+        print(f'{attempt:<8} predictions {predictions.shape} in {time.perf_counter() - start:.2f} s')
+    for threshold in args.threshold:
+        start = time.perf_counter()
+        errors, misses, falses = evaluate(predictions, args.root_dir[0], threshold=threshold)
+        print(f'threshold = {threshold:<6} error = {np.mean(errors):.4f}, miss = {np.mean(misses):.4f}, '
+              f'false = {np.mean(falses):.4f}, {time.perf_counter() - start:.2f} s')
@@ -0,0 +1,99 @@
+'''
+Batched preprocessing on the device: the DataLoader returns the stored matrices as they are (float32, float16 or int16),
+the normalization and the channel dimension are applied to the whole batch after it is moved to the device
+'''
+
+import argparse
+import json
+import time
+from dataclasses import dataclass, asdict
+import torch
+import torch.nn as nn
+from input_output import Default
+
+
+@dataclass
+class PreprocessConfig:
+    '''the normalization of the input, saved next to the state dicts so that training and inference use the same one
+    '''
+    method: str = 'uniform'                  # uniform: (dB - noise floor) / (-noise floor / 2), like UniformNormalize
+                                             # minmax: per sample (x - min) / (max - min) to [lower, upper], like MinMaxNormalize
+    noise_floor: float = Default.noise_floor
+    db_scale: float = Default.db_scale       # dB per unit of the int16 storage, see GenerateData.quantize
+    lower: float = 0
+    upper: float = 1
+
+    def __post_init__(self):
+        if self.method not in ('uniform', 'minmax'):
+            raise ValueError(f'unknown normalization {self.method}')
+
+    def save(self, filename: str):
+        with open(filename, 'w') as f:
+            json.dump(asdict(self), f, indent=1)
+
+    @classmethod
+    def load(cls, filename: str):
+        with open(filename) as f:
+            return cls(**json.load(f))
+
+
+class Preprocess(nn.Module):
+    '''Raw batch (N, H, W) or (N, 1, H, W) of any storage dtype -> normalized float32 (N, 1, H, W).
+       uniform is one cast and one multiply add: the int16 scale and the noise floor shift are folded into
+       one (scale, offset) pair. The input is never modified. The channel dimension is a view. Nothing is done per sample on the CPU
+    '''
+    def __init__(self, config: PreprocessConfig = None):
+        super().__init__()
+        self.config = PreprocessConfig() if config is None else config
+
+    def scale_offset(self, dtype: torch.dtype):
+        '''y = x * scale + offset for the uniform normalization of a stored dtype
+        '''
+        scale = 1 / (-self.config.noise_floor / 2)
+        offset = -self.config.noise_floor * scale
+        if dtype == torch.int16:
+            scale *= self.config.db_scale
+        return scale, offset
+
+    def forward(self, raw: torch.Tensor):
+        x = raw.unsqueeze(1) if raw.dim() == 3 else raw
+        if self.config.method == 'uniform':
+            scale, offset = self.scale_offset(raw.dtype)
+            return (x.to(torch.float32) * scale).add_(offset)       # x may be the float32 batch of the caller, not in place
+        x = x.to(torch.float32)
+        minimum = x.amin(dim=(2, 3), keepdim=True)
+        maximum = x.amax(dim=(2, 3), keepdim=True)
+        scale = (self.config.upper - self.config.lower) / (maximum - minimum)
+        return (x - minimum).mul_(scale).add_(self.config.lower)
+
+
+if __name__ == '__main__':
+
+    # python preprocess.py -rd data/matrix-train51 -nw 3
+
+    import numpy as np
+    from torch.utils.data import DataLoader
+    from dataset import open_dataset, tf, my_collate
+
+    parser = argparse.ArgumentParser(description='Per sample CPU transforms against the batched device preprocessing')
+    parser.add_argument('-rd', '--root_dir', nargs=1, type=str, default=['data/matrix-train51'], help='the dataset')
+    parser.add_argument('-nw', '--num_workers', nargs=1, type=int, default=[3], help='number of DataLoader workers')
+    parser.add_argument('-bs', '--batch_size', nargs=1, type=int, default=[32], help='the batch size')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    preprocess = Preprocess(PreprocessConfig('uniform')).to(device)
+    results = {}
+    for name, transform in [('cpu transforms', tf), ('device preprocess', None)]:
+        dataset = open_dataset(args.root_dir[0], transform)
+        loader = DataLoader(dataset, batch_size=args.batch_size[0], shuffle=False, num_workers=args.num_workers[0], collate_fn=my_collate)
+        start = time.perf_counter()
+        batches = []
+        for sample in loader:
+            X = sample['matrix'].to(device)
+            batches.append(X if transform is not None else preprocess(X))
+        elapsed = time.perf_counter() - start
+        results[name] = torch.cat(batches)
+        print(f'{name:<18} {len(dataset) / elapsed:8.0f} samples/s, input {tuple(results[name].shape)}')
+    difference = (results['cpu transforms'] - results['device preprocess'].to(results['cpu transforms'].device)).abs().max()
+    print(f'max difference = {difference.item():.2e}')
@@ -32,6 +32,18 @@ class Propagation:
         pathloss = freespace + shadowing
         return pathloss if pathloss > 0 else -pathloss
 
+    def pathloss_vector(self, distance: np.ndarray, rng: np.random.Generator = None):
+        '''vectorized pathloss, one independent shadowing per element
+        Args:
+            distance -- np.ndarray          -- the distances
+            rng      -- np.random.Generator -- the random stream of the shadowing, by default the global np.random
+        Return:
+            np.ndarray -- same shape as distance
+        '''
+        freespace = np.where(distance > 1, 10 * self.alpha * np.log10(np.maximum(distance, 1)), 0)
+        shadowing = (np.random if rng is None else rng).normal(0, self.std, np.shape(distance))
+        return np.abs(freespace + shadowing)
+
 
 
 def test():
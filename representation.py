@@ -2,14 +2,29 @@
 Input and output representation of the deep learning networks
 '''
 
+import numpy as np
+from input_output import Default
+from node import SensorArray
+
+
 class InputRepresentation:
     '''Convert the sensor's data into a 2D matrix
     '''
-    def __init__(self, sensing_raw):
-        self.sensing_raw = sensing_raw
+    def __init__(self, sensing_raw, sensors: SensorArray, noise_floor: float = Default.noise_floor):
+        '''
+        Args:
+            sensing_raw -- np.ndarray  -- (n,) or (batch, n), the RSSI (dB) of the sensors, in the order of sensors
+            sensors     -- SensorArray -- the sensor layout
+            noise_floor -- float       -- the value of the cells without a sensor
+        '''
+        self.sensing_raw = np.asarray(sensing_raw)
+        self.sensors = sensors
+        self.noise_floor = noise_floor
         self.sensing_image = None
 
     def transform2image(self):
         '''transform the raw sensing data into a image that can be utilized by deep learning frameworks
         '''
-        pass 
+        readings = np.maximum(self.sensing_raw, self.noise_floor)
+        self.sensing_image = self.sensors.scatter(readings, self.noise_floor, np.float32)
+        return self.sensing_image
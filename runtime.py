@@ -0,0 +1,154 @@
+'''
+The CPU runtime configuration: the cores of the DataLoader workers, the intra-op and inter-op threads, the batch size
+'''
+
+import os
+import platform
+import time
+from dataclasses import dataclass, field, asdict
+from typing import List
+import torch
+
+
+@dataclass
+class RuntimeConfig:
+    '''the chosen configuration, recorded in the run metadata
+    '''
+    cores: List[int]                                          # the cores of the main process (intra-op threads)
+    num_workers: int = 0
+    worker_cores: List[List[int]] = field(default_factory=list)
+    intra_op: int = 1
+    inter_op: int = 1
+    batch_size: int = None
+    samples_per_second: float = None
+
+
+class WorkerInit:
+    '''worker_init_fn of the DataLoader: pin the worker to its cores, and one intra-op thread per core,
+       instead of inheriting the thread count of the main process
+    '''
+    def __init__(self, config: RuntimeConfig):
+        self.worker_cores = config.worker_cores
+
+    def __call__(self, worker_id: int):
+        if not self.worker_cores:
+            return
+        cores = self.worker_cores[worker_id % len(self.worker_cores)]
+        torch.set_num_threads(len(cores))
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+
+
+class Runtime:
+    '''Split the cores between the DataLoader workers and the intra-op threads of the main process,
+       so that 3 workers and the main process do not each start one thread per core
+    '''
+    @staticmethod
+    def available_cores():
+        if hasattr(os, 'sched_getaffinity'):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count()))
+
+    @staticmethod
+    def plan(num_workers: int, cores: List[int] = None, worker_threads: int = 1, inter_op: int = 1):
+        '''
+        Args:
+            num_workers    -- int       -- number of DataLoader workers
+            cores          -- list<int> -- the cores to use, by default the affinity of this process
+            worker_threads -- int       -- cores of each worker, loading and normalizing a sample is mostly single threaded
+            inter_op       -- int       -- inter-op threads, the models are sequential so 1 is enough
+        Return:
+            RuntimeConfig
+        '''
+        cores = Runtime.available_cores() if cores is None else sorted(cores)
+        need = num_workers * worker_threads
+        if need < len(cores):                   # the workers get their own cores at the end, the main process the rest
+            main = cores[:len(cores) - need]
+            worker_cores = [cores[len(main) + i * worker_threads: len(main) + (i + 1) * worker_threads] for i in range(num_workers)]
+        else:                                   # not enough cores: the workers share the cores round robin, the main process all of them
+            main = cores
+            worker_cores = [[cores[i % len(cores)]] for i in range(num_workers)]
+        intra_op = max(len(cores) - need, 1)
+        return RuntimeConfig(main, num_workers, worker_cores, intra_op, inter_op)
+
+    @staticmethod
+    def apply(config: RuntimeConfig):
+        '''set the affinity and the threads of this process. Call it before the first parallel op,
+           torch does not allow changing the inter-op threads afterwards (then it is kept as is)
+        '''
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, config.cores)
+        torch.set_num_threads(config.intra_op)
+        try:
+            torch.set_num_interop_threads(config.inter_op)
+        except RuntimeError:
+            config.inter_op = torch.get_num_interop_threads()
+        return config
+
+    @staticmethod
+    def autotune_batch_size(model: torch.nn.Module, shape: tuple = (1, 100, 100), candidates: List[int] = (8, 16, 32, 64, 128),
+                            train: bool = True, repeat: int = 3, config: RuntimeConfig = None):
+        '''the batch size with the most samples per second on this host
+        Args:
+            model      -- nn.Module   -- on the CPU
+            shape      -- tuple       -- the shape of one sample
+            candidates -- list<int>   -- the batch sizes to try
+            train      -- bool        -- time forward + backward + step, otherwise a no_grad forward
+            config     -- RuntimeConfig -- updated with the chosen batch size
+        Return:
+            int, list<(int, float)> -- the best batch size, (batch size, samples per second) of each candidate
+        '''
+        from benchmark import Benchmark
+
+        results = []
+        optimizer = torch.optim.SGD(model.parameters(), lr=0)      # lr 0: the weights do not change during tuning
+        for batch_size in candidates:
+            X = torch.rand(batch_size, *shape)
+            def step():
+                if train:
+                    model.train()
+                    loss = model(X).float().pow(2).mean()
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+                else:
+                    model.eval()
+                    with torch.no_grad():
+                        model(X)
+            mean, _ = Benchmark.timeit(step, repeat, warmup=1)
+            results.append((batch_size, batch_size / mean * 1000))
+        best, throughput = max(results, key=lambda r: r[1])
+        if config is not None:
+            config.batch_size, config.samples_per_second = best, round(throughput, 1)
+        return best, results
+
+    @staticmethod
+    def metadata(config: RuntimeConfig, filename: str = None, **extra):
+        '''the run metadata, in the same key = value format as the data log of GenerateData
+        Args:
+            filename -- str -- write to this file, eg. {output}.runtime.txt, otherwise only return the lines
+            extra    -- any other key values of the run, eg. the dataset
+        '''
+        info = {'host': platform.node(), 'processor': platform.processor() or platform.machine(), 'cpu count': os.cpu_count(),
+                'torch': torch.__version__, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        info.update({key.replace('_', ' '): value for key, value in asdict(config).items()})
+        info.update(extra)
+        lines = [f'{key:<20}= {value}' for key, value in info.items()]
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+        return lines
+
+
+if __name__ == '__main__':
+
+    # python runtime.py 3
+
+    import sys
+    from deepleaning_models import NetTranslation4
+
+    config = Runtime.apply(Runtime.plan(int(sys.argv[1]) if len(sys.argv) > 1 else 3))
+    best, results = Runtime.autotune_batch_size(NetTranslation4(), config=config)
+    for batch_size, throughput in results:
+        print(f'batch size = {batch_size:<4} {throughput:8.1f} samples/s')
+    print('\n'.join(Runtime.metadata(config)))
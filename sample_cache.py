@@ -0,0 +1,108 @@
+'''
+A byte bounded cache of the decoded and normalized samples, in shared memory so that all the DataLoader workers share it
+'''
+
+import argparse
+import multiprocessing
+import time
+import numpy as np
+import torch
+
+
+class SampleCache:
+    '''Fixed size slots in one shared memory tensor, CLOCK eviction (an approximation of LRU: a hit sets the reference
+       bit of the slot, the hand clears the bits it passes and evicts the first slot without one).
+       All the state is in shared tensors created before the DataLoader starts its workers, the workers inherit them
+       (fork) or receive them through the torch shared memory pickling (spawn), one lock protects the slot tables
+    '''
+    def __init__(self, num_samples: int, max_bytes: int, shape: tuple, dtype=torch.float32):
+        '''
+        Args:
+            num_samples -- int         -- the size of the dataset
+            max_bytes   -- int         -- the budget of the cached tensors
+            shape       -- tuple       -- the shape of a cached tensor, eg. (1, 100, 100)
+            dtype       -- torch.dtype -- the dtype of a cached tensor
+        '''
+        slot_bytes = int(np.prod(shape)) * torch.tensor([], dtype=dtype).element_size()
+        self.num_slots = max(min(max_bytes // slot_bytes, num_samples), 1)
+        self.shape = tuple(shape)
+        self.data = torch.zeros((self.num_slots, *shape), dtype=dtype).share_memory_()
+        self.slot_of = torch.full((num_samples,), -1, dtype=torch.int64).share_memory_()   # sample -> slot
+        self.owner = torch.full((self.num_slots,), -1, dtype=torch.int64).share_memory_()  # slot -> sample
+        self.reference = torch.zeros(self.num_slots, dtype=torch.uint8).share_memory_()
+        self.hand = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()                  # hits, misses, evictions
+        self.lock = multiprocessing.get_context().Lock()
+
+    def get(self, idx: int):
+        '''a copy of the cached tensor of sample idx, or None
+        '''
+        with self.lock:
+            slot = int(self.slot_of[idx])
+            if slot < 0:
+                self.counters[1] += 1
+                return None
+            self.counters[0] += 1
+            self.reference[slot] = 1
+            return self.data[slot].clone()
+
+    def put(self, idx: int, tensor: torch.Tensor):
+        '''cache the tensor of sample idx, evicting with the CLOCK hand when there is no free slot
+        '''
+        with self.lock:
+            if self.slot_of[idx] >= 0:                   # another worker cached it meanwhile
+                return
+            hand = int(self.hand)
+            while self.reference[hand]:
+                self.reference[hand] = 0
+                hand = (hand + 1) % self.num_slots
+            old = int(self.owner[hand])
+            if old >= 0:
+                self.slot_of[old] = -1
+                self.counters[2] += 1
+            self.data[hand] = tensor
+            self.slot_of[idx] = hand
+            self.owner[hand] = idx
+            self.reference[hand] = 1
+            self.hand[0] = (hand + 1) % self.num_slots
+
+    def stats(self):
+        '''the counters of all the processes, to tune the budget
+        '''
+        hits, misses, evictions = (int(c) for c in self.counters)
+        return {'hits': hits, 'misses': misses, 'evictions': evictions, 'hit rate': hits / max(hits + misses, 1),
+                'cached': int((self.owner >= 0).sum()), 'slots': self.num_slots,
+                'bytes': self.data.numel() * self.data.element_size()}
+
+    def summary(self):
+        return ', '.join(f'{key} = {value:.3f}' if isinstance(value, float) else f'{key} = {value}' for key, value in self.stats().items())
+
+    def reset_stats(self):
+        self.counters.zero_()
+
+
+if __name__ == '__main__':
+
+    # python sample_cache.py -rd data/matrix-train51 -mb 512 -nw 3 -ep 3
+
+    from torch.utils.data import DataLoader
+    from dataset import open_dataset, tf, my_collate
+
+    parser = argparse.ArgumentParser(description='Epochs over a dataset with and without the shared sample cache')
+    parser.add_argument('-rd', '--root_dir', nargs=1, type=str, default=['data/matrix-train51'], help='the dataset')
+    parser.add_argument('-mb', '--cache_mb', nargs='+', type=float, default=[0, 256, 1024], help='the cache budgets in MB, 0 is no cache')
+    parser.add_argument('-nw', '--num_workers', nargs=1, type=int, default=[3], help='number of DataLoader workers')
+    parser.add_argument('-ep', '--num_epochs', nargs=1, type=int, default=[3], help='number of epochs')
+    parser.add_argument('-bs', '--batch_size', nargs=1, type=int, default=[32], help='the batch size')
+    args = parser.parse_args()
+
+    for cache_mb in args.cache_mb:
+        dataset = open_dataset(args.root_dir[0], tf, int(cache_mb * 2**20))
+        loader = DataLoader(dataset, batch_size=args.batch_size[0], shuffle=True, num_workers=args.num_workers[0], collate_fn=my_collate)
+        for epoch in range(args.num_epochs[0]):
+            start = time.perf_counter()
+            num = sum(len(batch['index']) for batch in loader)
+            report = '' if dataset.cache is None else dataset.cache.summary()
+            print(f'cache = {cache_mb:<6} MB, epoch {epoch}: {num / (time.perf_counter() - start):8.0f} samples/s  {report}')
+            if dataset.cache is not None:
+                dataset.cache.reset_stats()
@@ -0,0 +1,180 @@
+'''
+The statistics index of a generated dataset, written at generation time
+'''
+
+import os
+import glob
+import numpy as np
+
+
+class SampleIndex:
+    '''One row per sample: folder, sample, num_tx, min pairwise TX distance, and the offset of its TX locations
+       in one concatenated array of all the TX locations. Saved as {root_dir}.index.npz, next to the {root_dir}.txt log.
+       The rows are ordered by (folder, sample), the same order as the dataset index
+    '''
+    def __init__(self, folder=None, sample=None, targets=None):
+        '''
+        Args:
+            folder  -- np.ndarray       -- (n,) the folder of each sample, eg. 1 is 000001
+            sample  -- np.ndarray       -- (n,) the sample in the folder, eg. 0 is 0.npy
+            targets -- list<np.ndarray> -- the TX locations of each sample
+        '''
+        self.folders, self.samples, self.targets = [], [], []     # the rows added during generation
+        self.folder = np.zeros(0, dtype=np.int32) if folder is None else np.asarray(folder, dtype=np.int32)
+        self.sample = np.zeros(0, dtype=np.int32) if sample is None else np.asarray(sample, dtype=np.int32)
+        targets = [] if targets is None else targets
+        self.num_tx = np.array([len(t) for t in targets], dtype=np.int16)
+        self.offset = np.concatenate([[0], np.cumsum(self.num_tx, dtype=np.int64)])
+        self.location = np.concatenate(targets).reshape(-1, 2).astype(np.float32) if targets else np.zeros((0, 2), dtype=np.float32)
+        self.min_dist = np.array([SampleIndex.min_pairwise(t) for t in targets], dtype=np.float32)
+
+    def __len__(self):
+        return len(self.folder)
+
+    @staticmethod
+    def filename(root_dir: str):
+        return os.path.normpath(root_dir) + '.index.npz'
+
+    @staticmethod
+    def min_pairwise(targets: np.ndarray):
+        '''the min pairwise distance (cells) between the TX, inf if there is only one TX
+        '''
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 2)
+        if len(targets) < 2:
+            return np.inf
+        dist = np.sqrt(((targets[:, None, :] - targets[None, :, :]) ** 2).sum(axis=2))
+        return dist[np.triu_indices(len(targets), 1)].min()
+
+    def add(self, folder: int, sample: int, targets):
+        '''add one sample during generation, the arrays are built at save
+        '''
+        self.folders.append(folder)
+        self.samples.append(sample)
+        self.targets.append(np.asarray(targets, dtype=np.float32).reshape(-1, 2))
+
+    def save(self, root_dir: str):
+        if self.targets:                        # the rows of a loaded index and the added rows, in (folder, sample) order
+            folder = np.concatenate([self.folder, self.folders])
+            sample = np.concatenate([self.sample, self.samples])
+            targets = [self.target(i) for i in range(len(self))] + self.targets
+            order = np.lexsort((sample, folder))
+            self.__init__(folder[order], sample[order], [targets[i] for i in order])
+        np.savez(SampleIndex.filename(root_dir), folder=self.folder, sample=self.sample, num_tx=self.num_tx,
+                 min_dist=self.min_dist, offset=self.offset, location=self.location)
+
+    @classmethod
+    def load(cls, root_dir: str):
+        '''load the index of root_dir, if there is no index (an old dataset), build it from the target files and save it.
+           An empty dataset is not saved
+        '''
+        filename = SampleIndex.filename(root_dir)
+        if not os.path.exists(filename):
+            if not os.path.isdir(root_dir):
+                raise FileNotFoundError(f'no dataset at {root_dir}')
+            index = cls.build(root_dir)
+            if len(index):
+                index.save(root_dir)
+            return index
+        index = cls()
+        with np.load(filename) as data:
+            for key in ['folder', 'sample', 'num_tx', 'min_dist', 'offset', 'location']:
+                setattr(index, key, data[key])
+        return index
+
+    @classmethod
+    def build(cls, root_dir: str):
+        '''scan the .target.npy of an existing dataset
+        '''
+        folder, sample, targets = [], [], []
+        for path in sorted(glob.glob(os.path.join(root_dir, '*'))):
+            if not os.path.isdir(path):
+                continue
+            names = [os.path.basename(f) for f in glob.glob(os.path.join(path, '*.target.npy'))]
+            for i in sorted(int(name.split('.')[0]) for name in names):
+                folder.append(int(os.path.basename(path)))
+                sample.append(i)
+                targets.append(np.load(os.path.join(path, f'{i}.target.npy')).reshape(-1, 2))
+        return cls(folder, sample, targets)
+
+    def sample_per_label(self):
+        '''the # of samples of each folder, (max folder + 1,)
+        '''
+        return np.bincount(self.folder) if len(self) else np.zeros(0, dtype=np.int64)
+
+    def path(self, root_dir: str, idx: int):
+        '''the matrix file of the idx-th sample
+        '''
+        return os.path.join(root_dir, format(self.folder[idx], '06d'), f'{self.sample[idx]}.npy')
+
+    def target(self, idx: int):
+        '''the TX locations of the idx-th sample, without loading the .target.npy
+        '''
+        return self.location[self.offset[idx]:self.offset[idx + 1]]
+
+    def select(self, num_tx=None, min_dist: float = None, max_dist: float = None):
+        '''filter the samples
+        Args:
+            num_tx   -- int or list<int> -- keep the samples with these # of TX
+            min_dist -- float            -- keep the samples whose min pairwise TX distance >= min_dist
+            max_dist -- float            -- keep the samples whose min pairwise TX distance <= max_dist (1 TX samples are dropped)
+        Return:
+            np.ndarray -- the dataset indices
+        '''
+        keep = np.ones(len(self), dtype=bool)
+        if num_tx is not None:
+            keep &= np.isin(self.num_tx, np.atleast_1d(num_tx))
+        if min_dist is not None:
+            keep &= self.min_dist >= min_dist
+        if max_dist is not None:
+            keep &= self.min_dist <= max_dist
+        return np.flatnonzero(keep)
+
+    def strata(self, dist_bins=None):
+        '''the stratum of each sample, by num_tx and optionally by the bins of the min pairwise distance
+        Args:
+            dist_bins -- list<float> -- eg. [5, 10, 20], the edges of the distance bins
+        Return:
+            np.ndarray -- (n,) the stratum id
+        '''
+        stratum = self.num_tx.astype(np.int64)
+        if dist_bins is not None:
+            stratum = stratum * (len(dist_bins) + 1) + np.digitize(self.min_dist, dist_bins)
+        return np.unique(stratum, return_inverse=True)[1]
+
+    def stratified(self, num: int, dist_bins=None, seed: int = 0, indices=None):
+        '''a subset with the same # of samples from each stratum (or all of a stratum if it is smaller)
+        Args:
+            num       -- int         -- samples per stratum
+            dist_bins -- list<float> -- see strata
+            indices   -- np.ndarray  -- stratify within these indices, eg. the output of select
+        Return:
+            np.ndarray -- the sorted dataset indices
+        '''
+        rng = np.random.default_rng(seed)
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        stratum = self.strata(dist_bins)[indices]
+        chosen = [rng.permutation(indices[stratum == s])[:num] for s in np.unique(stratum)]
+        return np.sort(np.concatenate(chosen)) if chosen else indices[:0]
+
+    def summary(self, dist_bins=(5, 10, 20, 40)):
+        '''# of samples by num_tx and by min pairwise distance bins
+        '''
+        ntx, count = np.unique(self.num_tx, return_counts=True)
+        lines = [f'{len(self)} samples']
+        lines += [f'{"num_tx = " + str(n):<18} {c:>8}' for n, c in zip(ntx, count)]
+        edges = [0] + list(dist_bins) + [np.inf]
+        multi = self.min_dist[np.isfinite(self.min_dist)]
+        hist, _ = np.histogram(multi, edges)
+        lines += [f'{f"min dist [{low}, {high})":<18} {c:>8}' for low, high, c in zip(edges[:-1], edges[1:], hist)]
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    # python sample_index.py data/matrix-train51
+
+    import sys
+
+    for root_dir in sys.argv[1:]:
+        print(root_dir)
+        print(SampleIndex.load(root_dir).summary())
@@ -0,0 +1,131 @@
+'''
+Stratified and curriculum batch samplers driven by the SampleIndex (num_tx and the min pairwise TX distance)
+'''
+
+import math
+import numpy as np
+from torch.utils.data import Sampler
+from sample_index import SampleIndex
+
+
+class Proportional:
+    '''the natural frequency of the strata, the same as a plain shuffle in expectation
+    '''
+    def __call__(self, epoch: int, difficulty: np.ndarray, count: np.ndarray):
+        return count / count.sum()
+
+
+class Uniform:
+    '''every stratum equally, so the rare strata (eg. close by TX) are over sampled
+    '''
+    def __call__(self, epoch: int, difficulty: np.ndarray, count: np.ndarray):
+        return np.ones(len(count)) / len(count)
+
+
+class Curriculum:
+    '''from easy (few and far apart TX) to hard (many and close by TX).
+       The weight of a stratum is exp(-temperature * difficulty * (1 - progress)), progress goes from 0 to 1 in warmup epochs,
+       after that the strata are sampled uniformly
+    '''
+    def __init__(self, warmup: int = 5, temperature: float = 4):
+        '''
+        Args:
+            warmup      -- int   -- number of epochs from the easy strata to all the strata
+            temperature -- float -- how much the hard strata are down weighted at epoch 0
+        '''
+        self.warmup = warmup
+        self.temperature = temperature
+
+    def __call__(self, epoch: int, difficulty: np.ndarray, count: np.ndarray):
+        progress = min(epoch / self.warmup, 1) if self.warmup > 0 else 1
+        weight = np.exp(-self.temperature * difficulty * (1 - progress))
+        return weight / weight.sum()
+
+
+class StratifiedBatchSampler(Sampler):
+    '''A batch sampler (DataLoader(batch_sampler=...)): each slot of a batch draws a stratum from the schedule weights,
+       then the next sample of that stratum. Every stratum is a shuffled queue that is reshuffled when it runs out,
+       so a batch costs O(batch_size) and no sample file is read. The queues are rebuilt at every epoch, so the batches
+       of an epoch depend only on (seed, epoch). The batches are drawn in the main process and only
+       the indices go to the workers, so it works with any num_workers
+    '''
+    def __init__(self, index: SampleIndex, batch_size: int, schedule=None, dist_bins=(5, 10, 20), indices=None,
+                 num_batches: int = None, seed: int = 0):
+        '''
+        Args:
+            index       -- SampleIndex   -- eg. dataset.index
+            batch_size  -- int           -- batch size
+            schedule    -- callable      -- (epoch, difficulty, count) -> the weight of each stratum, by default Uniform()
+            dist_bins   -- tuple<float>  -- the edges of the min pairwise distance bins
+            indices     -- np.ndarray    -- only sample from these dataset indices, eg. index.select(...)
+            num_batches -- int           -- batches per epoch, by default one pass over the samples
+            seed        -- int           -- random seed, the stream of an epoch is seeded by (seed, epoch)
+        '''
+        self.batch_size = batch_size
+        self.schedule = Uniform() if schedule is None else schedule
+        self.seed = seed
+        self.epoch = 0
+        indices = np.arange(len(index)) if indices is None else np.asarray(indices)
+        self.num_batches = math.ceil(len(indices) / batch_size) if num_batches is None else num_batches
+
+        num_tx = index.num_tx[indices].astype(np.int64)
+        bins = np.digitize(index.min_dist[indices], dist_bins)       # 1 TX samples (inf) fall in the last bin
+        key = num_tx * (len(dist_bins) + 1) + bins
+        keys, stratum, self.count = np.unique(key, return_inverse=True, return_counts=True)
+        order = np.argsort(stratum, kind='stable')
+        self.members = np.split(indices[order], np.cumsum(self.count)[:-1])
+        self.difficulty = StratifiedBatchSampler.difficulty(keys // (len(dist_bins) + 1), keys % (len(dist_bins) + 1), len(dist_bins))
+
+    @staticmethod
+    def difficulty(num_tx: np.ndarray, bins: np.ndarray, num_bins: int):
+        '''in [0, 1], half from the # of TX and half from how close the TX are
+        '''
+        ntx = (num_tx - num_tx.min()) / max(num_tx.max() - num_tx.min(), 1)
+        close = (num_bins - bins) / max(num_bins, 1)
+        return 0.5 * ntx + 0.5 * close
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def weights(self):
+        '''the stratum weights of the current epoch
+        '''
+        weight = np.asarray(self.schedule(self.epoch, self.difficulty, self.count), dtype=np.float64)
+        return weight / weight.sum()
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        weight = self.weights()
+        queues, positions = [None] * len(self.members), np.zeros(len(self.members), dtype=int)
+        for _ in range(self.num_batches):
+            slots = np.bincount(rng.choice(len(weight), self.batch_size, p=weight), minlength=len(weight))
+            batch = []
+            for s in np.flatnonzero(slots):
+                batch.extend(self.take(s, slots[s], rng, queues, positions))
+            yield [int(i) for i in rng.permutation(batch)]
+        self.epoch += 1
+
+    def take(self, s: int, num: int, rng, queues: list, positions: np.ndarray):
+        '''the next num samples of stratum s
+        Args:
+            queues    -- list<np.ndarray> -- the shuffled queue of each stratum in this epoch, None until it is used
+            positions -- np.ndarray       -- the next position in each queue
+        '''
+        taken = []
+        while num > 0:
+            if queues[s] is None or positions[s] == len(queues[s]):
+                queues[s] = rng.permutation(self.members[s])
+                positions[s] = 0
+            step = min(num, len(queues[s]) - positions[s])
+            taken.append(queues[s][positions[s]:positions[s] + step])
+            positions[s] += step
+            num -= step
+        return np.concatenate(taken)
+
+    def summary(self):
+        '''the share of each stratum in the current epoch
+        '''
+        return [(int(c), round(float(d), 2), round(float(w), 3)) for c, d, w in zip(self.count, self.difficulty, self.weights())]
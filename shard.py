@@ -0,0 +1,270 @@
+'''
+Compressed chunked dataset shards: the matrices of consecutive samples are compressed together in chunks,
+the chunks are appended to a few shard files, and a chunk index gives the shard, offset and length of every chunk
+'''
+
+import argparse
+import os
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sample_index import SampleIndex
+
+
+class Codec:
+    '''zlib is always available, zstd (pip install zstandard) and lz4 (pip install lz4) are optional
+    '''
+    @staticmethod
+    def compress(codec: str, data: bytes, level: int = None):
+        if codec == 'zlib':
+            return zlib.compress(data, 6 if level is None else level)
+        if codec == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+        if codec == 'lz4':
+            import lz4.frame
+            return lz4.frame.compress(data, compression_level=0 if level is None else level)
+        if codec == 'none':
+            return data
+        raise ValueError(f'unknown codec {codec}')
+
+    @staticmethod
+    def decompress(codec: str, data: bytes):
+        if codec == 'zlib':
+            return zlib.decompress(data)
+        if codec == 'zstd':
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(data)
+        if codec == 'lz4':
+            import lz4.frame
+            return lz4.frame.decompress(data)
+        if codec == 'none':
+            return data
+        raise ValueError(f'unknown codec {codec}')
+
+
+class ShardWriter:
+    '''convert a dataset generated by generate.py into shards
+       output/shard-00000.bin ...  the compressed chunks
+       output/chunks.npz           the chunk index: shard, offset, length, first sample, # of samples, dtype, shape, codec
+       output.index.npz            the SampleIndex of the dataset (num_tx, min distance, TX locations)
+    '''
+    @staticmethod
+    def convert(root_dir: str, output: str, chunk_size: int = 64, shard_bytes: int = 1 << 30, codec: str = 'zlib',
+                level: int = None, num_threads: int = 4):
+        '''
+        Args:
+            root_dir    -- str -- the dataset generated by generate.py
+            output      -- str -- the shard directory
+            chunk_size  -- int -- samples per chunk, the unit of compression and of random access
+            shard_bytes -- int -- a new shard file is started after this many compressed bytes
+            codec       -- str -- zlib, zstd, lz4 or none
+            num_threads -- int -- the chunks are compressed in parallel (the codecs release the GIL)
+        Return:
+            float -- the compression ratio
+        '''
+        from utility import Utility
+
+        index = SampleIndex.load(root_dir)
+        Utility.remove_make(output)
+        first = np.arange(0, len(index), chunk_size)
+        sample = np.load(index.path(root_dir, 0))
+        dtype, shape = sample.dtype, sample.shape
+
+        def compress(start):
+            stop = min(start + chunk_size, len(index))
+            matrices = np.stack([np.load(index.path(root_dir, i)) for i in range(start, stop)]).astype(dtype, copy=False)
+            return Codec.compress(codec, matrices.tobytes(), level)
+
+        shard, offset, length = np.zeros(len(first), dtype=np.int32), np.zeros(len(first), dtype=np.int64), np.zeros(len(first), dtype=np.int64)
+        current, position, raw, f = 0, 0, 0, open(os.path.join(output, 'shard-00000.bin'), 'wb')
+        with ThreadPoolExecutor(num_threads) as executor:
+            for i, data in enumerate(executor.map(compress, first)):       # in order, compressed ahead by the pool
+                if position > 0 and position + len(data) > shard_bytes:
+                    f.close()
+                    current, position = current + 1, 0
+                    f = open(os.path.join(output, f'shard-{current:05d}.bin'), 'wb')
+                f.write(data)
+                shard[i], offset[i], length[i] = current, position, len(data)
+                position += len(data)
+                raw += min(chunk_size, len(index) - first[i]) * sample.nbytes
+        f.close()
+        np.savez(os.path.join(output, 'chunks.npz'), shard=shard, offset=offset, length=length, first=first,
+                 count=np.diff(np.append(first, len(index))), dtype=str(dtype), shape=np.array(shape), codec=codec)
+        index.save(output)
+        return raw / max(length.sum(), 1)
+
+
+class ChunkCache:
+    '''a bounded LRU cache of the decompressed chunks, by bytes. Each DataLoader worker has its own
+    '''
+    def __init__(self, max_bytes: int = 256 << 20):
+        self.max_bytes = max_bytes
+        self.chunks = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.chunks.move_to_end(key)
+        return chunk
+
+    def put(self, key, chunk: np.ndarray):
+        self.chunks[key] = chunk
+        self.bytes += chunk.nbytes
+        while self.bytes > self.max_bytes and len(self.chunks) > 1:
+            _, old = self.chunks.popitem(last=False)
+            self.bytes -= old.nbytes
+
+
+class ShardReader:
+    '''random access to the matrices of the shards, the chunk of a sample is read with one pread and decompressed
+       once, then the other samples of the chunk come from the cache
+    '''
+    def __init__(self, root_dir: str, cache_bytes: int = 256 << 20):
+        self.root_dir = root_dir
+        with np.load(os.path.join(root_dir, 'chunks.npz')) as data:
+            self.shard, self.offset, self.length = data['shard'], data['offset'], data['length']
+            self.first, self.count = data['first'], data['count']
+            self.dtype, self.shape, self.codec = np.dtype(str(data['dtype'])), tuple(data['shape']), str(data['codec'])
+        self.chunk_size = int(self.count[0]) if len(self.count) else 1
+        self.cache = ChunkCache(cache_bytes)
+        self.files = {}
+        self.pid = None
+
+    def __getstate__(self):
+        '''the file descriptors and the cache are not shared with the DataLoader workers
+        '''
+        state = self.__dict__.copy()
+        state['files'], state['pid'], state['cache'] = {}, None, ChunkCache(self.cache.max_bytes)
+        return state
+
+    def fd(self, shard: int):
+        if self.pid != os.getpid():                     # forked into a DataLoader worker: open the files again
+            self.files, self.pid = {}, os.getpid()
+        if shard not in self.files:
+            self.files[shard] = os.open(os.path.join(self.root_dir, f'shard-{shard:05d}.bin'), os.O_RDONLY)
+        return self.files[shard]
+
+    def chunk(self, c: int):
+        '''the decompressed matrices of chunk c, (count, *shape)
+        '''
+        chunk = self.cache.get(c)
+        if chunk is None:
+            data = os.pread(self.fd(self.shard[c]), int(self.length[c]), int(self.offset[c]))
+            chunk = np.frombuffer(Codec.decompress(self.codec, data), dtype=self.dtype).reshape(-1, *self.shape)
+            self.cache.put(c, chunk)
+        return chunk
+
+    def __getitem__(self, idx: int):
+        c = idx // self.chunk_size
+        return self.chunk(c)[idx - self.first[c]].copy()
+
+    def close(self):
+        for fd in self.files.values():
+            os.close(fd)
+        self.files = {}
+
+
+class ChunkBatchSampler:
+    '''Shuffle with locality: the chunks are shuffled and dealt to the DataLoader workers, each worker mixes the samples
+       of window chunks at a time. The DataLoader hands the batches to the workers round robin, so the batches are
+       interleaved in the same order and every chunk is decompressed once per epoch by one worker
+    '''
+    def __init__(self, reader: ShardReader, batch_size: int, num_workers: int = 0, window: int = 4, indices=None, seed: int = 0):
+        '''
+        Args:
+            window  -- int        -- number of chunks shuffled together, the cache of a worker should hold window chunks
+            indices -- np.ndarray -- only these samples, eg. SampleIndex.select(...)
+        '''
+        self.first, self.count = reader.first, reader.count
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.window = window
+        self.indices = None if indices is None else np.sort(indices)
+        self.selected = self.count if indices is None else \
+                        np.searchsorted(self.indices, self.first + self.count) - np.searchsorted(self.indices, self.first)  # samples of each chunk
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        '''the batches of this epoch: a worker yields full batches, and one partial batch at the end of its chunks
+        '''
+        chunks = np.random.default_rng((self.seed, self.epoch)).permutation(len(self.first))
+        return sum(int(np.ceil(self.selected[chunks[w::self.num_workers]].sum() / self.batch_size)) for w in range(self.num_workers))
+
+    def stream(self, chunks, rng):
+        '''the batches of one worker, the remainder of a window is carried into the next window
+        '''
+        carry = np.zeros(0, dtype=np.int64)
+        for w in range(0, len(chunks), self.window):
+            samples = np.concatenate([np.arange(self.first[c], self.first[c] + self.count[c]) for c in chunks[w:w + self.window]])
+            if self.indices is not None:
+                samples = samples[np.isin(samples, self.indices)]
+            samples = np.concatenate([carry, rng.permutation(samples)])
+            full = len(samples) // self.batch_size * self.batch_size
+            for b in range(0, full, self.batch_size):
+                yield [int(i) for i in samples[b:b + self.batch_size]]
+            carry = samples[full:]
+        if len(carry):
+            yield [int(i) for i in carry]
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        chunks = rng.permutation(len(self.first))
+        streams = [self.stream(chunks[w::self.num_workers], rng) for w in range(self.num_workers)]
+        while streams:
+            alive = []
+            for stream in streams:
+                batch = next(stream, None)
+                if batch is not None:
+                    yield batch
+                    alive.append(stream)
+            streams = alive
+        self.epoch += 1
+
+
+if __name__ == '__main__':
+
+    # python shard.py -rd data/matrix-train51 -o data/matrix-train51.shards -cs 64 -co zlib
+
+    from torch.utils.data import DataLoader
+    from dataset import SensorInputDatasetShards, tf, my_collate
+
+    parser = argparse.ArgumentParser(description='Convert a dataset into compressed chunked shards')
+    parser.add_argument('-rd', '--root_dir', nargs=1, type=str, default=['data/matrix-train51'], help='the dataset generated by generate.py')
+    parser.add_argument('-o', '--output', nargs=1, type=str, default=[None], help='the shard directory, by default {root_dir}.shards')
+    parser.add_argument('-cs', '--chunk_size', nargs=1, type=int, default=[64], help='samples per chunk')
+    parser.add_argument('-sb', '--shard_bytes', nargs=1, type=int, default=[1 << 30], help='max bytes of a shard file')
+    parser.add_argument('-co', '--codec', nargs=1, type=str, default=['zlib'], choices=['zlib', 'zstd', 'lz4', 'none'])
+    parser.add_argument('-le', '--level', nargs=1, type=int, default=[None], help='compression level')
+    parser.add_argument('-nw', '--num_workers', nargs=1, type=int, default=[3], help='DataLoader workers of the read benchmark')
+    args = parser.parse_args()
+
+    output = args.output[0] or os.path.normpath(args.root_dir[0]) + '.shards'
+    start = time.perf_counter()
+    ratio = ShardWriter.convert(args.root_dir[0], output, args.chunk_size[0], args.shard_bytes[0], args.codec[0], args.level[0])
+    size = sum(os.path.getsize(os.path.join(output, f)) for f in os.listdir(output))
+    print(f'{output}: {size / 2**20:.1f} MB, compression ratio = {ratio:.1f}, {time.perf_counter() - start:.1f} s')
+
+    for name, dataset in [('files', None), ('shards', SensorInputDatasetShards(output, tf))]:
+        if dataset is None:
+            from dataset import SensorInputDatasetTranslation
+            dataset = SensorInputDatasetTranslation(args.root_dir[0], tf)
+            loader = DataLoader(dataset, batch_size=32, shuffle=True, num_workers=args.num_workers[0], collate_fn=my_collate)
+        else:
+            sampler = ChunkBatchSampler(dataset.reader, 32, args.num_workers[0])
+            loader = DataLoader(dataset, batch_sampler=sampler, num_workers=args.num_workers[0], collate_fn=my_collate)
+        start = time.perf_counter()
+        num = sum(len(batch['index']) for batch in loader)
+        print(f'{name:<8} {num / (time.perf_counter() - start):8.0f} samples/s')
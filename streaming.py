@@ -0,0 +1,230 @@
+'''
+Incremental localization for streaming sensor snapshots
+'''
+
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from input_output import Default
+from utility import Utility
+from tiling import TiledInference
+
+
+class IncrementalLocalizer:
+    '''Localization of a time series of sensor readings where only a few sensors change between snapshots.
+       1. only the receptive field of the changed sensors is recomputed: the output within R (the receptive radius) of a
+          changed sensor is dirty, and it is recomputed from an input crop with another R of margin, so it is exact
+       2. the peak mask of the previous window size is kept, and it is only recomputed around the dirty output.
+          If the # of peaks at this size is unchanged, the previous window size is reused, otherwise a full detect_peak runs
+       3. the peaks are associated with the previous peaks to update the TX tracks
+    '''
+    def __init__(self, model: nn.Module, sensors: np.ndarray, grid_shape: tuple = (Default.grid_length, Default.grid_length),
+                 num_tx: int = 1, threshold: float = 0.05, tolerance: float = 0.01, full_ratio: float = 0.5, gate: float = 5, device=None):
+        '''
+        Args:
+            model      -- nn.Module  -- a fully convolutional model, eg. NetTranslation4
+            sensors    -- SensorArray -- eg. GenerateSensors.load(sensor_file)
+            grid_shape -- tuple      -- (height, width)
+            num_tx     -- int        -- number of TX, could be updated at each frame
+            threshold  -- float      -- threshold for non-tx areas in the peak detection
+            tolerance  -- float      -- a reading changing less than tolerance dB is not a change
+            full_ratio -- float      -- do a full forward when the crops cover more than this ratio of the grid
+            gate       -- float      -- max distance (cells) for a peak to continue a track
+        '''
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
+        self.model = model.to(device).eval()
+        self.radius = TiledInference.receptive_radius(model)
+        self.sensors = sensors
+        self.grid_shape = grid_shape
+        self.num_tx = num_tx
+        self.threshold = threshold
+        self.tolerance = tolerance
+        self.full_ratio = full_ratio
+        self.gate = gate
+        self.readings = None
+        self.matrix = None          # normalized input
+        self.output = None          # model output, thresholded like detect_peak does
+        self.peak_size = None
+        self.peak_mask = None
+        self.peak_count = None      # the # of peaks when detect_peak chose peak_size
+        self.tracks = {}
+        self.next_track = 0
+        self.frame = 0
+        self.fallback = 0           # number of frames that needed a full detect_peak
+
+    def normalize(self, readings: np.ndarray):
+        '''the sensor readings (dB) into a normalized input matrix, same as UniformNormalize
+        '''
+        matrix = np.full(self.grid_shape, Default.noise_floor, dtype=np.float32)
+        matrix[self.sensors.x, self.sensors.y] = readings
+        matrix -= Default.noise_floor
+        matrix /= (-Default.noise_floor/2)
+        return matrix
+
+    def forward(self, matrix: np.ndarray):
+        with torch.no_grad():
+            X = torch.as_tensor(matrix, device=self.device).unsqueeze(0).unsqueeze(0)
+            return self.model(X)[0, 0].data.cpu().numpy()
+
+    @staticmethod
+    def peak_mask(image: np.ndarray, size: int, threshold: float):
+        '''the peak mask of one window size, the same as the detect_helper of Utility.detect_peak.
+           the square neighborhood is separable, so the maximum filter and the erosion (a minimum filter with the
+           border being background) run as 1D filters
+        '''
+        from scipy.ndimage import maximum_filter, minimum_filter
+
+        local_max = maximum_filter(image, size=size) == image
+        eroded_background = minimum_filter(image < threshold, size=size, mode='constant', cval=1)
+        return local_max ^ eroded_background
+
+    @staticmethod
+    def expand(box: tuple, margin: int, shape: tuple):
+        '''expand a box (tuple of two slices) by margin, clipped by the grid
+        '''
+        return tuple(slice(max(s.start - margin, 0), min(s.stop + margin, length)) for s, length in zip(box, shape))
+
+    def reset(self, readings: np.ndarray, num_tx: int = None):
+        '''full forward and full peak detection, for the first frame
+        '''
+        start = time.perf_counter()
+        self.readings = np.array(readings, dtype=np.float32)
+        self.matrix = self.normalize(self.readings)
+        self.output = self.forward(self.matrix)
+        self.output[self.output < self.threshold] = 0
+        return self.finish(num_tx, [], start, np.prod(self.grid_shape))
+
+    def update(self, readings: np.ndarray, num_tx: int = None):
+        '''
+        Args:
+            readings -- np.ndarray -- (n,) the new RSSI (dB) of every sensor
+            num_tx   -- int        -- number of TX, by default the previous one
+        Return:
+            dict -- frame, peaks, tracks {id: (x, y)}, latency (ms), recomputed (# of output cells recomputed)
+        '''
+        from scipy.ndimage import maximum_filter, label, find_objects
+
+        if self.readings is None:
+            return self.reset(readings, num_tx)
+        start = time.perf_counter()
+        readings = np.asarray(readings, dtype=np.float32)
+        changed = np.abs(readings - self.readings) > self.tolerance
+        self.readings[changed] = readings[changed]
+        self.matrix = self.normalize(self.readings)
+        if not changed.any():
+            return self.finish(num_tx, [], start, 0)
+
+        # 1 the dirty output: within the receptive radius of the changed sensors
+        mask = np.zeros(self.grid_shape, dtype=bool)
+        mask[self.sensors.x[changed], self.sensors.y[changed]] = True
+        dirty = maximum_filter(mask, size=2 * self.radius + 1, mode='constant')
+        boxes = find_objects(label(dirty)[0])
+        crops = [IncrementalLocalizer.expand(box, self.radius, self.grid_shape) for box in boxes]
+        area = sum((c[0].stop - c[0].start) * (c[1].stop - c[1].start) for c in crops)
+        if area > self.full_ratio * np.prod(self.grid_shape):
+            output = self.forward(self.matrix)
+            boxes = [(slice(0, self.grid_shape[0]), slice(0, self.grid_shape[1]))]
+            recomputed = np.prod(self.grid_shape)
+        else:
+            output = self.output
+            recomputed = 0
+            for box, crop in zip(boxes, crops):
+                pred = self.forward(self.matrix[crop])
+                inner = tuple(slice(b.start - c.start, b.stop - c.start) for b, c in zip(box, crop))
+                output[box] = pred[inner]
+                recomputed += (box[0].stop - box[0].start) * (box[1].stop - box[1].start)
+        output[output < self.threshold] = 0
+        self.output = output
+        return self.finish(num_tx, boxes, start, recomputed)
+
+    def finish(self, num_tx: int, boxes: list, start: float, recomputed: int):
+        '''update the peaks around the dirty boxes, then the tracks
+        '''
+        if num_tx is not None and num_tx != self.num_tx:
+            self.num_tx = num_tx
+            self.peak_size = None
+        if self.peak_size is not None:
+            half = self.peak_size // 2 + 1
+            for box in boxes:
+                region = IncrementalLocalizer.expand(box, half, self.grid_shape)
+                crop = IncrementalLocalizer.expand(region, self.peak_size, self.grid_shape)
+                mask = IncrementalLocalizer.peak_mask(self.output[crop], self.peak_size, self.threshold)
+                inner = tuple(slice(r.start - c.start, r.stop - c.start) for r, c in zip(region, crop))
+                self.peak_mask[region] = mask[inner]
+        if self.peak_size is None or self.peak_mask.sum() != self.peak_count:
+            self.fallback += 1
+            _, self.peak_size = Utility.detect_peak(self.output.copy(), self.num_tx, self.threshold)
+            self.peak_mask = IncrementalLocalizer.peak_mask(self.output, self.peak_size, self.threshold)
+            self.peak_count = self.peak_mask.sum()
+        peaks = [(x, y) for x, y in zip(*np.where(self.peak_mask))]
+        self.associate(peaks)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        latency = (time.perf_counter() - start) * 1000
+        self.frame += 1
+        return {'frame': self.frame - 1, 'peaks': peaks, 'tracks': dict(self.tracks), 'latency': latency, 'recomputed': recomputed}
+
+    def associate(self, peaks: list):
+        '''greedy nearest neighbor association of the peaks to the tracks of the previous frame
+        '''
+        ids = list(self.tracks.keys())
+        distances = np.full((len(ids), len(peaks)), np.inf)
+        for i, track in enumerate(ids):
+            for j, peak in enumerate(peaks):
+                distances[i, j] = Utility.distance(self.tracks[track], peak)
+        tracks = {}
+        while distances.size > 0 and np.min(distances) <= self.gate:
+            i, j = np.unravel_index(np.argmin(distances), distances.shape)
+            tracks[ids[i]] = peaks[j]
+            distances[i, :] = np.inf
+            distances[:, j] = np.inf
+        matched = set(tracks.values())
+        for peak in peaks:
+            if peak not in matched:
+                tracks[self.next_track] = peak
+                self.next_track += 1
+        self.tracks = tracks
+
+
+if __name__ == '__main__':
+
+    # python streaming.py -m model/model1-11.10.pt -fr 50 -ch 5
+
+    from deepleaning_models import NetTranslation4
+    from generate import GenerateSensors
+    from propagation import Propagation
+
+    parser = argparse.ArgumentParser(description='Incremental localization of a stream of snapshots')
+    parser.add_argument('-m', '--model', nargs=1, type=str, default=['model/model1-11.10.pt'], help='state dict of NetTranslation4')
+    parser.add_argument('-sf', '--sensor_file', nargs=1, type=str, default=['data/sensors/100-500'], help='sensor location file')
+    parser.add_argument('-fr', '--frames', nargs=1, type=int, default=[50], help='number of frames')
+    parser.add_argument('-ch', '--changes', nargs=1, type=int, default=[5], help='number of sensors changing per frame')
+    args = parser.parse_args()
+
+    net = NetTranslation4()
+    net.load_state_dict(torch.load(args.model[0], map_location='cpu'))
+    sensors = GenerateSensors.load(args.sensor_file[0])
+    propagation = Propagation()
+    tx = np.array([30.5, 40.5])
+    readings = np.maximum(Default.power - propagation.pathloss_vector(sensors.distance(tx) * Default.cell_length), Default.noise_floor)
+    incremental = IncrementalLocalizer(net, sensors, num_tx=1)
+    incremental.update(readings)
+    latency_incremental, latency_full = [], []
+    for _ in range(args.frames[0]):
+        readings = readings.copy()
+        change = np.random.choice(len(sensors), args.changes[0], replace=False)
+        readings[change] = np.maximum(readings[change] + np.random.normal(0, 2, len(change)), Default.noise_floor)
+        result = incremental.update(readings)
+        latency_incremental.append(result['latency'])
+        start = time.perf_counter()             # the full pipeline: full forward and detect_peak on every frame
+        output = incremental.forward(incremental.normalize(readings))
+        peaks, _ = Utility.detect_peak(output, 1, incremental.threshold)
+        latency_full.append((time.perf_counter() - start) * 1000)
+    print('tracks', result['tracks'])
+    print(f'incremental latency = {np.mean(latency_incremental):.2f} ms, full latency = {np.mean(latency_full):.2f} ms')
+    print('max output difference =', np.abs(incremental.output - output).max())
+    print(f'full peak detection in {incremental.fallback} of {incremental.frame} frames')
@@ -0,0 +1,184 @@
+'''
+Sliding window (tiled) inference for grids larger than the training grid
+'''
+
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from input_output import Default
+from utility import Utility
+
+
+class TiledInference:
+    '''Run a fully convolutional model of the NetTranslation family on a grid of any size.
+       The grid is split into overlapping tiles of size tile_length x tile_length, the tiles are batched through the model,
+       and only the core of each tile (the part that sees its whole receptive field) is stitched into the output.
+       Because the overlap equals the receptive field radius, the stitched output is the same as a full grid forward,
+       while the memory is bounded by batch_size tiles
+    '''
+    def __init__(self, model: nn.Module, tile_length: int = Default.grid_length, batch_size: int = 32, device=None):
+        '''
+        Args:
+            model       -- nn.Module -- a fully convolutional model, eg. NetTranslation, NetTranslation4
+            tile_length -- int       -- the length of a tile, by default the grid length the model is trained on
+            batch_size  -- int       -- number of tiles in one forward pass
+            device      -- torch.device -- by default cuda if available, otherwise cpu
+        '''
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
+        self.model = model.to(device)
+        self.model.eval()
+        self.halo = TiledInference.receptive_radius(model)
+        if tile_length <= 2 * self.halo:
+            raise ValueError(f'tile length {tile_length} should be larger than two times the receptive radius {self.halo}')
+        self.tile_length = tile_length
+        self.batch_size = batch_size
+
+    pointwise = (nn.ReLU, nn.LeakyReLU, nn.PReLU, nn.ELU, nn.GELU, nn.SiLU, nn.Sigmoid, nn.Tanh, nn.Identity,
+                 nn.Dropout, nn.Dropout2d)
+
+    @staticmethod
+    def receptive_radius(model: nn.Module):
+        '''the number of cells on each side that affect one output cell. Every layer should be a stride 1 convolution or
+           a pointwise layer (BatchNorm2d only in eval mode), other layers raise. The functional calls in forward are not
+           modules, so the radius is then verified by the impulse response of the model, see probe
+        Args:
+            model -- nn.Module -- should only have stride 1 convolution and pointwise layers
+        Return:
+            int
+        '''
+        radius = 0
+        for module in model.modules():
+            if next(module.children(), None) is not None:
+                continue
+            if isinstance(module, nn.Conv2d):
+                if module.stride != (1, 1):
+                    raise ValueError(f'{type(model).__name__} has a strided convolution')
+                radius += module.dilation[0] * (module.kernel_size[0] - 1) // 2
+            elif isinstance(module, nn.BatchNorm2d):
+                if module.training:
+                    raise ValueError(f'{type(model).__name__} has a BatchNorm2d in train mode, the batch statistics are not local')
+            elif not isinstance(module, TiledInference.pointwise):
+                raise ValueError(f'{type(model).__name__} has a {type(module).__name__}, which is not a stride 1 convolution or a pointwise layer')
+        TiledInference.probe(model, radius)
+        return radius
+
+    @staticmethod
+    def probe(model: nn.Module, radius: int, seed: int = 0):
+        '''raise if the output is not the size of the input, if a sample affects another sample of the batch,
+           or if an impulse at the center changes an output cell further than radius cells away
+        Args:
+            model  -- nn.Module -- the model
+            radius -- int       -- the receptive radius to verify
+        '''
+        parameter = next(model.parameters(), None)
+        device = parameter.device if parameter is not None else torch.device('cpu')
+        length = 4 * radius + 9
+        center = length // 2
+        generator = torch.Generator().manual_seed(seed)
+        base = torch.rand((1, 1, length, length), generator=generator)
+        impulse = base.clone()
+        impulse[0, 0, center, center] += 1
+        with torch.no_grad():
+            single = model(base.to(device)).cpu()
+            pair = model(torch.cat([base, impulse]).to(device)).cpu()
+        if pair.shape[-2:] != (length, length):
+            raise ValueError(f'{type(model).__name__} is not fully convolutional, the output is {tuple(pair.shape[-2:])} for an input of {(length, length)}')
+        if not torch.allclose(pair[0], single[0], atol=1e-5):
+            raise ValueError(f'{type(model).__name__} mixes the samples of a batch')
+        changed = (pair[1] - pair[0]).abs().amax(dim=0) > 1e-5
+        outside = torch.ones_like(changed)
+        outside[center - radius:center + radius + 1, center - radius:center + radius + 1] = False
+        if (changed & outside).any():
+            x, y = torch.nonzero(changed, as_tuple=True)
+            reach = int(max((x - center).abs().max(), (y - center).abs().max()))
+            raise ValueError(f'{type(model).__name__} has a receptive radius of at least {reach}, more than the {radius} of its layers')
+
+    @staticmethod
+    def spans(length: int, tile: int, halo: int):
+        '''split one axis into overlapping tiles
+        Args:
+            length -- int -- the length of the axis
+            tile   -- int -- the length of a tile
+            halo   -- int -- the receptive radius
+        Return:
+            list<(int, int, int)> -- (tile start, core start, core end), the core is in absolute coordinates
+        '''
+        if length <= tile:
+            return [(0, 0, length)]
+        spans = []
+        pos = 0
+        while pos < length:
+            start = min(max(pos - halo, 0), length - tile)
+            end = length if start + tile == length else start + tile - halo
+            spans.append((start, pos, end))
+            pos = end
+        return spans
+
+    def predict(self, matrix: np.ndarray):
+        '''the model output of a large grid
+        Args:
+            matrix -- np.ndarray -- (height, width), already normalized
+        Return:
+            np.ndarray -- (height, width)
+        '''
+        height, width = matrix.shape
+        tile_x = min(self.tile_length, height)
+        tile_y = min(self.tile_length, width)
+        spans_x = TiledInference.spans(height, tile_x, self.halo)
+        spans_y = TiledInference.spans(width, tile_y, self.halo)
+        tiles = [(sx, sy) for sx in spans_x for sy in spans_y]
+
+        X = torch.as_tensor(matrix, dtype=torch.float32, device=self.device)
+        output = np.zeros((height, width), dtype=np.float32)
+        with torch.no_grad():
+            for i in range(0, len(tiles), self.batch_size):
+                batch = tiles[i:i + self.batch_size]
+                inputs = torch.stack([X[sx[0]:sx[0] + tile_x, sy[0]:sy[0] + tile_y] for sx, sy in batch])
+                preds = self.model(inputs.unsqueeze(1)).data.cpu().numpy()
+                for pred, (sx, sy) in zip(preds, batch):
+                    x0, x1 = sx[1] - sx[0], sx[2] - sx[0]
+                    y0, y1 = sy[1] - sy[0], sy[2] - sy[0]
+                    output[sx[1]:sx[2], sy[1]:sy[2]] = pred[0, x0:x1, y0:y1]
+        return output
+
+    def localize(self, matrix: np.ndarray, num_tx: int, threshold: float = 0.05):
+        '''tiled forward, then one pass of peak detection over the stitched output
+        Args:
+            matrix    -- np.ndarray -- (height, width), already normalized
+            num_tx    -- int        -- number of TX
+            threshold -- float      -- threshold for non-tx areas
+        Return:
+            list<(int, int)>, int -- the peaks and the window size used by the peak detection
+        '''
+        output = self.predict(matrix)
+        return Utility.detect_peak(output, num_tx, threshold)
+
+
+if __name__ == '__main__':
+
+    # python tiling.py -m model/model1-11.10.pt -gl 1000 -bs 32
+
+    from deepleaning_models import NetTranslation4
+
+    parser = argparse.ArgumentParser(description='Tiled inference for large grids')
+    parser.add_argument('-m', '--model', nargs=1, type=str, default=[None], help='state dict of a NetTranslation4')
+    parser.add_argument('-gl', '--grid_length', nargs=1, type=int, default=[1000], help='the length of the large grid')
+    parser.add_argument('-tl', '--tile_length', nargs=1, type=int, default=[Default.grid_length], help='the length of a tile')
+    parser.add_argument('-bs', '--batch_size', nargs=1, type=int, default=[32], help='number of tiles in a batch')
+    args = parser.parse_args()
+
+    net = NetTranslation4()
+    if args.model[0] is not None:
+        net.load_state_dict(torch.load(args.model[0], map_location='cpu'))
+    tiled = TiledInference(net, args.tile_length[0], args.batch_size[0])
+    grid = np.random.uniform(0, 1, (args.grid_length[0], args.grid_length[0])).astype(np.float32)
+    start = time.time()
+    out = tiled.predict(grid)
+    print(f'tiled forward time = {time.time() - start:.3f}s')
+    with torch.no_grad():
+        full = tiled.model(torch.as_tensor(grid, device=tiled.device).unsqueeze(0).unsqueeze(0)).data.cpu().numpy()[0, 0]
+    print('max difference to full forward =', np.abs(out - full).max())
@@ -0,0 +1,210 @@
+'''
+Multi frame TX tracking on top of the detect_peak outputs
+'''
+
+import argparse
+import time
+import numpy as np
+from input_output import Default
+
+
+class Tracker:
+    '''Multiple TX tracking with a constant velocity Kalman filter.
+       All the tracks are kept in arrays, the predict and the update are vectorized over the tracks,
+       and the association of the tracks and the detections of a frame is one batched assignment over the gated pairs
+    '''
+    def __init__(self, gate: float = 5, process_noise: float = 0.1, measurement_noise: float = 1, min_hits: int = 3, max_missed: int = 3):
+        '''
+        Args:
+            gate              -- float -- max distance (cells) between a predicted track and a detection
+            process_noise     -- float -- std of the acceleration, cells per frame^2
+            measurement_noise -- float -- std of the detect_peak localization error, cells
+            min_hits          -- int   -- a track is confirmed after min_hits detections
+            max_missed        -- int   -- a track is deleted after max_missed frames without detection
+        '''
+        self.gate = gate
+        self.min_hits = min_hits
+        self.max_missed = max_missed
+        self.F = np.array([[1, 0, 1, 0], [0, 1, 0, 1], [0, 0, 1, 0], [0, 0, 0, 1]], dtype=float)   # state is (x, y, vx, vy)
+        self.H = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], dtype=float)
+        G = np.array([[0.5, 0], [0, 0.5], [1, 0], [0, 1]])
+        self.Q = G @ G.T * process_noise ** 2
+        self.R = np.eye(2) * measurement_noise ** 2
+        self.state = np.zeros((0, 4))
+        self.covariance = np.zeros((0, 4, 4))
+        self.ids = np.zeros(0, dtype=int)
+        self.hits = np.zeros(0, dtype=int)
+        self.missed = np.zeros(0, dtype=int)
+        self.next_id = 0
+
+    def predict(self):
+        '''constant velocity prediction of all the tracks
+        '''
+        self.state = self.state @ self.F.T
+        self.covariance = np.einsum('ij,njk,lk->nil', self.F, self.covariance, self.F) + self.Q
+
+    def associate(self, detections: np.ndarray):
+        '''the gated pairs come from a KD tree, the bipartite graph of the gated pairs is split into connected components.
+           a component with one track and one detection is matched directly (vectorized), the other components are
+           solved by the Hungarian algorithm. So the cost grows with the # of tracks instead of its square
+        Args:
+            detections -- np.ndarray -- n = 2
+        Return:
+            np.ndarray, np.ndarray -- the matched track index and detection index
+        '''
+        from scipy.optimize import linear_sum_assignment
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        from scipy.spatial import cKDTree
+
+        num_track, num_detect = len(self.state), len(detections)
+        if num_track == 0 or num_detect == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        pairs = cKDTree(self.state[:, :2]).sparse_distance_matrix(cKDTree(detections), self.gate, output_type='ndarray')
+        if len(pairs) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        i, j, distance = pairs['i'], pairs['j'], pairs['v']
+        graph = coo_matrix((np.ones(len(i)), (i, num_track + j)), shape=(num_track + num_detect, num_track + num_detect))
+        _, component = connected_components(graph, directed=False)
+        component = component[i]
+        size = np.bincount(component)
+        simple = size[component] == 1                   # one gated pair in the component: one track and one detection
+        rows, cols = [i[simple]], [j[simple]]
+        order = np.argsort(component[~simple], kind='stable')
+        i, j, distance, component = i[~simple][order], j[~simple][order], distance[~simple][order], component[~simple][order]
+        bounds = np.flatnonzero(np.diff(component)) + 1
+        for ci, cj, cd in zip(np.split(i, bounds), np.split(j, bounds), np.split(distance, bounds)):
+            if len(ci) == 0:
+                continue
+            tracks, ti = np.unique(ci, return_inverse=True)
+            detects, dj = np.unique(cj, return_inverse=True)
+            cost = np.full((len(tracks), len(detects)), self.gate * 1e3)
+            cost[ti, dj] = cd
+            r, c = linear_sum_assignment(cost)
+            keep = cost[r, c] <= self.gate
+            rows.append(tracks[r[keep]])
+            cols.append(detects[c[keep]])
+        return np.concatenate(rows).astype(int), np.concatenate(cols).astype(int)
+
+    def update(self, rows: np.ndarray, detections: np.ndarray):
+        '''Kalman update of the matched tracks, vectorized
+        '''
+        P = self.covariance[rows]
+        S = self.H @ P @ self.H.T + self.R                           # (m, 2, 2)
+        K = P @ self.H.T @ np.linalg.inv(S)                          # (m, 4, 2)
+        innovation = detections - self.state[rows, :2]
+        self.state[rows] += np.einsum('nij,nj->ni', K, innovation)
+        self.covariance[rows] = (np.eye(4) - K @ self.H) @ P
+
+    def step(self, detections):
+        '''process one frame
+        Args:
+            detections -- list<(float, float)> or np.ndarray -- the peaks of this frame, eg. from Utility.detect_peak
+        Return:
+            np.ndarray -- the confirmed tracks, one (id, x, y, vx, vy) per row
+        '''
+        detections = np.asarray(detections, dtype=float).reshape(-1, 2)
+        self.predict()
+        rows, cols = self.associate(detections)
+        self.update(rows, detections[cols])
+        matched = np.zeros(len(self.state), dtype=bool)
+        matched[rows] = True
+        self.hits[matched] += 1
+        self.missed[matched] = 0
+        self.missed[~matched] += 1
+
+        alive = self.missed <= self.max_missed
+        self.state, self.covariance = self.state[alive], self.covariance[alive]
+        self.ids, self.hits, self.missed = self.ids[alive], self.hits[alive], self.missed[alive]
+
+        new = np.ones(len(detections), dtype=bool)
+        new[cols] = False
+        num_new = new.sum()
+        if num_new > 0:
+            state = np.zeros((num_new, 4))
+            state[:, :2] = detections[new]
+            covariance = np.tile(np.diag([self.R[0, 0], self.R[1, 1], self.gate ** 2, self.gate ** 2]), (num_new, 1, 1))
+            self.state = np.concatenate([self.state, state])
+            self.covariance = np.concatenate([self.covariance, covariance])
+            self.ids = np.concatenate([self.ids, np.arange(self.next_id, self.next_id + num_new)])
+            self.hits = np.concatenate([self.hits, np.ones(num_new, dtype=int)])
+            self.missed = np.concatenate([self.missed, np.zeros(num_new, dtype=int)])
+            self.next_id += num_new
+        return self.tracks()
+
+    def tracks(self):
+        '''the confirmed tracks that are detected in the current frame
+        '''
+        confirmed = (self.hits >= self.min_hits) & (self.missed == 0)
+        return np.concatenate([self.ids[confirmed, None], self.state[confirmed]], axis=1)
+
+
+if __name__ == '__main__':
+
+    # the detections are the truth plus a localization error:
+    #   python tracking.py -nt 1000 -gl 1000 -nf 100
+    # the detections are NetTranslation4 (tiled) + detect_peak_batch on the frames of GenerateMovingData:
+    #   python tracking.py -nt 40 -gl 200 -nf 50 -m model/model1-11.10.pt
+
+    from generate import GenerateMovingData
+    from node import SensorArray
+
+    parser = argparse.ArgumentParser(description='Track moving TX')
+    parser.add_argument('-nt', '--num_tx', nargs=1, type=int, default=[1000], help='number of moving TX')
+    parser.add_argument('-gl', '--grid_length', nargs=1, type=int, default=[1000], help='the length of the grid')
+    parser.add_argument('-nf', '--num_frames', nargs=1, type=int, default=[100], help='number of frames')
+    parser.add_argument('-ve', '--velocity', nargs=1, type=float, default=[1], help='cells per frame')
+    parser.add_argument('-er', '--error', nargs=1, type=float, default=[1], help='std of the detection error, cells')
+    parser.add_argument('-m', '--model', nargs=1, type=str, default=[None], help='state dict of NetTranslation4, detect the TX in the frames')
+    parser.add_argument('-sd', '--sensor_density', nargs=1, type=float, default=[0.05], help='ratio of the cells with a sensor, with -m')
+    parser.add_argument('-th', '--threshold', nargs=1, type=float, default=[0.05], help='threshold of detect_peak, with -m')
+    args = parser.parse_args()
+
+    grid_length, num_tx, num_frames = args.grid_length[0], args.num_tx[0], args.num_frames[0]
+    gm = GenerateMovingData(Default.random_seed, Default.alpha, Default.std, grid_length, Default.cell_length, 0, Default.noise_floor)
+    if args.model[0] is None:
+        sensors = SensorArray.from_coordinates(np.zeros((0, 2)), grid_length)
+    else:
+        sensors = SensorArray.from_index(np.random.choice(grid_length ** 2, int(grid_length ** 2 * args.sensor_density[0]), replace=False), grid_length)
+    matrices, targets = gm.sequence(sensors, Default.power, num_tx, num_frames, args.velocity[0])
+    tracker = Tracker(measurement_noise=args.error[0])
+    from scipy.spatial import cKDTree
+
+    if args.model[0] is not None:
+        import torch
+        from dataset import UniformNormalize
+        from deepleaning_models import NetTranslation4
+        from ensemble import FusedLocalizer
+        from tiling import TiledInference
+        from utility import Utility
+
+        model = NetTranslation4()
+        model.load_state_dict(torch.load(args.model[0], map_location='cpu'))
+        tiled = TiledInference(model)
+        normalize = UniformNormalize(Default.noise_floor)
+
+    elapsed, detect_elapsed = 0, 0
+    errors, detection_errors = [], []
+    for matrix, target in zip(matrices, targets):
+        if args.model[0] is None:
+            detections = target + np.random.normal(0, args.error[0], target.shape)
+        else:
+            start = time.perf_counter()
+            image = tiled.predict(normalize(matrix))
+            peaks, _ = Utility.detect_peak_batch(image[None].copy(), [num_tx], args.threshold[0])
+            detections = np.array(FusedLocalizer.float_target(image, peaks[0])).reshape(-1, 2)
+            detect_elapsed += time.perf_counter() - start
+            if len(detections) > 0:
+                detection_errors.extend(cKDTree(target).query(detections)[0])
+        start = time.perf_counter()
+        tracks = tracker.step(detections)
+        elapsed += time.perf_counter() - start
+        if len(tracks) > 0:
+            errors.extend(cKDTree(target).query(tracks[:, 1:3])[0])
+    print(f'{num_tx * num_frames / elapsed:.0f} track updates per second, {num_frames / elapsed:.1f} frames per second')
+    if args.model[0] is None:
+        print(f'tracking error = {np.mean(errors):.3f}, detection error = {np.sqrt(2) * args.error[0] * np.sqrt(np.pi / 4):.3f}')
+    else:
+        print(f'detection = {num_frames / detect_elapsed:.2f} frames per second')
+        print(f'tracking error = {np.mean(errors):.3f}, detection error = {np.mean(detection_errors):.3f} (nearest TX of each peak)')
+    print(f'confirmed tracks = {len(tracks)}, total tracks created = {tracker.next_id}')
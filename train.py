@@ -0,0 +1,343 @@
+'''
+Training of the two CNNs in parallel: NetTranslation4 (image translation) and NetNumTx (# of TX)
+'''
+
+import argparse
+import contextlib
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import DataLoader
+from input_output import Default
+from utility import Utility
+from deepleaning_models import NetTranslation4, NetNumTx, NetNumTxPool
+from dataset import SensorInputDatasetShards, open_dataset, tf, my_collate, my_uncollate
+from shard import ChunkBatchSampler
+from ensemble import FusedLocalizer
+from sampler import StratifiedBatchSampler, Uniform, Curriculum
+from runtime import Runtime, WorkerInit
+from preprocess import Preprocess, PreprocessConfig
+from memory import ActivationCheckpoint, Memory
+
+
+class Metrics:
+    '''Evaluation metrics
+    '''
+    @staticmethod
+    def localization_error_image_continuous(pred_batch, pred_ntx, truth_batch, index, grid_len, debug=False):
+        '''Continuous -- for multi TX
+           euclidian error when modeling the output representation is a matrix (image)
+           both pred and truth are batches, typically a batch of 32
+        Args:
+            pred_batch:  numpy.ndarray -- size=(N, 1, 100, 100)
+            pred_ntx:    numpy.ndarray -- size=(N,)
+            truth_batch: numpy.ndarray -- size=(N, num_tx, 2)
+        Return:
+            errors    -- list<list>
+            misses    -- list
+            false     -- list
+        '''
+        pred_batch = pred_batch[:, 0]             # there is only one channel
+        pred_peaks, _ = Utility.detect_peak_batch(pred_batch.copy(), np.round(pred_ntx, 0), 0.1)
+        errors = []
+        misses = []
+        falses = []
+        for i, pred, peaks, truth, indx in zip(range(len(pred_batch)), pred_batch, pred_peaks, truth_batch, index):
+            peaks = FusedLocalizer.float_target(pred, peaks)
+            radius_threshold = grid_len * Default.error_threshold
+            error, miss, false = Utility.compute_error(peaks, truth, radius_threshold, False)
+            errors.append(error)
+            misses.append(miss)
+            falses.append(false)
+            if debug:
+                print(i, indx, 'pred', [(round(loc[0], 2), round(loc[1], 2)) for loc in peaks], '; truth', \
+                      [(round(loc[0], 2), round(loc[1], 2)) for loc in truth], ' ; error', error, ' ; miss', miss, ' ; false', false)
+        return errors, misses, falses
+
+    @staticmethod
+    def mean_std(values: list, world_size: int = 1):
+        '''the mean and std of the values, across all the ranks when training is distributed
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        moments = np.array([len(values), values.sum(), (values ** 2).sum()])
+        if world_size > 1:
+            import torch.distributed as dist
+            moments = torch.from_numpy(moments)
+            dist.all_reduce(moments)
+            moments = moments.numpy()
+        count, total, square = moments
+        if count == 0:
+            return np.nan, np.nan
+        mean = total / count
+        return mean, np.sqrt(max(square / count - mean ** 2, 0))
+
+
+class CountLoss(nn.Module):
+    '''the loss of the # of TX model: the cross entropy of the classes of NetNumTx (class 0 is 1 TX),
+       or a regression of the (N, 1) count of NetNumTxPool. The count is the sum of a density map, so poisson
+       (the negative log likelihood of a Poisson count) is the default, mse is the plain squared error
+    '''
+    def __init__(self, regression: str = 'poisson', count_head: bool = False):
+        '''
+        Args:
+            regression -- str  -- poisson or mse, the loss of a count
+            count_head -- bool -- the model outputs a count, see FusedLocalizer.is_count_head, otherwise classes
+        '''
+        super().__init__()
+        if regression not in ('poisson', 'mse'):
+            raise ValueError(f'unknown count loss {regression}')
+        self.regression = regression
+        self.count_head = count_head
+        self.cross_entropy = nn.CrossEntropyLoss()
+
+    def forward(self, pred_ntx: torch.Tensor, y_num: torch.Tensor):
+        if not self.count_head:
+            return self.cross_entropy(pred_ntx, y_num - 1)
+        count, target = pred_ntx[:, 0], y_num.float()
+        if self.regression == 'poisson':
+            return F.poisson_nll_loss(count, target, log_input=False)
+        return F.mse_loss(count, target)
+
+
+def no_sync(model: nn.Module, accumulate: bool):
+    '''no all reduce of the gradients of a DistributedDataParallel model while they are accumulated
+    '''
+    return model.no_sync() if accumulate and hasattr(model, 'no_sync') else contextlib.nullcontext()
+
+
+def train_test(train: str, test: str, num_epochs: int, model1: nn.Module, model2: nn.Module, augment=None,
+               batch_size: int = 32, num_workers: int = 3, device=None, error_every: int = 200, print_every: int = 200, schedule=None,
+               rank: int = 0, world_size: int = 1, runtime=None, cache_bytes: int = 0, preprocess=None,
+               checkpoint: int = 0, micro_batch: int = None, memory_budget: int = None, count_loss: str = 'poisson'):
+    '''
+    Args:
+        train       -- str       -- the training dataset, eg. matrix-train51, or its shards, eg. matrix-train51.shards
+        test        -- str       -- the testing dataset, eg. matrix-test51
+        num_epochs  -- int       -- number of epochs
+        model1      -- nn.Module -- the image translation model, eg. NetTranslation4
+        model2      -- nn.Module -- the # of TX model, NetNumTx (classes) or NetNumTxPool (a count)
+        augment     -- callable  -- eg. SensorAugment, applied to every training batch on the device after collate
+        device      -- torch.device -- by default cuda if available, otherwise cpu
+        schedule    -- callable  -- the stratum weights of StratifiedBatchSampler, eg. Curriculum(). None is a plain shuffle
+        rank        -- int       -- the rank of this process, when the models are wrapped in DistributedDataParallel
+        world_size  -- int       -- number of processes, each one loads a shard of the dataset with batch_size samples per step
+        runtime     -- RuntimeConfig -- the cores and threads of the DataLoader workers, see Runtime.plan
+        cache_bytes -- int       -- the budget of the shared cache of the normalized training samples, 0 is no cache
+        preprocess  -- Preprocess -- normalize the raw batches on the device, instead of tf per sample in the workers
+        checkpoint  -- int       -- the channel groups of the ActivationCheckpoint of model1, 0 is no checkpoint
+        micro_batch -- int       -- the samples of one forward and backward, the gradients are accumulated over the batch
+        memory_budget -- int     -- bytes, the micro batch is the largest one whose measured peak is within it
+        count_loss  -- str       -- poisson or mse, the loss of a NetNumTxPool model2, see CountLoss
+    Return:
+        dict -- the (mean, std) of the losses and errors of each epoch
+    '''
+    train = os.path.join('.', 'data', train)
+    transform = tf if preprocess is None else None
+    sensor_input_dataset = open_dataset(train, transform, cache_bytes)
+    test = os.path.join('.', 'data', test)
+    worker_init = WorkerInit(runtime) if runtime is not None else None
+    sensor_input_test_dataset = open_dataset(test, transform)
+    preprocess = nn.Identity() if preprocess is None else preprocess
+    if schedule is None:
+        batch_sampler = ChunkBatchSampler(sensor_input_dataset.reader, batch_size, num_workers) \
+                        if isinstance(sensor_input_dataset, SensorInputDatasetShards) and world_size == 1 else None
+    else:
+        batch_sampler = StratifiedBatchSampler(sensor_input_dataset.index, batch_size * world_size, schedule)
+    if world_size == 1:
+        if batch_sampler is None:
+            sensor_input_dataloader = DataLoader(sensor_input_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, collate_fn=my_collate, worker_init_fn=worker_init)
+        else:
+            sensor_input_dataloader = DataLoader(sensor_input_dataset, batch_sampler=batch_sampler, num_workers=num_workers, collate_fn=my_collate, worker_init_fn=worker_init)
+        sensor_input_test_dataloader = DataLoader(sensor_input_test_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, collate_fn=my_collate, worker_init_fn=worker_init)
+    else:
+        from torch.utils.data.distributed import DistributedSampler
+        from distributed import ShardedBatchSampler
+        if batch_sampler is None:
+            batch_sampler = DistributedSampler(sensor_input_dataset, world_size, rank, shuffle=True)
+            sensor_input_dataloader = DataLoader(sensor_input_dataset, batch_size=batch_size, sampler=batch_sampler, num_workers=num_workers, collate_fn=my_collate, worker_init_fn=worker_init)
+        else:
+            batch_sampler = ShardedBatchSampler(batch_sampler, rank, world_size)
+            sensor_input_dataloader = DataLoader(sensor_input_dataset, batch_sampler=batch_sampler, num_workers=num_workers, collate_fn=my_collate, worker_init_fn=worker_init)
+        test_sampler = DistributedSampler(sensor_input_test_dataset, world_size, rank, shuffle=False)
+        sensor_input_test_dataloader = DataLoader(sensor_input_test_dataset, batch_size=batch_size, sampler=test_sampler, num_workers=num_workers, collate_fn=my_collate, worker_init_fn=worker_init)
+
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model1     = model1.to(device)
+    optimizer1 = optim.Adam(model1.parameters(), lr=0.001)
+    model2     = model2.to(device)
+    optimizer2 = optim.Adam(model2.parameters(), lr=0.001)
+    forward1   = ActivationCheckpoint(model1, checkpoint) if checkpoint else model1
+    if memory_budget is not None:
+        micro_batch, peak = Memory.feasible_batch_size([forward1, model2], (1, Default.grid_length, Default.grid_length),
+                                                       memory_budget, batch_size, device=device)
+        if rank == 0:
+            print(f'micro batch = {micro_batch}, peak memory = {peak / 2**20:.0f} MB, budget = {memory_budget / 2**20:.0f} MB')
+    micro_batch = batch_size if micro_batch is None else micro_batch
+    mse_loss   = nn.MSELoss()  # criterion is the loss function
+    count_head = FusedLocalizer.is_count_head(model2)
+    count_loss = CountLoss(count_loss, count_head)
+
+    history = {'train_loss1': [], 'train_loss2': [], 'train_error1': [], 'train_error2': [],
+               'test_loss1': [], 'test_loss2': [], 'test_error1': [], 'test_error2': [], 'test_miss1': [], 'test_false1': [],
+               'peak_memory_mb': []}
+
+    for epoch in range(num_epochs):
+        if rank == 0:
+            print(f'epoch = {epoch}')
+        if batch_sampler is not None:
+            batch_sampler.set_epoch(epoch)
+        stats = {key: [] for key in history}
+        model1.train()
+        model2.train()
+        for t, sample in enumerate(sensor_input_dataloader):
+            Memory.reset_peak(device)
+            X = preprocess(sample['matrix'].to(device))
+            y = sample['target'].to(device)
+            y_num   = sample['target_num'].to(device)
+            y_float = sample['target_float']
+            if augment is not None:
+                X, y, y_float = augment(X, y, y_float.to(device), y_num)
+            y_num2  = np.array(sample['target_num'])
+            y_float = my_uncollate(y_num2, y_float.cpu().numpy())
+            indx = sample['index']
+
+            optimizer1.zero_grad()
+            optimizer2.zero_grad()
+            loss1, loss2, pred_matrix, pred_ntx = 0, 0, [], []
+            for i in range(0, len(X), micro_batch):      # the mean of the batch is the weighted sum of the micro batch means
+                weight = len(X[i:i + micro_batch]) / len(X)
+                accumulate = i + micro_batch < len(X)    # DistributedDataParallel all reduces at the last micro batch only
+                with no_sync(model1, accumulate):
+                    pred = forward1(X[i:i + micro_batch])    # the model for iamge translation
+                    loss = mse_loss(pred, y[i:i + micro_batch]) * weight
+                    loss.backward()
+                loss1 += loss.item()
+                pred_matrix.append(pred.detach())
+
+                with no_sync(model2, accumulate):
+                    pred = model2(X[i:i + micro_batch])      # the model for num TX
+                    loss = count_loss(pred, y_num[i:i + micro_batch]) * weight
+                    loss.backward()
+                loss2 += loss.item()
+                pred_ntx.append(pred.detach())
+            optimizer1.step()
+            optimizer2.step()
+            pred_matrix, pred_ntx = torch.cat(pred_matrix), torch.cat(pred_ntx)
+            peak = Memory.peak(device)
+
+            stats['train_loss1'].append(loss1)
+            stats['train_loss2'].append(loss2)
+            if peak is not None:
+                stats['peak_memory_mb'].append(peak / 2**20)
+            if t % error_every == 0:
+                pred_matrix = pred_matrix.data.cpu().numpy()
+                pred_ntx = FusedLocalizer.num_tx(pred_ntx.data, count_head).cpu().numpy()
+                errors, _, _ = Metrics.localization_error_image_continuous(pred_matrix, pred_ntx, y_float, indx, Default.grid_length)
+                stats['train_error1'].extend([e for error in errors for e in error])
+                stats['train_error2'].append(1 - (pred_ntx == y_num2).mean())
+            if t % print_every == 0 and rank == 0:
+                memory = '' if peak is None else f', peak_memory = {peak / 2**20:.0f} MB'
+                print(f't = {t}, loss_matrix = {loss1}, loss_num_tx = {loss2}{memory}')
+
+        model1.eval()
+        model2.eval()
+        with torch.no_grad():
+            for t, sample in enumerate(sensor_input_test_dataloader):
+                X = preprocess(sample['matrix'].to(device))
+                y = sample['target'].to(device)
+                y_num   = sample['target_num'].to(device)
+                y_num2  = np.array(sample['target_num'])
+                y_float = my_uncollate(y_num2, np.array(sample['target_float']))
+                indx = sample['index']
+
+                pred_matrix = model1(X)
+                pred_ntx = model2(X)
+                stats['test_loss1'].append(mse_loss(pred_matrix, y).item())
+                stats['test_loss2'].append(count_loss(pred_ntx, y_num).item())
+                if t % error_every == 0:
+                    pred_matrix = pred_matrix.data.cpu().numpy()
+                    pred_ntx = FusedLocalizer.num_tx(pred_ntx.data, count_head).cpu().numpy()
+                    errors, misses, falses = Metrics.localization_error_image_continuous(pred_matrix, pred_ntx, y_float, indx, Default.grid_length)
+                    stats['test_error1'].extend([e for error in errors for e in error])
+                    stats['test_miss1'].extend(misses)
+                    stats['test_false1'].extend(falses)
+                    stats['test_error2'].append(1 - (pred_ntx == y_num2).mean())
+
+        for key, values in stats.items():
+            history[key].append(Metrics.mean_std(values, world_size))
+            if rank == 0:
+                print(f'{key:<13} = {history[key][-1][0]}')
+        if sensor_input_dataset.cache is not None and rank == 0:
+            print(f'sample cache  : {sensor_input_dataset.cache.summary()}')
+    return history
+
+
+if __name__ == '__main__':
+
+    # python train.py -tr matrix-train51 -te matrix-test51 -ep 10 -mn 10 -au -o model/model-aug
+    # python train.py -tr matrix-train52 -te matrix-test52 -ep 10 -mn 10 -sa curriculum -wu 5
+    # python train.py -tr matrix-train51 -te matrix-test51 -ep 10 -mn 10 -cm 2048
+    # python train.py -tr matrix-train51 -te matrix-test51 -ep 10 -mn 10 -ck 4 -mm 0
+    # python train.py -tr matrix-train51 -te matrix-test51 -ep 10 -hd pool -cl poisson
+
+    from augmentation import SensorAugment
+
+    parser = argparse.ArgumentParser(description='Train NetTranslation4 and NetNumTx')
+    parser.add_argument('-tr', '--train', nargs=1, type=str, default=['matrix-train51'], help='the training dataset in data/')
+    parser.add_argument('-te', '--test', nargs=1, type=str, default=['matrix-test51'], help='the testing dataset in data/')
+    parser.add_argument('-ep', '--num_epochs', nargs=1, type=int, default=[10], help='number of epochs')
+    parser.add_argument('-mn', '--max_ntx', nargs=1, type=int, default=[10], help='max_ntx of NetNumTx')
+    parser.add_argument('-hd', '--head', nargs=1, type=str, default=['fc'], choices=['fc', 'pool'],
+                        help='the # of TX model: fc is NetNumTx (classes, 100 x 100 only), pool is NetNumTxPool (a count, any grid size)')
+    parser.add_argument('-cl', '--count_loss', nargs=1, type=str, default=['poisson'], choices=['poisson', 'mse'], help='the loss of the pool head')
+    parser.add_argument('-bs', '--batch_size', nargs=1, type=int, default=[32], help='the batch size')
+    parser.add_argument('-nw', '--num_workers', nargs=1, type=int, default=[3], help='number of DataLoader workers')
+    parser.add_argument('-au', '--augment', action='store_true', help='online sensor dropout, jitter, flips and translations')
+    parser.add_argument('-dr', '--dropout', nargs=1, type=float, default=[0.1], help='probability of dropping a sensor')
+    parser.add_argument('-ji', '--jitter', nargs=1, type=float, default=[0.025], help='std of the reading jitter, normalized unit')
+    parser.add_argument('-ms', '--max_shift', nargs=1, type=int, default=[10], help='max translation in cells')
+    parser.add_argument('-sa', '--sampler', nargs=1, type=str, default=['shuffle'], choices=['shuffle', 'uniform', 'curriculum'],
+                        help='plain shuffle, or batches stratified by num_tx and TX distance, or a curriculum from easy to hard strata')
+    parser.add_argument('-wu', '--warmup', nargs=1, type=int, default=[5], help='epochs of the curriculum until all strata are uniform')
+    parser.add_argument('-rt', '--runtime', action='store_true', help='split the cores between the DataLoader workers and the intra-op threads')
+    parser.add_argument('-ab', '--autotune_batch', action='store_true', help='use the batch size with the most samples per second')
+    parser.add_argument('-pp', '--preprocess', nargs=1, type=str, default=['cpu'], choices=['cpu', 'uniform', 'minmax'],
+                        help='cpu is the per sample tf in the workers, the others normalize the batches on the device')
+    parser.add_argument('-cm', '--cache_mb', nargs=1, type=float, default=[0], help='MB of the shared cache of the training samples')
+    parser.add_argument('-ck', '--checkpoint', nargs=1, type=int, default=[0], help='the channel groups of the activation checkpoint of NetTranslation4, 0 is no checkpoint')
+    parser.add_argument('-mb', '--micro_batch', nargs=1, type=int, default=[None], help='samples of one forward and backward, the gradients are accumulated')
+    parser.add_argument('-mm', '--memory_mb', nargs=1, type=float, default=[None], help='pick the largest micro batch within this MB, 0 is 80%% of the available memory')
+    parser.add_argument('-o', '--output', nargs=1, type=str, default=[None], help='save the state dicts as {output}-1.pt and {output}-2.pt')
+    args = parser.parse_args()
+
+    start = time.time()
+    augment = SensorAugment(args.dropout[0], args.jitter[0], True, args.max_shift[0]) if args.augment else None
+    runtime = Runtime.apply(Runtime.plan(args.num_workers[0])) if args.runtime else None
+    schedule = {'shuffle': None, 'uniform': Uniform(), 'curriculum': Curriculum(args.warmup[0])}[args.sampler[0]]
+    model1, model2 = NetTranslation4(), NetNumTx(args.max_ntx[0]) if args.head[0] == 'fc' else NetNumTxPool()
+    config = PreprocessConfig('uniform' if args.preprocess[0] == 'cpu' else args.preprocess[0])     # tf is the uniform one
+    preprocess = None if args.preprocess[0] == 'cpu' else Preprocess(config)
+    batch_size = args.batch_size[0]
+    if args.autotune_batch:                 # in the threads of -rt if it is applied, otherwise in the default threads
+        batch_size, _ = Runtime.autotune_batch_size(model1, config=runtime)
+    memory_budget = None
+    if args.memory_mb[0] is not None:
+        memory_budget = int(args.memory_mb[0] * 2**20) if args.memory_mb[0] > 0 else Memory.available()
+    if runtime is not None:
+        runtime.batch_size = batch_size
+        metadata = Runtime.metadata(runtime, None if args.output[0] is None else f'{args.output[0]}.runtime.txt', train=args.train[0])
+        print('\n'.join(metadata))
+    train_test(args.train[0], args.test[0], args.num_epochs[0], model1, model2, augment, batch_size, args.num_workers[0],
+               schedule=schedule, runtime=runtime, cache_bytes=int(args.cache_mb[0] * 2**20),
+               preprocess=preprocess, checkpoint=args.checkpoint[0], micro_batch=args.micro_batch[0], memory_budget=memory_budget,
+               count_loss=args.count_loss[0])
+    if args.output[0] is not None:
+        torch.save(model1.state_dict(), f'{args.output[0]}-1.pt')
+        torch.save(model2.state_dict(), f'{args.output[0]}-2.pt')
+        config.save(f'{args.output[0]}.preprocess.json')
+    print('time = {}'.format(time.time() - start))
@@ -0,0 +1,207 @@
+'''
+Tune the threshold and the window sizes of Utility.detect_peak (the # TUNE) on cached predictions:
+successive halving over growing subsets of the samples, the evaluations run in a process pool
+'''
+
+import argparse
+import itertools
+import json
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, asdict
+from typing import List
+import numpy as np
+from input_output import Default
+from sample_index import SampleIndex
+from prediction_cache import evaluate
+
+
+@dataclass
+class PeakProfile:
+    '''the parameters of Utility.detect_peak and detect_peak_batch (profile=...), and how they scored
+    '''
+    threshold: float = 0.05
+    size: List[int] = field(default_factory=lambda: [40, 30, 20, 15, 10, 5])   # first pass, decreasing
+    fine_size: List[int] = field(default_factory=lambda: [5, 4, 3, 2])         # second pass when no size of the first pass fits
+    score: float = None
+    error: float = None
+    miss: float = None
+    false: float = None
+    samples: int = None
+    source: dict = field(default_factory=dict)                                 # what it was tuned on
+
+    def __post_init__(self):
+        if not self.size or not self.fine_size or any(a <= b for a, b in zip(self.size, self.size[1:])):
+            raise ValueError(f'size must be decreasing and fine_size not empty: {self.size}, {self.fine_size}')
+
+    def save(self, filename: str):
+        with open(filename, 'w') as f:
+            json.dump(asdict(self), f, indent=1)
+
+    @classmethod
+    def load(cls, filename: str):
+        '''eg. Utility.detect_peak(image, num_tx, profile=PeakProfile.load('model/model1-11.10.peak.json'))
+        '''
+        with open(filename) as f:
+            return cls(**json.load(f))
+
+    def parameters(self):
+        return f'threshold = {self.threshold:<5} size = {self.size} fine size = {self.fine_size}'
+
+
+worker_state = {}       # the predictions and the SampleIndex of a worker process
+
+
+class PeakTuner:
+    '''Successive halving: all the candidates are evaluated on a small subset of the samples, the best 1/eta are kept and
+       evaluated on eta times more samples, until one is left. The subsets are nested chunks of one random permutation, so
+       a (candidate, chunk) is evaluated once and the pool gets many small tasks.
+       The objective is weights[0] * mean error + weights[1] * misses per sample + weights[2] * false alarms per sample
+    '''
+    def __init__(self, predictions, root_dir: str, weights=(1, 1, 1), num_workers: int = 2, eta: int = 3,
+                 min_samples: int = 64, chunk_size: int = 16, seed: int = 0):
+        '''
+        Args:
+            predictions -- str or np.memmap -- the outputs of NetTranslation4, a .npy of PredictionCache or its memory map
+            root_dir    -- str        -- the dataset of the predictions, for the truth
+            weights     -- tuple      -- of the mean error (cells), the misses and the false alarms
+            num_workers -- int        -- processes of the pool, 0 evaluates in this process
+            eta         -- int        -- 1/eta of the candidates survive each rung
+            min_samples -- int        -- samples of the first rung, at least
+        '''
+        self.path = predictions if isinstance(predictions, str) else predictions.filename
+        self.root_dir = root_dir
+        self.weights = weights
+        self.num_workers = num_workers
+        self.eta = eta
+        self.min_samples = min_samples
+        num = len(np.load(self.path, mmap_mode='r'))
+        order = np.random.default_rng(seed).permutation(num)
+        self.chunks = [order[i:i + chunk_size] for i in range(0, num, chunk_size)]
+        self.results = {}                # (candidate, chunk) -> (sum of errors, # of errors, misses, false alarms, samples)
+
+    @staticmethod
+    def space(thresholds=(0.05, 0.1, 0.15, 0.2, 0.3),
+              sizes=((40, 30, 20, 15, 10, 5), (30, 20, 15, 10, 5), (40, 20, 10, 5), (50, 40, 30, 20, 15, 10, 5), (20, 15, 10, 7, 5)),
+              fine_sizes=((5, 4, 3, 2), (4, 3, 2), (6, 5, 4, 3), (5, 4, 3))):
+        '''the grid of candidates
+        '''
+        return [PeakProfile(t, list(s), list(f)) for t, s, f in itertools.product(thresholds, sizes, fine_sizes)]
+
+    @staticmethod
+    def init_worker(path: str, root_dir: str):
+        worker_state['predictions'] = np.load(path, mmap_mode='r')
+        worker_state['index'] = SampleIndex.load(root_dir)
+        worker_state['root_dir'] = root_dir
+
+    @staticmethod
+    def evaluate_chunk(profile: PeakProfile, indices: np.ndarray):
+        errors, misses, falses = evaluate(worker_state['predictions'], worker_state['root_dir'], indices=indices,
+                                          profile=profile, index=worker_state['index'])
+        return sum(errors), len(errors), sum(misses), sum(falses), len(indices)
+
+    def score(self, candidate: int, num_chunks: int):
+        '''the objective on the first num_chunks chunks
+        Return:
+            float, float, float, float -- score, mean error, misses and false alarms per sample
+        '''
+        total = np.sum([self.results[(candidate, c)] for c in range(num_chunks)], axis=0)
+        error = total[0] / total[1] if total[1] else Default.grid_length * Default.error_threshold   # nothing detected
+        miss, false = total[2] / total[4], total[3] / total[4]
+        return float(np.dot(self.weights, [error, miss, false])), float(error), float(miss), float(false)
+
+    def evaluate(self, executor, candidates: list, alive: list, num_chunks: int):
+        '''evaluate the alive candidates on the first num_chunks chunks, only the (candidate, chunk) not done yet
+        '''
+        todo = [(i, c) for i in alive for c in range(num_chunks) if (i, c) not in self.results]
+        if executor is None:
+            for i, c in todo:
+                self.results[(i, c)] = PeakTuner.evaluate_chunk(candidates[i], self.chunks[c])
+            return
+        futures = {(i, c): executor.submit(PeakTuner.evaluate_chunk, candidates[i], self.chunks[c]) for i, c in todo}
+        for key, future in futures.items():
+            self.results[key] = future.result()
+
+    def run(self, candidates: List[PeakProfile], verbose: bool = True):
+        '''
+        Args:
+            candidates -- list<PeakProfile> -- eg. PeakTuner.space()
+        Return:
+            list<PeakProfile> -- the candidates evaluated on all the samples (the survivors of the last rung),
+                                 best first, with their score
+        '''
+        rungs = math.ceil(math.log(max(len(candidates), 1), self.eta))
+        num = sum(len(c) for c in self.chunks)
+        samples = min(num, max(self.min_samples, num // self.eta ** rungs))
+        alive = list(range(len(candidates)))
+        executor = None
+        if self.num_workers > 0:
+            executor = ProcessPoolExecutor(self.num_workers, initializer=PeakTuner.init_worker, initargs=(self.path, self.root_dir))
+        else:
+            PeakTuner.init_worker(self.path, self.root_dir)
+        try:
+            while True:
+                num_chunks = next(c for c in range(1, len(self.chunks) + 1) if sum(len(k) for k in self.chunks[:c]) >= samples)
+                start = time.perf_counter()
+                self.evaluate(executor, candidates, alive, num_chunks)
+                alive.sort(key=lambda i: self.score(i, num_chunks)[0])
+                if verbose:
+                    best = self.score(alive[0], num_chunks)
+                    print(f'{len(alive):>4} candidates on {samples:>5} samples, {time.perf_counter() - start:6.1f} s, '
+                          f'best score = {best[0]:.4f} ({candidates[alive[0]].parameters()})')
+                if samples >= num:
+                    break
+                alive = alive[:max(math.ceil(len(alive) / self.eta), 1)]
+                samples = min(num, samples * self.eta)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        profiles = []
+        for i in alive:
+            profile = PeakProfile(candidates[i].threshold, candidates[i].size, candidates[i].fine_size)
+            profile.score, profile.error, profile.miss, profile.false = self.score(i, len(self.chunks))
+            profile.samples = num
+            profiles.append(profile)
+        return profiles
+
+
+if __name__ == '__main__':
+
+    # python tuning.py -rd data/matrix-test51 -c model/model1-11.10.pt -w 1 1 1 -nw 4 -o model/model1-11.10.peak.json
+
+    import torch
+    from deepleaning_models import NetTranslation4
+    from prediction_cache import PredictionCache
+
+    parser = argparse.ArgumentParser(description='Tune the threshold and the window sizes of the peak detection')
+    parser.add_argument('-rd', '--root_dir', nargs=1, type=str, default=['data/matrix-test51'], help='the tuning dataset')
+    parser.add_argument('-c', '--checkpoint', nargs=1, type=str, default=['model/model1-11.10.pt'], help='the state dict of NetTranslation4')
+    parser.add_argument('-cd', '--cache_dir', nargs=1, type=str, default=[None], help='the prediction cache, by default $XDG_CACHE_HOME/deeplearning-localization/predictions')
+    parser.add_argument('-o', '--output', nargs=1, type=str, default=[None], help='the profile, by default {checkpoint}.peak.json')
+    parser.add_argument('-w', '--weights', nargs=3, type=float, default=[1, 1, 1], help='weights of the mean error, miss and false alarm')
+    parser.add_argument('-th', '--threshold', nargs='+', type=float, default=[0.05, 0.1, 0.15, 0.2, 0.3], help='the candidate thresholds')
+    parser.add_argument('-nw', '--num_workers', nargs=1, type=int, default=[2], help='processes of the pool')
+    parser.add_argument('-eta', '--eta', nargs=1, type=int, default=[3], help='1/eta of the candidates survive each rung')
+    parser.add_argument('-ms', '--min_samples', nargs=1, type=int, default=[64], help='samples of the first rung')
+    args = parser.parse_args()
+
+    model = NetTranslation4()
+    model.load_state_dict(torch.load(args.checkpoint[0], map_location='cpu'))
+    predictions = PredictionCache(args.cache_dir[0]).predictions(model, args.checkpoint[0], args.root_dir[0])
+
+    candidates = PeakTuner.space(args.threshold)
+    tuner = PeakTuner(predictions, args.root_dir[0], args.weights, args.num_workers[0], args.eta[0], args.min_samples[0])
+    start = time.perf_counter()
+    profiles = tuner.run(candidates)
+    print(f'{len(candidates)} candidates in {time.perf_counter() - start:.1f} s')
+
+    best = profiles[0]
+    best.source = {'dataset': args.root_dir[0], 'checkpoint': args.checkpoint[0], 'weights': args.weights}
+    output = args.output[0] or args.checkpoint[0].rsplit('.', 1)[0] + '.peak.json'
+    best.save(output)
+    for name, profile in [('default', PeakProfile()), ('tuned', best)]:
+        errors, misses, falses = evaluate(predictions, args.root_dir[0], profile=profile)
+        print(f'{name:<8} {profile.parameters()}\n         error = {np.mean(errors):.4f}, miss = {np.mean(misses):.4f}, '
+              f'false = {np.mean(falses):.4f}')
+    print(f'profile saved to {output}')
@@ -2,20 +2,11 @@
 common utility
 '''
 
-import torch
 import math
 import os
 import shutil
 import time
 import numpy as np
-from scipy.ndimage.filters import maximum_filter
-from scipy.ndimage.morphology import generate_binary_structure, binary_erosion
-from torch._six import container_abcs, string_classes, int_classes
-import re
-np_str_obj_array_pattern = re.compile(r'[SaUO]')
-default_collate_err_msg_format = (
-    "default_collate: batch must contain tensors, numpy arrays, numbers, "
-    "dicts or lists; found {}")
 
 
 class Utility:
@@ -73,7 +64,7 @@ class Utility:
         return db
 
     @staticmethod
-    def detect_peak(image, num_tx: int, threshold=0.05):  # TUNE: a larger threshold will decrease false
+    def detect_peak(image, num_tx: int, threshold=0.05, profile=None):  # TUNE: a larger threshold will decrease false
         """
         Returns a boolean mask of the peaks (i.e. 1 when
         the pixel's value is the neighborhood maximum, 0 otherwise)
@@ -81,9 +72,12 @@ class Utility:
             image  -- array-like -- (100,100)
             num_tx -- int -- number of Tx
             threshold -- float -- threshold for non-tx areas
+            profile -- PeakProfile -- the tuned threshold and window sizes (see tuning.py), overrides threshold
         Return:
             list<(int, int)>: a list of peaks
         """
+        from scipy.ndimage import maximum_filter, binary_erosion
+
         def detect_helper(size):
             '''Takes an image and detect the peaks using the local maximum filter
             '''
@@ -112,8 +106,10 @@ class Utility:
             memo[size] = detected_peaks
             return detected_peaks
 
+        size, fine_size = [40, 30, 20, 15, 10, 5], [5, 4, 3, 2]    # TUNE: a larger size will decrease false
+        if profile is not None:
+            threshold, size, fine_size = profile.threshold, list(profile.size), list(profile.fine_size)
         memo = {}
-        size = [40, 30, 20, 15, 10, 5]             # TUNE: a larger size will decrease false
         peaks = []
         peaks_num = []
         for i, s in enumerate(size):               # first pass with coarse grain size
@@ -131,7 +127,7 @@ class Utility:
                 new_size = list(range(size[i], size[i+1]-1, -1))
                 break
         else:
-            new_size = [5, 4, 3, 2]
+            new_size = fine_size
         peaks_num = []
         for s in new_size:
             peaks = detect_helper(s)
@@ -152,6 +148,93 @@ class Utility:
         return [(x, y) for x, y in zip(peaks[0], peaks[1])], new_size[min_i]
 
 
+    @staticmethod
+    def detect_peak_batch(images, num_txs, threshold=0.05, profile=None):
+        """batched version of detect_peak, returns the same peaks as calling detect_peak on each image.
+           the maximum filter and the erosion of a window size run once over all the images that need this size
+        Args:
+            images    -- np.ndarray -- (N, 100, 100)
+            num_txs   -- array-like -- (N,) number of Tx of each image
+            threshold -- float      -- threshold for non-tx areas
+            profile   -- PeakProfile -- the tuned threshold and window sizes (see tuning.py), overrides threshold
+        Return:
+            list<list<(int, int)>>, list<int>: the peaks and the window size of each image
+        """
+        from scipy.ndimage import maximum_filter, binary_erosion
+
+        def detect_helper(indx, size):
+            '''run the local maximum filter of one size over the images in indx, memo the peaks of each image
+            '''
+            indx = [i for i in indx if size not in memo[i]]
+            if len(indx) == 0:
+                return
+            sub = images[indx]
+            neighborhood = np.ones((1, size, size), dtype=bool)
+            local_max = maximum_filter(sub, footprint=neighborhood) == sub
+            background = (sub < threshold)
+            eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
+            detected_peaks = local_max ^ eroded_background
+            for k, i in enumerate(indx):
+                peaks = np.where(detected_peaks[k] == True)
+                memo[i][size] = [(x, y) for x, y in zip(peaks[0], peaks[1])]
+
+        size, fine_size = [40, 30, 20, 15, 10, 5], [5, 4, 3, 2]    # TUNE: a larger size will decrease false
+        if profile is not None:
+            threshold, size, fine_size = profile.threshold, list(profile.size), list(profile.fine_size)
+        images = np.asarray(images)
+        images[images < threshold] = 0
+        num_txs = [int(n) for n in num_txs]
+        memo = [{} for _ in range(len(images))]
+        results = [None] * len(images)
+        sizes = [None] * len(images)
+        unresolved = list(range(len(images)))
+        for j, s in enumerate(size):               # first pass with coarse grain size
+            detect_helper(unresolved, s)
+            remain = []
+            for i in unresolved:
+                num = len(memo[i][s])
+                if (j == 0 and num > num_txs[i]) or num == num_txs[i]:
+                    results[i], sizes[i] = memo[i][s], s
+                else:
+                    remain.append(i)
+            unresolved = remain
+
+        new_sizes = {}                             # second pass with fine coarse size
+        for i in unresolved:
+            peaks_num = [len(memo[i][s]) for s in size]
+            for j in range(len(peaks_num)-1):
+                if peaks_num[j] < num_txs[i] < peaks_num[j+1]:
+                    new_sizes[i] = list(range(size[j], size[j+1]-1, -1))
+                    break
+            else:
+                new_sizes[i] = fine_size
+        k = 0
+        while unresolved:
+            groups = {}
+            for i in unresolved:
+                if k < len(new_sizes[i]):
+                    groups.setdefault(new_sizes[i][k], []).append(i)
+            if len(groups) == 0:
+                break
+            for s, indx in groups.items():
+                detect_helper(indx, s)
+                for i in indx:
+                    if len(memo[i][s]) == num_txs[i]:
+                        results[i], sizes[i] = memo[i][s], s
+            unresolved = [i for i in unresolved if results[i] is None]
+            k += 1
+
+        for i in unresolved:
+            min_diff = 100
+            min_s = new_sizes[i][0]
+            for s in new_sizes[i]:
+                diff = abs(num_txs[i] - len(memo[i][s]))
+                if diff <= min_diff:
+                    min_diff = diff
+                    min_s = s
+            results[i], sizes[i] = memo[i][min_s], min_s
+        return results, sizes
+
     @staticmethod
     def compute_error(pred_locations, true_locations, distance_threshold, debug=False):
         '''Given the true location and localization location, computer the error **for our localization**
@@ -2,25 +2,24 @@
 visualization
 '''
 
-from typing import List
-
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+from node import SensorArray
 
 
 class Visualize:
     '''some visualization
     '''
     @classmethod
-    def sensors(cls, sensors: List[int], grid_length: int, fig: int):
+    def sensors(cls, sensors, grid_length: int, fig: int):
         '''visualize the sensor location
+        Args:
+            sensors -- SensorArray or list<int> -- the sensors, or their flat indices
         '''
-        grid = np.zeros((grid_length, grid_length))
-        for sensor in sensors:
-            x = sensor // grid_length
-            y = sensor % grid_length
-            grid[x][y] = 1
+        if not isinstance(sensors, SensorArray):
+            sensors = SensorArray.from_index(sensors, grid_length)
+        grid = sensors.mask().astype(float)
         sns.set(style="white")
         plt.subplots(figsize=(25, 25))
         sns.heatmap(grid, center=0, square=True, linewidth=1, cbar_kws={"shrink": .5}, annot=False)